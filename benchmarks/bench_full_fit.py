@@ -0,0 +1,39 @@
+r"""Benchmark of the native sigma-clipped solver against the astropy `FittingWithOutlierRemoval` path.
+
+Run with:
+
+>>> python -m benchmarks.bench_full_fit
+"""
+
+import timeit
+
+import numpy as np
+
+from benchmarks.synthetic import synthetic_lines
+from gnirsarc2d.fitting import arc2d
+from gnirsarc2d.gnirs_config import gnirs
+
+
+def main(number: int = 20):
+    configuration = gnirs.GnirsConfiguration(name='32/mmSB')
+    for lines_per_order in [20, 100, 500]:
+        pixel, wavelength, order, _ = synthetic_lines(lines_per_order=lines_per_order)
+        for fit_function in arc2d.FIT_FUNCTIONS:
+            results, timings = {}, {}
+            for fitter in arc2d.FITTERS:
+                def run():
+                    return arc2d.full_fit(pixel, wavelength, order, tot_pixel=configuration.cols,
+                                          fit_function=fit_function, fitter=fitter)
+                results[fitter] = run()
+                timings[fitter] = min(timeit.repeat(run, number=number, repeat=3)) / number
+            same_mask = np.array_equal(results['native'][1], results['astropy'][1])
+            max_delta = np.max(np.abs(results['native'][0].parameters - results['astropy'][0].parameters))
+            print('{:4d} lines/order {:12s} astropy={:8.3f} ms native={:8.3f} ms speed-up={:5.1f}x '
+                  'same mask={} max coeff. diff={:.2e}'.format(lines_per_order, fit_function,
+                                                              1.e3 * timings['astropy'], 1.e3 * timings['native'],
+                                                              timings['astropy'] / timings['native'], same_mask,
+                                                              max_delta))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+r"""Import-time benchmark of the gnirsarc2d modules, based on `python -X importtime`.
+
+Each module is imported in a fresh interpreter. The script reports the cumulative import time and checks that the
+heavy plotting and modeling stacks are not loaded as a side effect. It exits with a non-zero status if a module is
+slower than its budget or if it imports one of the `HEAVY_MODULES`.
+
+Run with:
+
+>>> python -m benchmarks.bench_import_time
+"""
+
+import re
+import subprocess
+import sys
+
+HEAVY_MODULES = ['matplotlib', 'astropy']
+
+# Budgets in milliseconds, deliberately generous to avoid failures on slow machines
+IMPORT_BUDGETS = {'gnirsarc2d.scripts.fit_arc2d': 150.,
+                  'gnirsarc2d.fitting.arc2d': 500.,
+                  'gnirsarc2d.io.read_iraf_database': 500.,
+                  'gnirsarc2d.fitting.batch': 500.}
+
+
+def import_time(module: str, repeat: int = 5) -> tuple:
+    r"""Measure the import time of a module in a fresh interpreter.
+
+    Args:
+        module (str): name of the module to be imported
+        repeat (int): number of measurements, the fastest is returned
+
+    Returns:
+        time_ms, imported: cumulative import time in milliseconds and set of the top-level packages imported
+    """
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                                capture_output=True, text=True, check=True).stderr
+        imported, cumulative = set(), None
+        for line in output.splitlines():
+            match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)', line)
+            if match is None:
+                continue
+            imported.add(match.group(4).split('.')[0])
+            if match.group(4) == module:
+                cumulative = int(match.group(2))
+        times.append(cumulative / 1.e3)
+    return min(times), imported
+
+
+def main() -> int:
+    failures = 0
+    for module, budget in IMPORT_BUDGETS.items():
+        time_ms, imported = import_time(module)
+        heavy = sorted(set(HEAVY_MODULES) & imported)
+        status = 'OK' if (time_ms <= budget and not heavy) else 'FAIL'
+        failures += status == 'FAIL'
+        print('{:35s} {:8.1f} ms (budget {:6.1f} ms) heavy imports: {:20s} {}'.format(
+            module, time_ms, budget, ', '.join(heavy) or '-', status))
+    return failures
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,336 @@
+r"""Benchmark suite of parsing, fitting, and QA on synthetic GNIRS arc databases, in the `asv` format.
+
+Run with:
+
+>>> asv run --python=same
+>>> asv dev
+
+The `track_` benchmarks are also correctness checks: for instance, they report the RMS difference between the fitted
+and the injected wavelength solution over the whole detector, and fail if it exceeds the expected tolerance.
+"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from benchmarks import synthetic
+from gnirsarc2d.fitting import arc2d, batch, centroid, incremental, qa, stacked, uncertainty, wavelength_map
+from gnirsarc2d.gnirs_config import gnirs
+from gnirsarc2d.io import cache, read_iraf_database, summary
+
+CONFIGURATION_NAME = '32/mmSB'
+ROOT_FILENAME = 'idwarc_comb_SCI'
+# Largest accepted RMS difference between fitted and injected solution in Angstrom
+INJECTED_TOLERANCE = synthetic.LINE_NOISE
+
+
+class Parse:
+    r"""Parsing of the identify database of one arc"""
+    params = ([3, 30, 100], [20, 100])
+    param_names = ['columns_per_file', 'lines_per_order']
+
+    def setup(self, columns_per_file, lines_per_order):
+        self.database_directory = tempfile.mkdtemp()
+        synthetic.make_database(self.database_directory, ROOT_FILENAME, configuration_name=CONFIGURATION_NAME,
+                                columns_per_file=columns_per_file, lines_per_order=lines_per_order)
+        self.configuration = gnirs.GnirsConfiguration(name=CONFIGURATION_NAME)
+        self.path_to_file = os.path.join(self.database_directory, ROOT_FILENAME + '_1_')
+        self.cache = cache.IdentifyCache(os.path.join(self.database_directory, 'cache'))
+        read_iraf_database.get_features_from_database(self.database_directory, ROOT_FILENAME, self.configuration,
+                                                      cache=self.cache)
+
+    def teardown(self, columns_per_file, lines_per_order):
+        shutil.rmtree(self.database_directory)
+
+    def time_get_features_from_identify_table(self, columns_per_file, lines_per_order):
+        read_iraf_database.get_features_from_identify_table(self.path_to_file)
+
+    def time_get_all_features_from_identify_table(self, columns_per_file, lines_per_order):
+        read_iraf_database.get_all_features_from_identify_table(self.path_to_file)
+
+    def time_get_features_from_database(self, columns_per_file, lines_per_order):
+        read_iraf_database.get_features_from_database(self.database_directory, ROOT_FILENAME, self.configuration)
+
+    def time_get_features_from_database_cached(self, columns_per_file, lines_per_order):
+        read_iraf_database.get_features_from_database(self.database_directory, ROOT_FILENAME, self.configuration,
+                                                      cache=self.cache)
+
+    def peakmem_get_all_features_from_database(self, columns_per_file, lines_per_order):
+        read_iraf_database.get_all_features_from_database(self.database_directory, ROOT_FILENAME,
+                                                          self.configuration)
+
+    def track_lines_read(self, columns_per_file, lines_per_order):
+        pixel, _, wavelength, order = read_iraf_database.get_features_from_database(
+            self.database_directory, ROOT_FILENAME, self.configuration)
+        expected = synthetic.synthetic_lines(CONFIGURATION_NAME, lines_per_order=lines_per_order)
+        # pixels are 1-based in the IRAF files
+        assert np.allclose(pixel - 1., expected[0], atol=1.e-3)
+        assert np.allclose(wavelength, expected[1], atol=1.e-4)
+        assert np.array_equal(order, expected[2])
+        return len(pixel)
+
+
+class Fit:
+    r"""2D fit of the lines of one arc"""
+    params = ([20, 100, 500], arc2d.FIT_FUNCTIONS, arc2d.FITTERS)
+    param_names = ['lines_per_order', 'fit_function', 'fitter']
+
+    def setup(self, lines_per_order, fit_function, fitter):
+        self.tot_pixel = gnirs.GnirsConfiguration(name=CONFIGURATION_NAME).cols
+        self.pixel, self.wavelength, self.order, self.outliers = synthetic.synthetic_lines(
+            CONFIGURATION_NAME, lines_per_order=lines_per_order)
+
+    def _fit(self, fit_function, fitter):
+        return arc2d.full_fit(self.pixel, self.wavelength, self.order, tot_pixel=self.tot_pixel,
+                              fit_function=fit_function, fitter=fitter)
+
+    def time_full_fit(self, lines_per_order, fit_function, fitter):
+        self._fit(fit_function, fitter)
+
+    def peakmem_full_fit(self, lines_per_order, fit_function, fitter):
+        self._fit(fit_function, fitter)
+
+    def track_injected_solution_error(self, lines_per_order, fit_function, fitter):
+        fit2d, mask = self._fit(fit_function, fitter)
+        assert np.all(mask[self.outliers]), 'misidentified lines have not been rejected'
+        orders = np.unique(self.order)
+        fitted = wavelength_map.wavelength_map(fit2d, self.tot_pixel, orders)
+        injected = synthetic.injected_wavelength(np.arange(self.tot_pixel)[np.newaxis, :], orders[:, np.newaxis],
+                                                 self.tot_pixel)
+        error = float(np.sqrt(np.mean((fitted - injected) ** 2)))
+        assert error < INJECTED_TOLERANCE, 'fitted solution differs from the injected one by {} Ang'.format(error)
+        return error
+
+    track_injected_solution_error.unit = 'Angstrom'
+
+
+class Rejection:
+    r"""2D fit of the lines of one arc with different rejection strategies and fractions of misidentified lines"""
+    params = ([0.05, 0.2, 0.35], arc2d.REJECTIONS)
+    param_names = ['outlier_fraction', 'rejection']
+
+    def setup(self, outlier_fraction, rejection):
+        self.tot_pixel = gnirs.GnirsConfiguration(name=CONFIGURATION_NAME).cols
+        self.pixel, self.wavelength, self.order, self.outliers = synthetic.synthetic_lines(
+            CONFIGURATION_NAME, lines_per_order=100, outlier_fraction=outlier_fraction)
+
+    def _fit(self, rejection, fit_info=None):
+        return arc2d.full_fit(self.pixel, self.wavelength, self.order, tot_pixel=self.tot_pixel,
+                              rejection=rejection, fit_info=fit_info)
+
+    def time_full_fit(self, outlier_fraction, rejection):
+        self._fit(rejection)
+
+    def track_iterations(self, outlier_fraction, rejection):
+        fit_info = {}
+        _, mask = self._fit(rejection, fit_info=fit_info)
+        assert np.all(mask[self.outliers]), 'misidentified lines have not been rejected'
+        return fit_info['iterations']
+
+    track_iterations.unit = 'iterations'
+
+
+class Incremental:
+    r"""Refit of one arc after editing its lines, with the factor of the normal equations kept between refits"""
+    params = ([0.05, 0.2],)
+    param_names = ['outlier_fraction']
+
+    def setup(self, outlier_fraction):
+        self.tot_pixel = gnirs.GnirsConfiguration(name=CONFIGURATION_NAME).cols
+        self.pixel, self.wavelength, self.order, self.outliers = synthetic.synthetic_lines(
+            CONFIGURATION_NAME, lines_per_order=40, outlier_fraction=outlier_fraction)
+        self.fit = incremental.IncrementalFit(self.pixel, self.wavelength, self.order, self.tot_pixel)
+
+    def time_refit_after_edit(self, outlier_fraction):
+        self.fit.set_weights([0], [2.])
+        self.fit.refit()
+
+    def time_refit_from_scratch(self, outlier_fraction):
+        self.fit.refit(warm_start=False)
+
+    def track_full_solutions(self, outlier_fraction):
+        fit = incremental.IncrementalFit(self.pixel, self.wavelength, self.order, self.tot_pixel)
+        fit.remove_lines([3, 10, 50])
+        fit.add_lines(self.pixel[:5] + 0.3, self.wavelength[:5], self.order[:5], weights=np.full(5, 1.5))
+        fit.set_weights([1, 2], [3., 3.])
+        fit.refit(warm_start=False)
+        active = fit.active
+        design = fit._design_matrix[active]
+        coefficients, mask, _ = arc2d.sigma_clip_fit(design, fit._data[active], weights=fit._weights[active])
+        assert np.array_equal(fit.mask, mask), 'rejected lines differ from sigma_clip_fit'
+        assert np.allclose(fit.coefficients, coefficients, rtol=0., atol=1.e-8 * np.max(np.abs(coefficients)))
+        # at realistic fractions of rejected lines, the rejection passes must only update the factor
+        assert np.all(mask[np.isin(active, self.outliers)]), 'misidentified lines have not been rejected'
+        assert fit.n_least_squares == 0, 'the refit fell back to least squares'
+        return fit.n_factorizations
+
+    track_full_solutions.unit = 'factorizations'
+
+
+class Stacked:
+    r"""2D fit of a sequence of arcs with the same identified lines at different pixels, individually and stacked"""
+    params = ([2, 10, 50],)
+    param_names = ['n_arcs']
+
+    def setup(self, n_arcs):
+        self.tot_pixel = gnirs.GnirsConfiguration(name=CONFIGURATION_NAME).cols
+        pixel, wavelength, order, _ = synthetic.synthetic_lines(CONFIGURATION_NAME, lines_per_order=100,
+                                                                outlier_fraction=0.05)
+        rng = np.random.default_rng(0)
+        # same lines, shifted by the flexure of each arc and with different noise realizations of the centroids
+        self.line_lists = [(pixel + rng.uniform(-1., 1.) + rng.normal(scale=0.05, size=len(pixel)), wavelength,
+                            order) for _ in range(n_arcs)]
+
+    def time_full_fit(self, n_arcs):
+        for pixel, wavelength, order in self.line_lists:
+            arc2d.full_fit(pixel, wavelength, order, tot_pixel=self.tot_pixel)
+
+    def time_fit_stacked(self, n_arcs):
+        stacked.fit_stacked(self.line_lists, tot_pixel=self.tot_pixel)
+
+    def track_mismatched_arcs(self, n_arcs):
+        results = stacked.fit_stacked(self.line_lists, tot_pixel=self.tot_pixel)
+        n_mismatched = 0
+        for (pixel, wavelength, order), (fit2d, mask) in zip(self.line_lists, results):
+            fit2d_single, mask_single = arc2d.full_fit(pixel, wavelength, order, tot_pixel=self.tot_pixel)
+            if not np.array_equal(mask, mask_single):
+                n_mismatched += 1
+                continue
+            difference = np.max(np.abs(fit2d.parameters - fit2d_single.parameters))
+            assert difference <= 1.e-8 * np.max(np.abs(fit2d_single.parameters)), \
+                'stacked coefficients differ by {} from the individual fit'.format(difference)
+        assert n_mismatched == 0, '{} arcs have different masks in the stacked fit'.format(n_mismatched)
+        return n_mismatched
+
+    track_mismatched_arcs.unit = 'arcs'
+
+
+class Batch:
+    r"""Batch fit of several arcs, writing the solution and the summary of each arc"""
+    params = ([4],)
+    param_names = ['n_arcs']
+
+    def setup(self, n_arcs):
+        self.database_directory = tempfile.mkdtemp()
+        self.root_filenames = ['{}{}'.format(ROOT_FILENAME, index) for index in range(n_arcs)]
+        for index, root_filename in enumerate(self.root_filenames):
+            synthetic.make_database(self.database_directory, root_filename, configuration_name=CONFIGURATION_NAME,
+                                    seed=index)
+
+    def teardown(self, n_arcs):
+        shutil.rmtree(self.database_directory)
+
+    def _fit_arcs(self, output_directory):
+        return batch.fit_arcs(self.database_directory, root_filenames=self.root_filenames,
+                              configuration=CONFIGURATION_NAME, processes=1, output_directory=output_directory,
+                              summary_table=os.path.join(output_directory, 'tables', summary.DEFAULT_TABLE_NAME))
+
+    def time_fit_arcs(self, n_arcs):
+        self._fit_arcs(tempfile.mkdtemp(dir=self.database_directory))
+
+    def track_output_errors(self, n_arcs):
+        output_directory = tempfile.mkdtemp(dir=self.database_directory)
+        # the solution of the second arc cannot be written: the other arcs must be written anyway
+        os.makedirs(os.path.join(output_directory, self.root_filenames[1] + '.fits'))
+        results = self._fit_arcs(output_directory)
+        failed = [result.root_filename for result in results if result.output_error is not None]
+        assert failed == [self.root_filenames[1]], 'unexpected output errors: {}'.format(failed)
+        for result in results:
+            assert result.success, 'fit of {} failed: {}'.format(result.root_filename, result.error)
+            if result.output_error is None:
+                assert os.path.exists(os.path.join(output_directory, result.root_filename + '_summary.json'))
+        return len(failed)
+
+    track_output_errors.unit = 'arcs'
+
+
+class Uncertainty:
+    r"""Covariance of the coefficients and wavelength uncertainty map of a fitted arc"""
+    params = (uncertainty.UNCERTAINTY_METHODS,)
+    param_names = ['method']
+
+    def setup(self, method):
+        self.tot_pixel = gnirs.GnirsConfiguration(name=CONFIGURATION_NAME).cols
+        self.pixel, self.wavelength, self.order, _ = synthetic.synthetic_lines(CONFIGURATION_NAME,
+                                                                               lines_per_order=100)
+        self.fit2d, self.mask = arc2d.full_fit(self.pixel, self.wavelength, self.order, tot_pixel=self.tot_pixel)
+        self.orders = np.unique(self.order)
+
+    def _uncertainty(self, method):
+        return uncertainty.solution_uncertainty(self.fit2d, self.mask, self.pixel, self.wavelength, self.order,
+                                                self.tot_pixel, method=method)
+
+    def time_solution_uncertainty(self, method):
+        self._uncertainty(method)
+
+    def time_wavelength_uncertainty(self, method):
+        self._uncertainty(method).wavelength_uncertainty(self.fit2d, self.tot_pixel, self.orders)
+
+    def track_median_wavelength_uncertainty(self, method):
+        return float(np.median(self._uncertainty(method).wavelength_uncertainty(self.fit2d, self.tot_pixel,
+                                                                                 self.orders)))
+
+    track_median_wavelength_uncertainty.unit = 'Angstrom'
+
+
+class Centroid:
+    r"""Refinement of the line positions on synthetic spectra, starting from positions off by up to 1.5 pixels"""
+    params = ([20, 40], centroid.CENTROID_METHODS)
+    param_names = ['lines_per_order', 'method']
+
+    def setup(self, lines_per_order, method):
+        configuration = gnirs.GnirsConfiguration(name=CONFIGURATION_NAME)
+        self.pixel, _, self.order, _ = synthetic.synthetic_lines(CONFIGURATION_NAME, lines_per_order=lines_per_order,
+                                                                 outlier_fraction=0.)
+        self.orders = np.array(configuration.order['number'])
+        self.spectra = synthetic.synthetic_spectra(self.pixel, self.order, self.orders, configuration.cols)
+        rng = np.random.default_rng(0)
+        self.approximate_pixel = self.pixel + centroid.IRAF_FIRST_PIXEL + rng.uniform(-1.5, 1.5, len(self.pixel))
+
+    def _refine(self, method):
+        return centroid.refine_centroids(self.spectra, self.orders, self.approximate_pixel, self.order,
+                                         method=method)
+
+    def time_refine_centroids(self, lines_per_order, method):
+        self._refine(method)
+
+    def track_median_centroid_error(self, lines_per_order, method):
+        result = self._refine(method)
+        error = result.pixel[result.valid] - (self.pixel[result.valid] + centroid.IRAF_FIRST_PIXEL)
+        # the few blended lines do not affect the median error
+        return float(np.median(np.abs(error)))
+
+    track_median_centroid_error.unit = 'pixel'
+
+
+class QA:
+    r"""Residual statistics and wavelength map of a fitted arc"""
+    params = ([20, 100, 500], [np.float64, np.float32])
+    param_names = ['lines_per_order', 'dtype']
+
+    def setup(self, lines_per_order, dtype):
+        self.tot_pixel = gnirs.GnirsConfiguration(name=CONFIGURATION_NAME).cols
+        self.pixel, self.wavelength, self.order, _ = synthetic.synthetic_lines(CONFIGURATION_NAME,
+                                                                               lines_per_order=lines_per_order)
+        self.fit2d, self.mask = arc2d.full_fit(self.pixel, self.wavelength, self.order, tot_pixel=self.tot_pixel)
+        self.orders = np.unique(self.order)
+
+    def time_residual_statistics(self, lines_per_order, dtype):
+        qa.residual_statistics(self.fit2d, self.mask, self.pixel, self.wavelength, self.order, self.tot_pixel)
+
+    def time_wavelength_map(self, lines_per_order, dtype):
+        wavelength_map.wavelength_map(self.fit2d, self.tot_pixel, self.orders, dtype=dtype)
+
+    def peakmem_wavelength_map(self, lines_per_order, dtype):
+        wavelength_map.wavelength_map(self.fit2d, self.tot_pixel, self.orders, dtype=dtype)
+
+    def track_rms_global(self, lines_per_order, dtype):
+        statistics = qa.residual_statistics(self.fit2d, self.mask, self.pixel, self.wavelength, self.order,
+                                            self.tot_pixel)
+        # the RMS of the lines used in the fit should be close to the injected scatter
+        assert abs(statistics.rms_global - synthetic.LINE_NOISE) < 0.5 * synthetic.LINE_NOISE
+        return statistics.rms_global
+
+    track_rms_global.unit = 'Angstrom'
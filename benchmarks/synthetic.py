@@ -0,0 +1,183 @@
+r"""Synthetic GNIRS arc line lists and IRAF identify databases with a known (injected) wavelength solution.
+"""
+
+import os
+
+import numpy as np
+
+from gnirsarc2d.gnirs_config import gnirs
+
+# Injected grating equation: order * wavelength [micron] as a polynomial of the normalized pixel and of the order.
+# It is exactly representable by a 2D fit with fit_order_spec >= 2 and fit_order_order >= 1.
+INJECTED_ORDER_WAVELENGTH = {'constant': 5.61, 'linear': 1.98, 'quadratic': 0.05, 'cross': 0.01, 'order_zero': 5.}
+# Scatter of the identified lines around the injected solution in Angstrom
+LINE_NOISE = 0.1
+
+
+def injected_wavelength(pixel: np.array, order: np.array, tot_pixel: int) -> np.array:
+    r"""Wavelength in Angstrom of the injected solution.
+
+    Args:
+        pixel (array): pixel positions
+        order (array): order numbers
+        tot_pixel (int): size of the image in the spectral direction
+
+    Returns:
+        array: wavelengths in Angstrom
+    """
+    norm_pixel = pixel / (tot_pixel - 1.)
+    coefficients = INJECTED_ORDER_WAVELENGTH
+    return 1.e4 * (coefficients['constant'] + coefficients['linear'] * norm_pixel +
+                   coefficients['quadratic'] * norm_pixel ** 2 +
+                   coefficients['cross'] * (order - coefficients['order_zero']) * norm_pixel) / order
+
+
+def synthetic_lines(configuration_name: str = '32/mmSB', lines_per_order: int = 40, outlier_fraction: float = 0.05,
+                    noise: float = LINE_NOISE, seed: int = 42) -> tuple:
+    r"""Generate a synthetic list of identified arc lines following the injected solution.
+
+    Args:
+        configuration_name (str): GNIRS configuration
+        lines_per_order (int): number of lines identified in each order
+        outlier_fraction (float): fraction of misidentified lines
+        noise (float): scatter of the lines around the injected solution in Angstrom
+        seed (int): seed of the random number generator
+
+    Returns:
+        pixel, wavelength, order, outliers: arrays describing the identified lines (wavelengths in Angstrom) and
+        indices of the misidentified lines
+    """
+    rng = np.random.default_rng(seed)
+    configuration = gnirs.GnirsConfiguration(name=configuration_name)
+    pixel, order = [], []
+    for number in configuration.order['number']:
+        pixel.append(np.sort(rng.uniform(5., configuration.cols - 5., lines_per_order)))
+        order.append(np.full(lines_per_order, number))
+    pixel, order = np.concatenate(pixel), np.concatenate(order)
+    wavelength = injected_wavelength(pixel, order, configuration.cols) + rng.normal(0., noise, len(pixel))
+    n_outliers = int(outlier_fraction * len(pixel))
+    outliers = rng.choice(len(pixel), n_outliers, replace=False)
+    wavelength[outliers] += rng.choice([-1., 1.], n_outliers) * rng.uniform(20., 200., n_outliers)
+    return pixel, wavelength, order, outliers
+
+
+def write_identify_file(path_to_file: str, columns: list, pixel: np.array, wavelength: np.array,
+                        fwhm: float = 4.0, seed: int = 0):
+    r"""Write an IRAF identify database file with one block per column.
+
+    Pixels are written 1-based, as IRAF does. All the columns contain the same lines, with slightly different
+    measured wavelengths.
+
+    Args:
+        path_to_file (str): name of the file
+        columns (list): columns where `identify`/`reidentify` ran
+        pixel (array): 0-based pixel position of the lines
+        wavelength (array): archive wavelength of the lines in Angstrom
+        fwhm (float): FWHM of the lines in pixels
+        seed (int): seed of the random number generator
+    """
+    rng = np.random.default_rng(seed)
+    blocks = []
+    for column in columns:
+        measured = wavelength + rng.normal(0., 0.01, len(wavelength))
+        features = '\n'.join('\t   {:9.3f} {:10.4f} {:10.4f} {:5.2f} 1 1'.format(p, m, w, fwhm)
+                             for p, m, w in zip(pixel + 1., measured, wavelength))
+        blocks.append('# Mon 15:46:16 18-Jan-2021\n'
+                      'begin\tidentify warc_comb_SCI[SCI,1][{0},*]\n'
+                      '\tid\twarc_comb_SCI[SCI,1][{0},*]\n'
+                      '\ttask\tidentify\n'
+                      '\timage\twarc_comb_SCI[SCI,1][{0},*]\n'
+                      '\tunits\tangstroms\n'
+                      '\tfeatures\t{1}\n'
+                      '{2}\n'
+                      '\tfunction chebyshev\n'
+                      '\torder 4\n'
+                      '\tsample *\n'
+                      '\tnaverage 1\n'
+                      '\tniterate 0\n'
+                      '\tlow_reject 3.\n'
+                      '\thigh_reject 3.\n'
+                      '\tgrow 0.\n'
+                      '\n'.format(column, len(pixel), features))
+    with open(path_to_file, 'w') as f:
+        f.write(''.join(blocks))
+
+
+def make_database(database_directory: str, root_filename: str = 'idwarc_comb_SCI',
+                  configuration_name: str = '32/mmSB', n_slits: int = None, columns_per_file: int = 3,
+                  lines_per_order: int = 40, outlier_fraction: float = 0.05, seed: int = 42) -> tuple:
+    r"""Write the identify database files `root_filename_SLIT_` of a synthetic arc.
+
+    Args:
+        database_directory (str): directory where the files are written
+        root_filename (str): root filename of the arc
+        configuration_name (str): GNIRS configuration
+        n_slits (int): number of slits (i.e. of files) to be written. By default, all the slits of the configuration
+        columns_per_file (int): number of identify blocks in each file
+        lines_per_order (int): number of lines identified in each order
+        outlier_fraction (float): fraction of misidentified lines
+        seed (int): seed of the random number generator
+
+    Returns:
+        pixel, wavelength, order, outliers: lines written in each column (see :func:`synthetic_lines`)
+    """
+    configuration = gnirs.GnirsConfiguration(name=configuration_name)
+    pixel, wavelength, order, outliers = synthetic_lines(configuration_name, lines_per_order=lines_per_order,
+                                                         outlier_fraction=outlier_fraction, seed=seed)
+    os.makedirs(database_directory, exist_ok=True)
+    columns = list(np.linspace(100, configuration.rows - 100, columns_per_file).astype(int))
+    slits = configuration.order['slit'] if n_slits is None else configuration.order['slit'][:n_slits]
+    for slit, number in zip(slits, configuration.order['number']):
+        on_order = order == number
+        write_identify_file(os.path.join(database_directory, '{}_{}_'.format(root_filename, slit)), columns,
+                            pixel[on_order], wavelength[on_order], seed=seed + slit)
+    return pixel, wavelength, order, outliers
+
+
+def synthetic_spectra(pixel: np.array, order: np.array, orders: list, tot_pixel: int, fwhm: float = 3.,
+                      background: float = 50., seed: int = 0) -> np.array:
+    r"""Spectra of the orders with a gaussian line at each position and Poisson noise.
+
+    Args:
+        pixel (array): 0-based pixel position of the lines
+        order (array): order number of the lines
+        orders (list): order numbers, one spectrum for each of them
+        tot_pixel (int): size of the spectra
+        fwhm (float): FWHM of the lines in pixels
+        background (float): constant background level in counts
+        seed (int): seed of the random number generator
+
+    Returns:
+        array: spectra with shape (len(orders), tot_pixel)
+    """
+    rng = np.random.default_rng(seed)
+    sigma = fwhm / (2. * np.sqrt(2. * np.log(2.)))
+    spectra = np.full((len(orders), tot_pixel), background)
+    x = np.arange(tot_pixel)
+    for row, number in enumerate(orders):
+        on_order = order == number
+        amplitude = rng.uniform(200., 2000., on_order.sum())
+        spectra[row] += (amplitude[:, np.newaxis] *
+                         np.exp(-0.5 * ((x - pixel[on_order][:, np.newaxis]) / sigma) ** 2)).sum(axis=0)
+    return rng.poisson(spectra).astype(float)
+
+
+def write_rectified_arc(filename: str, pixel: np.array, order: np.array, configuration_name: str = '32/mmSB',
+                        n_spatial: int = 20, seed: int = 0):
+    r"""Write a rectified arc with one `SCI` extension per slit, the dispersion being along the `y` axis.
+
+    Args:
+        filename (str): name of the file
+        pixel (array): 0-based pixel position of the lines
+        order (array): order number of the lines
+        configuration_name (str): GNIRS configuration
+        n_spatial (int): size of the images along the spatial direction
+        seed (int): seed of the random number generator
+    """
+    from astropy.io import fits
+    configuration = gnirs.GnirsConfiguration(name=configuration_name)
+    hdus = [fits.PrimaryHDU()]
+    for slit, number in zip(configuration.order['slit'], configuration.order['number']):
+        spectrum = synthetic_spectra(pixel, order, [number], configuration.cols, seed=seed + slit)[0]
+        hdus.append(fits.ImageHDU(np.repeat(spectrum[:, np.newaxis], n_spatial, axis=1), name='SCI', ver=slit))
+    fits.HDUList(hdus).writeto(filename, overwrite=True)
@@ -2,21 +2,438 @@
 """
 
 import numpy as np
-from matplotlib import gridspec
-from matplotlib import pyplot as plt
 
-from astropy.modeling import models, fitting
-from astropy.stats import sigma_clip
+from gnirsarc2d import profiling
+
+# astropy.modeling and matplotlib are imported only by the functions that need them, to keep the import of this
+# module (and the startup of the scripts) fast
 
 # from IPython import embed
 
 FIT_FUNCTIONS = ['legendre2d', 'chebyshev2d']
+FITTERS = ['native', 'astropy']
+REJECTIONS = ['sigma_clip', 'mad_clip', 'huber', 'tukey', 'lmeds']
+# Initial solutions of the `huber` and `tukey` rejections
+ROBUST_STARTS = ['mad_clip', 'lmeds']
+
+# Scale factor between the median absolute deviation and the standard deviation of a normal distribution
+MAD_TO_STD = 1.4826
+# Tuning constants of the IRLS weights, in units of the robust standard deviation (95% efficiency for normal data)
+HUBER_TUNING = 1.345
+TUKEY_TUNING = 4.685
+
+# Window in which the orthogonal polynomials are evaluated (same default used by astropy)
+POLYNOMIAL_WINDOW = (-1., 1.)
+
+
+def _map_domain(values: np.array, domain: tuple, window: tuple = POLYNOMIAL_WINDOW) -> np.array:
+    r"""Linearly map `values` from `domain` to `window`, following `astropy.modeling.utils.poly_map_domain`.
+    """
+    scale = (window[1] - window[0]) / (domain[1] - domain[0])
+    offset = (window[0] * domain[1] - window[1] * domain[0]) / (domain[1] - domain[0])
+    return offset + scale * values
+
+
+def _vander_1d(values: np.array, degree: int, fit_function: str = 'legendre2d') -> np.array:
+    r"""1D pseudo-Vandermonde matrix of shape (len(values), degree + 1) for the selected polynomial family.
+    """
+    if fit_function == 'legendre2d':
+        return np.polynomial.legendre.legvander(values, degree)
+    elif fit_function == 'chebyshev2d':
+        return np.polynomial.chebyshev.chebvander(values, degree)
+    else:
+        raise ValueError(r"fitting function not defined. Current possibilities are: {}".format(FIT_FUNCTIONS))
+
+
+def design_matrix(norm_pixel: np.array, all_orders: np.array, fit_order_spec: int, fit_order_order: int,
+                  order_domain: tuple, fit_function: str = 'legendre2d') -> np.array:
+    r"""Build the 2D pseudo-Vandermonde matrix of the wavelength solution.
+
+    The columns follow the parameter ordering of `astropy.modeling.models.Legendre2D` (and `Chebyshev2D`), i.e.
+    `c0_0, c1_0, ..., cN_0, c0_1, ...`, with the spectral index running fastest. This means that the coefficients
+    obtained from a least-squares solution can be directly assigned to the `parameters` of the astropy model.
+
+    Args:
+        norm_pixel (array): pixel positions normalized to the range [0, 1]
+        all_orders (array): order number of each point
+        fit_order_spec (int): order of the fitting along the spectral (pixel) direction
+        fit_order_order (int): order of the fitting in the order direction
+        order_domain (tuple): (min, max) order numbers used to normalize `all_orders`
+        fit_function (str): 2D function to be used
+
+    Returns:
+        array: design matrix of shape (len(norm_pixel), (fit_order_spec + 1) * (fit_order_order + 1))
+    """
+    vander_spec = _vander_1d(_map_domain(np.asarray(norm_pixel, dtype=float), (0., 1.)), fit_order_spec,
+                             fit_function=fit_function)
+    vander_order = _vander_1d(_map_domain(np.asarray(all_orders, dtype=float), order_domain), fit_order_order,
+                              fit_function=fit_function)
+    return _combine_vander(vander_spec, vander_order)
+
+
+def _combine_vander(vander_spec: np.array, vander_order: np.array) -> np.array:
+    r"""Row-wise outer product of the 1D basis, with the spectral index running fastest.
+    """
+    return (vander_order[:, :, np.newaxis] * vander_spec[:, np.newaxis, :]).reshape(len(vander_spec), -1)
+
+
+def _init_model(fit_function: str, fit_order_spec: int, fit_order_order: int, order_domain: tuple) -> object:
+    r"""Create the (not yet fitted) astropy 2D model used to store the wavelength solution.
+    """
+    from astropy.modeling import models
+    if fit_function == 'legendre2d':
+        return models.Legendre2D(x_degree=fit_order_spec, y_degree=fit_order_order,
+                                 x_domain=(0., 1.), y_domain=order_domain)
+    elif fit_function == 'chebyshev2d':
+        return models.Chebyshev2D(x_degree=fit_order_spec, y_degree=fit_order_order,
+                                  x_domain=(0., 1.), y_domain=order_domain)
+    else:
+        raise ValueError(r"fitting function not defined. Current possibilities are: {}".format(FIT_FUNCTIONS))
+
+
+def _sigma_clip_mask(residuals: np.array, mask: np.array, sigma: float = 3.0, maxiters: int = 5) -> np.array:
+    r"""Update `mask` with the points rejected by a median-centered, iterative sigma clipping of `residuals`.
+
+    This reproduces the default behaviour of `astropy.stats.sigma_clip` (cenfunc='median', stdfunc='std',
+    maxiters=5). Already masked points are kept masked.
+    """
+    kept = residuals[~mask]
+    min_value, max_value = -np.inf, np.inf
+    for _ in range(maxiters):
+        if kept.size == 0:
+            break
+        center, std = np.median(kept), np.std(kept)
+        min_value, max_value = center - sigma * std, center + sigma * std
+        new_kept = kept[(kept >= min_value) & (kept <= max_value)]
+        if new_kept.size == kept.size:
+            break
+        kept = new_kept
+    return mask | (residuals < min_value) | (residuals > max_value)
+
+
+def _least_squares(design: np.array, data: np.array, weights: np.array = None) -> np.array:
+    r"""Column-scaled (weighted) linear least-squares solution of `design @ coefficients = data`.
+
+    `data` can have shape (n_points, n_sets), to solve several sets of data with a single factorization.
+    """
+    if weights is not None:
+        design = design * weights[:, np.newaxis]
+        data = data * (weights if data.ndim == 1 else weights[:, np.newaxis])
+    scale = np.sqrt((design * design).sum(axis=0))
+    scale[scale == 0.] = 1.
+    coefficients = np.linalg.lstsq(design / scale, data, rcond=None)[0]
+    return coefficients / (scale if data.ndim == 1 else scale[:, np.newaxis])
+
+
+def sigma_clip_fit(design: np.array, data: np.array, sigma: float = 3.0, niter: int = 100,
+                   mask: np.array = None, weights: np.array = None) -> tuple:
+    r"""Linear least-squares fit with iterative sigma-clipping rejection on a fixed design matrix.
+
+    The design matrix is built only once. At each iteration the rejected rows are simply excluded from the solution
+    and the loop stops as soon as the rejection mask stops changing. The rejection is cumulative, as in
+    `astropy.modeling.fitting.FittingWithOutlierRemoval`.
+
+    Args:
+        design (array): design matrix of shape (n_points, n_coefficients)
+        data (array): values to be fitted
+        sigma (float): sigma level for the rejection algorithm
+        niter (int): maximum number of iterations for the rejection algorithm
+        mask (array): initial mask of the rejected points (True = rejected)
+        weights (array): weights of the points
+
+    Returns:
+        coefficients, mask, iterations: coefficients of the fit, mask of the rejected points, and number of
+        rejection iterations performed.
+    """
+    if mask is None:
+        mask = np.zeros(len(data), dtype=bool)
+    else:
+        mask = np.array(mask, dtype=bool)
+    good = ~mask
+    coefficients = _least_squares(design[good], data[good], None if weights is None else weights[good])
+    iterations = 0
+    for _ in range(niter):
+        iterations += 1
+        new_mask = _sigma_clip_mask(design @ coefficients - data, mask, sigma=sigma)
+        good = ~new_mask
+        coefficients = _least_squares(design[good], data[good], None if weights is None else weights[good])
+        if new_mask.sum() == mask.sum():
+            mask = new_mask
+            break
+        mask = new_mask
+    return coefficients, mask, iterations
+
+
+def _robust_scale(residuals: np.array) -> tuple:
+    r"""Median and MAD-based standard deviation of `residuals`"""
+    center = np.median(residuals)
+    return center, MAD_TO_STD * np.median(np.abs(residuals - center))
+
+
+def mad_clip_fit(design: np.array, data: np.array, sigma: float = 3.0, niter: int = 100, tol: float = 1.e-3,
+                 mask: np.array = None, weights: np.array = None, coefficients: np.array = None) -> tuple:
+    r"""Linear least-squares fit with rejection based on the median absolute deviation (MAD) of the residuals.
+
+    Differently from :func:`sigma_clip_fit`, the rejection is not cumulative: at each iteration all the points are
+    tested against the current solution, so that lines wrongly rejected at the beginning can be recovered. The
+    scale of the residuals is the MAD of all the points, that is not inflated by up to 50% of outliers, and it does
+    not shrink as the rejected points are excluded. The loop stops when the mask stops changing, or when the fitted
+    values change by less than `tol` times the scale of the residuals.
+
+    Args:
+        design (array): design matrix of shape (n_points, n_coefficients)
+        data (array): values to be fitted
+        sigma (float): rejection threshold in units of the MAD-based standard deviation
+        niter (int): maximum number of iterations
+        tol (float): convergence tolerance on the fitted values, in units of the scale of the residuals
+        mask (array): points that are always rejected (True = rejected)
+        weights (array): weights of the points
+        coefficients (array): initial solution. By default, the least-squares solution of the non-masked points
+
+    Returns:
+        coefficients, mask, iterations: coefficients of the fit, mask of the rejected points, and number of
+        rejection iterations performed.
+    """
+    fixed_mask = np.zeros(len(data), dtype=bool) if mask is None else np.array(mask, dtype=bool)
+    mask = fixed_mask
+    if coefficients is None:
+        good = ~mask
+        coefficients = _least_squares(design[good], data[good], None if weights is None else weights[good])
+    model = design @ coefficients
+    iterations = 0
+    for _ in range(niter):
+        iterations += 1
+        residuals = model - data
+        center, scale = _robust_scale(residuals[~fixed_mask])
+        new_mask = fixed_mask | (np.abs(residuals - center) > sigma * scale)
+        good = ~new_mask
+        coefficients = _least_squares(design[good], data[good], None if weights is None else weights[good])
+        new_model = design @ coefficients
+        converged = np.array_equal(new_mask, mask) or np.max(np.abs(new_model - model)) <= tol * scale
+        mask, model = new_mask, new_model
+        if converged:
+            break
+    return coefficients, mask, iterations
+
+
+def irls_fit(design: np.array, data: np.array, weight_function: str = 'huber', sigma: float = 3.0,
+             niter: int = 100, tol: float = 1.e-3, tuning: float = None, mask: np.array = None,
+             weights: np.array = None, coefficients: np.array = None, scale: float = None) -> tuple:
+    r"""Robust linear fit with iteratively reweighted least squares (IRLS).
+
+    The residuals are standardized with the scale `s` and every point gets a weight that decreases with its residual
+    `u = r / s`:
+
+    - `huber`: 1 for `|u| <= k`, `k / |u|` otherwise (convex, it converges from any starting point)
+    - `tukey`: `(1 - (u / c)^2)^2` for `|u| < c`, 0 otherwise (redescending, gross outliers get zero weight, so
+      it should start from a robust solution, see :func:`mad_clip_fit` and :func:`least_median_fit`)
+
+    If `scale` is not provided, `s` is the MAD-based standard deviation of the residuals, re-estimated at each
+    iteration. Starting from the :func:`mad_clip_fit` solution, holding `s` fixed at its MAD-based scale avoids
+    the slow drift of the re-estimated scale. The loop stops when the weighted residual norm `sum(w * u^2)`
+    changes by less than a fraction `tol` of its value. The points whose final residual is larger than `sigma`
+    times the MAD-based standard deviation of the final residuals are flagged in the output mask.
+
+    Args:
+        design (array): design matrix of shape (n_points, n_coefficients)
+        data (array): values to be fitted
+        weight_function (str): `huber` or `tukey`
+        sigma (float): threshold used to flag the rejected points, in units of the MAD-based standard deviation
+        niter (int): maximum number of iterations
+        tol (float): relative convergence tolerance on the weighted residual norm
+        tuning (float): tuning constant of the weights. By default `HUBER_TUNING` or `TUKEY_TUNING`
+        mask (array): points that are always rejected (True = rejected)
+        weights (array): weights of the points
+        coefficients (array): initial solution. By default, the least-squares solution of the non-masked points
+        scale (float): standard deviation of the residuals, held fixed. By default, it is re-estimated at each
+            iteration
+
+    Returns:
+        coefficients, mask, iterations: coefficients of the fit, mask of the rejected points, and number of
+        reweighting iterations performed.
+    """
+    if weight_function == 'huber':
+        tuning = HUBER_TUNING if tuning is None else tuning
+    elif weight_function == 'tukey':
+        tuning = TUKEY_TUNING if tuning is None else tuning
+    else:
+        raise ValueError(r"weight function not defined. Current possibilities are: {}".format(['huber', 'tukey']))
+    mask = np.zeros(len(data), dtype=bool) if mask is None else np.array(mask, dtype=bool)
+    good = ~mask
+    design, data = design[good], data[good]
+    weights = np.ones(len(data)) if weights is None else weights[good]
+    if coefficients is None:
+        coefficients = _least_squares(design, data, weights)
+    model = design @ coefficients
+    fixed_scale = scale
+    iterations = 0
+    norm = None
+    for _ in range(niter):
+        scale = fixed_scale if fixed_scale is not None else _robust_scale(model - data)[1]
+        if scale == 0.:
+            break
+        iterations += 1
+        u = np.abs(model - data) / (tuning * scale)
+        if weight_function == 'huber':
+            robust_weights = 1. / np.maximum(u, 1.)
+        else:
+            robust_weights = np.where(u < 1., (1. - u * u) ** 2, 0.)
+        # `_least_squares` multiplies the rows by the weights: pass the square root of the IRLS weights
+        coefficients = _least_squares(design, data, weights * np.sqrt(robust_weights))
+        model = design @ coefficients
+        new_norm = np.sum(robust_weights * ((model - data) / scale) ** 2)
+        converged = norm is not None and abs(new_norm - norm) <= tol * new_norm
+        norm = new_norm
+        if converged:
+            break
+    residuals = model - data
+    _, scale = _robust_scale(residuals)
+    mask[good] = np.abs(residuals) > sigma * scale
+    return coefficients, mask, iterations
+
+
+def least_median_fit(design: np.array, data: np.array, sigma: float = 3.0, niter: int = 100, tol: float = 1.e-3,
+                     n_trials: int = 500, subset_size: int = None, seed: int = 0, groups: np.array = None,
+                     mask: np.array = None, weights: np.array = None, chunk_size: int = 100,
+                     refine: bool = True) -> tuple:
+    r"""Least median of squares (LMedS) fit, optionally refined with :func:`mad_clip_fit`.
+
+    Random subsets of the lines are drawn as in RANSAC, and each of them is solved in the least-squares sense. The
+    candidate solution with the smallest median squared residual is kept. All the candidates of a chunk are solved
+    at once with a stacked pseudo-inverse and scored with a single matrix product. The solution is insensitive to
+    up to ~50% of misidentified lines, so the refinement that follows converges in a few iterations.
+
+    The cost is dominated by the `n_trials` pseudo-inverses and does not depend on the actual fraction of
+    misidentified lines: with the default 500 trials, 20 coefficients, and ~1000 lines it is ~50-60 ms, more than ten
+    times the cost of :func:`mad_clip_fit`, which is usually enough for up to ~35% of misidentified lines.
+
+    If `groups` is provided (e.g. the order numbers), the score of a candidate is the largest median squared
+    residual among the groups. Otherwise, a solution that ignores a whole order (that contains less than 50% of the
+    lines) could have the smallest median.
+
+    Args:
+        design (array): design matrix of shape (n_points, n_coefficients)
+        data (array): values to be fitted
+        sigma (float): rejection threshold in units of the robust standard deviation
+        niter (int): maximum number of iterations of the refinement
+        tol (float): convergence tolerance of the refinement (see :func:`mad_clip_fit`)
+        n_trials (int): number of random subsets
+        subset_size (int): number of lines in each subset. By default, 1.5 times the number of coefficients
+        seed (int): seed of the random number generator
+        groups (array): group of each point, the median squared residual is computed separately for each group
+        mask (array): points that are always rejected (True = rejected)
+        weights (array): weights of the points, used in the final least-squares solutions
+        chunk_size (int): number of subsets solved at once, it limits the memory to
+            `n_points * chunk_size` residuals
+        refine (bool): refine the solution with :func:`mad_clip_fit`
+
+    Returns:
+        coefficients, mask, iterations: coefficients of the fit, mask of the rejected points, and number of
+        iterations performed (1 for the LMedS step plus the iterations of the refinement).
+    """
+    fixed_mask = np.zeros(len(data), dtype=bool) if mask is None else np.array(mask, dtype=bool)
+    good_index = np.flatnonzero(~fixed_mask)
+    n_good, n_coefficients = len(good_index), design.shape[1]
+    if subset_size is None:
+        subset_size = 3 * n_coefficients // 2
+    if n_good <= subset_size:
+        coefficients = _least_squares(design[good_index], data[good_index],
+                                      None if weights is None else weights[good_index])
+        return coefficients, fixed_mask, 1
+    good_design, good_data = design[good_index], data[good_index]
+    group_selections = [None] if groups is None else [np.asarray(groups)[good_index] == group
+                                                      for group in np.unique(np.asarray(groups)[good_index])]
+    rng = np.random.default_rng(seed)
+    best_coefficients, best_median = None, np.inf
+    for start in range(0, n_trials, chunk_size):
+        n_chunk = min(chunk_size, n_trials - start)
+        # random subsets without repetitions, one per row
+        subsets = np.argsort(rng.random((n_chunk, n_good)), axis=1)[:, :subset_size]
+        candidates = np.einsum('tij,tj->ti', np.linalg.pinv(good_design[subsets]), good_data[subsets])
+        squared_residuals = (good_design @ candidates.T - good_data[:, np.newaxis]) ** 2
+        medians = np.max([np.median(squared_residuals if selection is None else squared_residuals[selection],
+                                    axis=0) for selection in group_selections], axis=0)
+        best = np.argmin(medians)
+        if medians[best] < best_median:
+            best_coefficients, best_median = candidates[best], medians[best]
+    # robust standard deviation of the LMedS solution, with the finite sample correction of Rousseeuw & Leroy
+    scale = MAD_TO_STD * (1. + 5. / max(n_good - n_coefficients, 1)) * np.sqrt(best_median)
+    mask = fixed_mask | (np.abs(design @ best_coefficients - data) > sigma * scale)
+    good = ~mask
+    coefficients = _least_squares(design[good], data[good], None if weights is None else weights[good])
+    if not refine:
+        return coefficients, mask, 1
+    coefficients, mask, iterations = mad_clip_fit(design, data, sigma=sigma, niter=niter, tol=tol,
+                                                  mask=fixed_mask, weights=weights, coefficients=coefficients)
+    return coefficients, mask, iterations + 1
+
+
+def robust_fit(design: np.array, data: np.array, rejection: str = 'sigma_clip', sigma: float = 3.0,
+               niter: int = 100, tol: float = 1.e-3, mask: np.array = None, weights: np.array = None,
+               seed: int = 0, groups: np.array = None, start: str = 'mad_clip') -> tuple:
+    r"""Fit `data` on the design matrix with one of the rejection strategies in `REJECTIONS`.
+
+    - `sigma_clip`: cumulative iterative sigma clipping, see :func:`sigma_clip_fit`
+    - `mad_clip`: non-cumulative clipping based on the MAD, see :func:`mad_clip_fit`
+    - `huber`: IRLS with Huber weights starting from the `start` solution, see :func:`irls_fit`
+    - `tukey`: IRLS with Tukey biweights starting from the `start` solution, see :func:`irls_fit`
+    - `lmeds`: least median of squares refined with the MAD clipping, see :func:`least_median_fit`
+
+    The LMedS start of `huber` and `tukey` is more robust than the MAD clipping for large fractions of misidentified
+    lines, but it costs more than ten times as much (see :func:`least_median_fit`).
+
+    Args:
+        design (array): design matrix of shape (n_points, n_coefficients)
+        data (array): values to be fitted
+        rejection (str): rejection strategy
+        sigma (float): sigma level for the rejection algorithm
+        niter (int): maximum number of iterations
+        tol (float): convergence tolerance (not used by `sigma_clip`)
+        mask (array): initial mask of the rejected points (True = rejected)
+        weights (array): weights of the points
+        seed (int): seed of the random subsets of the LMedS solution
+        groups (array): groups of points scored separately by the LMedS solution (see :func:`least_median_fit`)
+        start (str): initial solution of `huber` and `tukey`, one of `ROBUST_STARTS`
+
+    Returns:
+        coefficients, mask, iterations: coefficients of the fit, mask of the rejected points, and number of
+        iterations performed.
+    """
+    if rejection == 'sigma_clip':
+        return sigma_clip_fit(design, data, sigma=sigma, niter=niter, mask=mask, weights=weights)
+    elif rejection == 'mad_clip':
+        return mad_clip_fit(design, data, sigma=sigma, niter=niter, tol=tol, mask=mask, weights=weights)
+    elif rejection in ['huber', 'tukey']:
+        if start == 'mad_clip':
+            coefficients, _, initial_iterations = mad_clip_fit(design, data, sigma=sigma, niter=niter, tol=tol,
+                                                               mask=mask, weights=weights)
+            # hold the scale of the MAD-clip solution fixed (see :func:`mad_clip_fit`)
+            good = np.ones(len(data), dtype=bool) if mask is None else ~np.asarray(mask, dtype=bool)
+            _, scale = _robust_scale(design[good] @ coefficients - data[good])
+        elif start == 'lmeds':
+            # the LMedS solution is not refined, its scale can be inflated: re-estimate it at each iteration
+            coefficients, _, initial_iterations = least_median_fit(design, data, sigma=sigma, mask=mask,
+                                                                   weights=weights, seed=seed, groups=groups,
+                                                                   refine=False)
+            scale = None
+        else:
+            raise ValueError(r"start not defined. Current possibilities are: {}".format(ROBUST_STARTS))
+        coefficients, mask, iterations = irls_fit(design, data, weight_function=rejection, sigma=sigma,
+                                                  niter=niter, tol=tol, mask=mask, weights=weights,
+                                                  coefficients=coefficients, scale=scale)
+        return coefficients, mask, iterations + initial_iterations
+    elif rejection == 'lmeds':
+        return least_median_fit(design, data, sigma=sigma, niter=niter, tol=tol, mask=mask, weights=weights,
+                                seed=seed, groups=groups)
+    else:
+        raise ValueError(r"rejection not defined. Current possibilities are: {}".format(REJECTIONS))
 
 
 def full_fit(all_pixel: np.array, all_wavelength: np.array, all_orders: np.array,
              tot_pixel: float, fit_order_spec: int = 3, fit_order_order: int = 4,
              fit_function: str = 'legendre2d', sigma: float = 3.0,
-             niter: int = 100) -> tuple:
+             niter: int = 100, fitter: str = 'native', rejection: str = 'sigma_clip', tol: float = 1.e-3,
+             fit_info: dict = None, start: str = 'mad_clip') -> tuple:
     r"""Obtain the 2D wavelength solution for an Echelle spectrograph.
 
     This is calculated from the pixel centroid and the order number of identified arc lines. The fit is a simple
@@ -39,6 +456,14 @@ def full_fit(all_pixel: np.array, all_wavelength: np.array, all_orders: np.array
         fit_function (str): 2D function to be used
         sigma (float): sigma level for the rejection algorithm
         niter (int): number of iterations for the rejection algorithm
+        fitter (str): `native` uses the vectorized solver in :func:`sigma_clip_fit`, `astropy` uses
+            `FittingWithOutlierRemoval` with `LinearLSQFitter` and `sigma_clip`
+        rejection (str): rejection strategy of the `native` fitter (see :func:`robust_fit`). The `astropy` fitter
+            supports only `sigma_clip`
+        tol (float): convergence tolerance of the `mad_clip`, `huber`, `tukey`, and `lmeds` rejections
+        fit_info (dict): if provided, it is filled with the `rejection` used and the number of `iterations`
+        start (str): initial solution of the `huber` and `tukey` rejections, `mad_clip` or `lmeds` (see
+            :func:`robust_fit`)
 
     Returns:
         fit2d, mask: result of the fit and mask of the rejected lines.
@@ -49,33 +474,43 @@ def full_fit(all_pixel: np.array, all_wavelength: np.array, all_orders: np.array
     # This allows to perform the fitting independently from the binning
     tot_pixel_minus_1 = float(tot_pixel - 1)
     norm_pixel = all_pixel / tot_pixel_minus_1
-    min_norm_pixel = 0.0
-    max_norm_pixel = 1.0
     # Normalize for orders
-    min_order = np.min(all_orders)
-    max_order = np.max(all_orders)
+    order_domain = (np.min(all_orders), np.max(all_orders))
     # Fit the product of wavelength and order number with a 2d legendre polynomial
     all_wavelength_order = all_wavelength * all_orders
 
     # Define fitting function
-    if fit_function == 'legendre2d':
-        model_function2d = models.Legendre2D(x_degree=fit_order_spec, y_degree=fit_order_order,
-                                             x_domain=(min_norm_pixel, max_norm_pixel), y_domain=(min_order, max_order))
-    elif fit_function == 'chebyshev2d':
-        model_function2d = models.Chebyshev2D(x_degree=fit_order_spec, y_degree=fit_order_order,
-                                              x_domain=(min_norm_pixel, max_norm_pixel), y_domain=(min_order, max_order))
-    else:
-        raise ValueError(r"fitting function not defined. Current possibilities are: {}".format(FIT_FUNCTIONS))
-    fit_function2d = fitting.FittingWithOutlierRemoval(fitting.LinearLSQFitter(), sigma_clip, niter=niter,
-                                                       sigma=sigma)
+    model_function2d = _init_model(fit_function, fit_order_spec, fit_order_order, order_domain)
 
     # run the fit
-    fit2d, mask = fit_function2d(model_function2d, norm_pixel, all_orders, all_wavelength_order)
+    with profiling.stage('fit', fitter=fitter, rejection=rejection):
+        if fitter == 'native':
+            design = design_matrix(norm_pixel, all_orders, fit_order_spec, fit_order_order, order_domain,
+                                   fit_function=fit_function)
+            coefficients, mask, iterations = robust_fit(design, all_wavelength_order, rejection=rejection,
+                                                        sigma=sigma, niter=niter, tol=tol, groups=all_orders,
+                                                        start=start)
+            fit2d = model_function2d
+            fit2d.parameters = coefficients
+        elif fitter == 'astropy':
+            if rejection != 'sigma_clip':
+                raise ValueError(r"the astropy fitter supports only the sigma_clip rejection")
+            from astropy.modeling import fitting
+            from astropy.stats import sigma_clip
+            fit_function2d = fitting.FittingWithOutlierRemoval(fitting.LinearLSQFitter(), sigma_clip, niter=niter,
+                                                               sigma=sigma)
+            fit2d, mask = fit_function2d(model_function2d, norm_pixel, all_orders, all_wavelength_order)
+            iterations = fit_function2d.fit_info['niter']
+        else:
+            raise ValueError(r"fitter not defined. Current possibilities are: {}".format(FITTERS))
+    profiling.count('rejection_iterations', iterations, fitter=fitter, rejection=rejection)
+    if fit_info is not None:
+        fit_info.update(rejection=rejection, iterations=iterations)
     return fit2d, mask
 
 
 def plot_fit(fit2d: object, mask: object, all_pixel: np.array, all_wavelength: np.array, all_orders: np.array,
-             tot_pixel: float) -> None:
+             tot_pixel: float, output_file: str = None, show: bool = None) -> tuple:
     """Plot the result of the fitting process order by order.
 
     Args:
@@ -85,102 +520,109 @@ def plot_fit(fit2d: object, mask: object, all_pixel: np.array, all_wavelength: n
         all_wavelength (array): true wavelength of the identified lines
         all_orders (array): order number where the line are identified lines
         tot_pixel (int): size of the image in the spectral direction
+        output_file (str): if provided, the figure is saved in this file (the format is taken from the extension,
+            e.g. `.png` or `.pdf`)
+        show (bool): show the figure on screen. By default, the figure is shown only if `output_file` is `None`.
+            If `False`, pyplot is never used and no display is needed
 
     Returns:
-        None
+        fig, statistics: the figure and the `FitStatistics` of the fit (see :func:`qa.residual_statistics`)
     """
-
-    # define the different orders
-    orders = np.unique(all_orders)
-    # define the normalizations for the pixels
-    tot_pixel_minus_1 = float(tot_pixel - 1)
-
-    # Define pixels array
-    spec_vec_norm = np.arange(tot_pixel) / tot_pixel_minus_1
-
-    resid_wl_global = []
-
-    # set the size of the plot
-    nrow = np.int(2)
-    ncol = np.int(np.ceil(len(orders) / 2.))
-    fig = plt.figure(figsize=(4 * ncol, 5 * nrow))
-
-    outer = gridspec.GridSpec(nrow, ncol, wspace=0.3, hspace=0.2)
-
-    for ii_row in range(nrow):
-        for ii_col in range(ncol):
-            if (ii_row * ncol + ii_col) < len(orders):
-                inner = gridspec.GridSpecFromSubplotSpec(2, 1,
-                                                         height_ratios=[2, 1], width_ratios=[1],
-                                                         subplot_spec=outer[ii_row * ncol + ii_col],
-                                                         wspace=0.1, hspace=0.0)
-                ax0 = plt.Subplot(fig, inner[0])
-                ax1 = plt.Subplot(fig, inner[1], sharex=ax0)
-                plt.setp(ax0.get_xticklabels(), visible=False)
-
-                ii = orders[ii_row * ncol + ii_col]
-
-                # define the color
-                rr = (ii - np.max(orders)) / (np.min(orders) - np.max(orders))
-                gg = 0.0
-                bb = (ii - np.min(orders)) / (np.max(orders) - np.min(orders))
-
-                # Evaluate function
-                wv_order_mod = fit2d(spec_vec_norm, ii * np.ones_like(spec_vec_norm))
-
-                # Evaluate delta lambda
-                dwl = (wv_order_mod[-1] - wv_order_mod[0]) / ii / tot_pixel_minus_1 / (spec_vec_norm[-1] - spec_vec_norm[0])
-
-                # Estimate the residuals
-                on_order = all_orders == ii
-                this_order = all_orders[on_order]
-                this_pix = all_pixel[on_order]
-                this_wv = all_wavelength[on_order]
-                this_msk = mask[on_order]
-
-                wv_order_mod_resid = fit2d(this_pix / tot_pixel_minus_1, this_order)
-                resid_wl = (wv_order_mod_resid / ii - this_wv)
-                resid_wl_global = np.append(resid_wl_global, resid_wl[~this_msk])
-
-                # Plot the fit
-                ax0.set_title('Order = {0:0.0f}'.format(ii))
-                ax0.plot(spec_vec_norm * tot_pixel_minus_1, wv_order_mod / ii / 10000., color=(rr, gg, bb),
-                         linestyle='-', linewidth=2.5)
-                ax0.scatter(this_pix[this_msk], (wv_order_mod_resid[this_msk] / ii / 10000.) + \
-                            100. * resid_wl[this_msk] / 10000., marker='x', color='black', \
-                            linewidth=2.5, s=16.)
-                ax0.scatter(this_pix[~this_msk], (wv_order_mod_resid[~this_msk] / ii / 10000.) + \
-                            100. * resid_wl[~this_msk] / 10000., color=(rr, gg, bb), \
-                            linewidth=2.5, s=16.)
-
-                ax0.set_ylabel(r'Wavelength [$\mu$m]')
-
-                # Plot the residuals
-                ax1.scatter(this_pix[this_msk], (resid_wl[this_msk] / dwl), marker='x', color='black', \
-                            linewidth=2.5, s=16.)
-                ax1.scatter(this_pix[~this_msk], (resid_wl[~this_msk] / dwl), color=(rr, gg, bb), \
-                            linewidth=2.5, s=16.)
-                ax1.axhline(y=0., color=(rr, gg, bb), linestyle=':', linewidth=2.5)
-                ax1.get_yaxis().set_label_coords(-0.15, 0.5)
-
-                rms_order = np.std(resid_wl[~this_msk])
-
-                ax1.set_ylabel(r'Res. [pix]')
-
-                ax0.text(0.1, 0.9, r'RMS={0:.3f} Pixel'.format(rms_order / np.abs(dwl)), ha="left", va="top",
-                         transform=ax0.transAxes)
-                ax0.text(0.1, 0.8, r'$\Delta\lambda$={0:.3f} Pixel/$\AA$'.format(np.abs(dwl)), ha="left", va="top",
-                         transform=ax0.transAxes)
-                ax0.get_yaxis().set_label_coords(-0.15, 0.5)
-
-                fig.add_subplot(ax0)
-                fig.add_subplot(ax1)
-
-    rms_global = np.std(resid_wl_global)
-
-    fig.text(0.5, 0.04, r'Row [pixel]', ha='center', size='large')
-    fig.suptitle(
-        r'Arc 2D FIT, RMS={:5.3f} Ang*Order#, residuals $\times$ 100'.format(rms_global))
-    plt.show()
-
-    return
+    from gnirsarc2d.fitting import qa
+    if show is None:
+        show = output_file is None
+    from matplotlib import gridspec
+    if show:
+        from matplotlib import pyplot as plt
+        figure = plt.figure
+    else:
+        # stand-alone figure: rendered with Agg when saved, it does not interact with the pyplot state machine
+        from matplotlib.figure import Figure as figure
+
+    with profiling.stage('plot'):
+        mask = np.asarray(mask, dtype=bool)
+        statistics = qa.residual_statistics(fit2d, mask, all_pixel, all_wavelength, all_orders, tot_pixel)
+        # define the different orders
+        orders = statistics.orders
+        # define the normalizations for the pixels
+        tot_pixel_minus_1 = float(tot_pixel - 1)
+
+        # Define pixels array
+        spec_vec_norm = np.arange(tot_pixel) / tot_pixel_minus_1
+        pixels = spec_vec_norm * tot_pixel_minus_1
+
+        # Evaluate function on all orders at once
+        wv_order_mod_all = fit2d(np.tile(spec_vec_norm, len(orders)),
+                                 np.repeat(orders, len(spec_vec_norm))).reshape(len(orders), len(spec_vec_norm))
+
+        # set the size of the plot
+        nrow = 2
+        ncol = int(np.ceil(len(orders) / 2.))
+        fig = figure(figsize=(4 * ncol, 5 * nrow))
+
+        outer = gridspec.GridSpec(nrow, ncol, figure=fig, wspace=0.3, hspace=0.2)
+
+        for index_order, ii in enumerate(orders):
+            inner = gridspec.GridSpecFromSubplotSpec(2, 1,
+                                                     height_ratios=[2, 1], width_ratios=[1],
+                                                     subplot_spec=outer[index_order],
+                                                     wspace=0.1, hspace=0.0)
+            ax0 = fig.add_subplot(inner[0])
+            ax1 = fig.add_subplot(inner[1], sharex=ax0)
+            ax0.tick_params(labelbottom=False)
+
+            # define the color
+            rr = (ii - np.max(orders)) / (np.min(orders) - np.max(orders))
+            gg = 0.0
+            bb = (ii - np.min(orders)) / (np.max(orders) - np.min(orders))
+
+            wv_order_mod = wv_order_mod_all[index_order]
+            dwl = statistics.dwl[index_order]
+
+            # Select the residuals
+            on_order = all_orders == ii
+            this_pix = all_pixel[on_order]
+            this_msk = mask[on_order]
+            resid_wl = statistics.resid_wl[on_order]
+            wv_order_mod_resid = (resid_wl + all_wavelength[on_order]) * ii
+
+            # Plot the fit
+            ax0.set_title('Order = {0:0.0f}'.format(ii))
+            ax0.plot(pixels, wv_order_mod / ii / 10000., color=(rr, gg, bb),
+                     linestyle='-', linewidth=2.5)
+            ax0.scatter(this_pix[this_msk], (wv_order_mod_resid[this_msk] / ii / 10000.) + \
+                        100. * resid_wl[this_msk] / 10000., marker='x', color='black', \
+                        linewidth=2.5, s=16.)
+            ax0.scatter(this_pix[~this_msk], (wv_order_mod_resid[~this_msk] / ii / 10000.) + \
+                        100. * resid_wl[~this_msk] / 10000., color=(rr, gg, bb), \
+                        linewidth=2.5, s=16.)
+
+            ax0.set_ylabel(r'Wavelength [$\mu$m]')
+
+            # Plot the residuals
+            ax1.scatter(this_pix[this_msk], (resid_wl[this_msk] / dwl), marker='x', color='black', \
+                        linewidth=2.5, s=16.)
+            ax1.scatter(this_pix[~this_msk], (resid_wl[~this_msk] / dwl), color=(rr, gg, bb), \
+                        linewidth=2.5, s=16.)
+            ax1.axhline(y=0., color=(rr, gg, bb), linestyle=':', linewidth=2.5)
+            ax1.get_yaxis().set_label_coords(-0.15, 0.5)
+
+            rms_order = statistics.rms_order[index_order]
+
+            ax1.set_ylabel(r'Res. [pix]')
+
+            ax0.text(0.1, 0.9, r'RMS={0:.3f} Pixel'.format(rms_order / np.abs(dwl)), ha="left", va="top",
+                     transform=ax0.transAxes)
+            ax0.text(0.1, 0.8, r'$\Delta\lambda$={0:.3f} Pixel/$\AA$'.format(np.abs(dwl)), ha="left", va="top",
+                     transform=ax0.transAxes)
+            ax0.get_yaxis().set_label_coords(-0.15, 0.5)
+
+        fig.text(0.5, 0.04, r'Row [pixel]', ha='center', size='large')
+        fig.suptitle(
+            r'Arc 2D FIT, RMS={:5.3f} Ang*Order#, residuals $\times$ 100'.format(statistics.rms_global))
+        if output_file is not None:
+            fig.savefig(output_file)
+    if show:
+        plt.show()
+
+    return fig, statistics
@@ -0,0 +1,373 @@
+"""Fit the wavelength solution of many arcs in a single process pool.
+"""
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from gnirsarc2d import profiling
+from gnirsarc2d.fitting import arc2d, prefilter, qa, stacked
+from gnirsarc2d.gnirs_config import gnirs
+from gnirsarc2d.io import cache, read_iraf_database, summary
+
+
+class ArcFitResult:
+    """Class containing the result of the 2D fit of a single arc.
+
+    Attributes:
+        root_filename (str): root filename of the arc (`idFILENAME`)
+        fit2d (object): result of the fitting procedure
+        mask (array): data rejected by the fitting procedure
+        pixel (array): centroid position in pixels of the identified lines
+        wavelength (array): true wavelength of the identified lines
+        order (array): order number where the line are identified lines
+        statistics (FitStatistics): residuals and QA statistics of the fit
+        prefilter (PrefilterResult): lines removed before the fit, if the prefilter has been applied
+        fit_info (dict): rejection used and number of rejection iterations (see :func:`arc2d.full_fit`)
+        timing (dict): seconds spent reading the identify files (`read`) and fitting the lines (`fit`)
+        profile (dict): profiling report of the arc, when fitted in a worker process with the profiling on
+        error (str): description of the error, if the fit of the arc failed
+        plot_error (str): description of the error, if the fit succeeded but its plot failed
+        output_error (str): description of the error, if writing the outputs of the arc failed
+
+    """
+
+    def __init__(self, root_filename: str, fit2d: object = None, mask: object = None, pixel: object = None,
+                 wavelength: object = None, order: object = None, statistics: object = None,
+                 prefilter: object = None, fit_info: dict = None, timing: dict = None, error: str = None):
+        self.root_filename = root_filename
+        self.fit2d = fit2d
+        self.mask = mask
+        self.pixel = pixel
+        self.wavelength = wavelength
+        self.order = order
+        self.statistics = statistics
+        self.prefilter = prefilter
+        self.fit_info = {} if fit_info is None else fit_info
+        self.timing = {} if timing is None else timing
+        self.profile = None
+        self.error = error
+        self.plot_error = None
+        self.output_error = None
+
+    def __str__(self):
+        if self.error is not None:
+            return '{}: FAILED ({})'.format(self.root_filename, self.error)
+        prefiltered = '' if self.prefilter is None else ', {} prefiltered'.format(self.prefilter.n_removed)
+        failed = '' if self.output_error is None else ', output FAILED ({})'.format(self.output_error)
+        failed += '' if self.plot_error is None else ', plot FAILED ({})'.format(self.plot_error)
+        return '{}: {} lines{}, {} rejected, RMS={:.4f} Ang{}'.format(self.root_filename, len(self.pixel), prefiltered,
+                                                                      int(self.mask.sum()), self.statistics.rms_global,
+                                                                      failed)
+
+    @property
+    def success(self):
+        r"""True if the arc has been successfully fitted"""
+        return self.error is None
+
+
+def fit_arc(database_directory: str, root_filename: str, configuration: str = '32/mmSB',
+            cache_directory: str = None, use_prefilter: bool = False, identify_cache: object = None,
+            **fit_kwargs) -> object:
+    r"""Read the lines identified in all the slits of an arc and fit them with :func:`arc2d.full_fit`.
+
+    Any exception raised while reading or fitting is caught and stored in the `error` attribute of the result, so
+    that a single bad arc does not stop the processing of a batch.
+
+    Args:
+        database_directory (str): IRAF database directory
+        root_filename (str): root filename for the result of the identify task
+        configuration (str): name of the GNIRS configuration
+        cache_directory (str): if provided, parsed features are cached in this directory (see `IdentifyCache`)
+        use_prefilter (bool): remove the misidentified lines found by :func:`prefilter.prefilter_lines` before the
+            fit
+        identify_cache (object): cache of the parsed features (e.g. `MemoryIdentifyCache`), used instead of
+            `cache_directory`
+        **fit_kwargs: additional keywords passed to :func:`arc2d.full_fit`
+
+    Returns:
+        ArcFitResult: result of the fit
+    """
+    timing, fit_info = {}, {}
+    try:
+        start = time.perf_counter()
+        gnirs_configuration = gnirs.get_configuration(configuration)
+        if identify_cache is None and cache_directory is not None:
+            identify_cache = cache.IdentifyCache(cache_directory)
+        pixel, wavelength_iraf, wavelength, order = read_iraf_database.get_features_from_database(
+            database_directory, root_filename, gnirs_configuration, cache=identify_cache)
+        timing['read'] = time.perf_counter() - start
+        start = time.perf_counter()
+        prefilter_result = None
+        if use_prefilter:
+            with profiling.stage('prefilter'):
+                prefilter_result = prefilter.prefilter_lines(wavelength_iraf, wavelength, order, gnirs_configuration)
+                pixel, wavelength, order = prefilter_result.apply(pixel, wavelength, order)
+        fit2d, mask = arc2d.full_fit(pixel, wavelength, order, tot_pixel=gnirs_configuration.cols, fit_info=fit_info,
+                                     **fit_kwargs)
+        timing['fit'] = time.perf_counter() - start
+        statistics = qa.residual_statistics(fit2d, mask, pixel, wavelength, order, tot_pixel=gnirs_configuration.cols)
+    except Exception as error:
+        return ArcFitResult(root_filename, timing=timing, error='{}: {}'.format(type(error).__name__, error))
+    return ArcFitResult(root_filename, fit2d=fit2d, mask=mask, pixel=pixel, wavelength=wavelength, order=order,
+                        statistics=statistics, prefilter=prefilter_result, fit_info=fit_info, timing=timing)
+
+
+def _fit_arc_star(arguments: tuple) -> object:
+    database_directory, root_filename, configuration, cache_directory, use_prefilter, fit_kwargs = arguments
+    return fit_arc(database_directory, root_filename, configuration=configuration, cache_directory=cache_directory,
+                   use_prefilter=use_prefilter, **fit_kwargs)
+
+
+def _fit_arc_worker(arguments: tuple) -> object:
+    # worker processes send back their own profiling records, to be merged by the parent process
+    profile, arguments = arguments
+    if profile is None:
+        return _fit_arc_star(arguments)
+    if not profiling.is_enabled():
+        profiling.enable(memory=profile)
+    profiling.reset()
+    result = _fit_arc_star(arguments)
+    result.profile = profiling.report()
+    return result
+
+
+def plot_arc(result: object, configuration: str = '32/mmSB', plot_directory: str = '.',
+             plot_format: str = 'png') -> str:
+    r"""Save the plot of the fit of an arc in `plot_directory` as `root_filename.plot_format`.
+
+    The directory is created if it does not exist.
+
+    Args:
+        result (ArcFitResult): result of the fit
+        configuration (str): name of the GNIRS configuration
+        plot_directory (str): directory where the plot is saved
+        plot_format (str): format of the plot (e.g. `png` or `pdf`)
+
+    Returns:
+        str: name of the file, or `None` if the fit of the arc failed
+    """
+    if not result.success:
+        return None
+    os.makedirs(plot_directory, exist_ok=True)
+    output_file = os.path.join(plot_directory, '{}.{}'.format(result.root_filename, plot_format))
+    arc2d.plot_fit(result.fit2d, result.mask, result.pixel, result.wavelength, result.order,
+                   tot_pixel=gnirs.get_configuration(configuration).cols, output_file=output_file, show=False)
+    return output_file
+
+
+def _prefetch_features(database_directory: str, root_filenames: list, configurations: list,
+                       cache_directory: str = None) -> object:
+    r"""Read the identify files of all the arcs concurrently into a cache, returned to be used by :func:`fit_arc`.
+
+    Files that cannot be read are skipped: the error is raised again (and stored in the result) by the fit of the arc.
+    """
+    identify_cache = cache.MemoryIdentifyCache() if cache_directory is None else cache.IdentifyCache(cache_directory)
+    paths = [path_to_file for root_filename, configuration in zip(root_filenames, configurations)
+             for path_to_file in read_iraf_database._slit_paths(database_directory, root_filename,
+                                                                gnirs.get_configuration(configuration))]
+
+    def prefetch(path_to_file):
+        try:
+            identify_cache.get_features(path_to_file)
+        except Exception:
+            pass
+
+    with profiling.stage('prefetch'):
+        for _ in read_iraf_database.map_concurrently(prefetch, paths):
+            pass
+    return identify_cache
+
+
+def _write_outputs(result: object, configuration: str, output_directory: str = None, summary_format: str = 'json',
+                   table_writer: object = None):
+    # files of the arc in `output_directory` and row of the combined table. A failure is stored in the result, so
+    # that it does not stop the other arcs
+    if output_directory is None and table_writer is None:
+        return
+    with profiling.stage('output'):
+        try:
+            if output_directory is not None:
+                arc_summary = summary.write_arc_outputs(result, output_directory, configuration=configuration,
+                                                        tot_pixel=gnirs.get_configuration(configuration).cols,
+                                                        summary_format=summary_format)
+            else:
+                arc_summary = summary.arc_summary(result, configuration=configuration)
+            if table_writer is not None:
+                table_writer.write(arc_summary)
+        except Exception as error:
+            result.output_error = '{}: {}'.format(type(error).__name__, error)
+
+
+def fit_arcs(database_directory: str, root_filenames: list = None, pattern: str = 'id*',
+             configuration: object = '32/mmSB', processes: int = None, cache_directory: str = None,
+             plot_directory: str = None, plot_format: str = 'png', use_prefilter: bool = False,
+             output_directory: str = None, summary_format: str = 'json', summary_table: str = None,
+             **fit_kwargs) -> list:
+    r"""Fit the wavelength solution of many arcs, distributing them over a pool of processes.
+
+    Args:
+        database_directory (str): IRAF database directory
+        root_filenames (list): root filenames of the arcs. If `None`, all the arcs matching `pattern` in the
+            `database_directory` are considered
+        pattern (str): glob pattern used to select the identify files when `root_filenames` is `None`
+        configuration (str or list): name of the GNIRS configuration, or list with the configuration of each arc
+        processes (int): number of worker processes. If `None`, it is set to the number of CPUs. If 1, the arcs
+            are fitted sequentially in the current process, after reading the files of all the arcs concurrently
+        cache_directory (str): if provided, parsed features are cached in this directory (see `IdentifyCache`)
+        plot_directory (str): if provided, the plot of each fit is saved in this directory (see :func:`plot_arc`).
+            The plots are rendered by a background process while the following arcs are fitted. A failed plot is
+            recorded in the `plot_error` attribute of the result of its arc
+        plot_format (str): format of the plots (e.g. `png` or `pdf`)
+        use_prefilter (bool): remove the misidentified lines found by :func:`prefilter.prefilter_lines` before the
+            fit of each arc
+        output_directory (str): if provided, the solution and the summary of each arc are written in this
+            directory as soon as the arc is fitted (see :func:`summary.write_arc_outputs`). A failure is recorded in
+            the `output_error` attribute of the result of its arc
+        summary_format (str): format of the summary of each arc, `json` or `ecsv`
+        summary_table (str): if provided, a row for each arc is appended to this ECSV table as soon as the arc is
+            fitted (see :class:`summary.SummaryTableWriter`)
+        **fit_kwargs: additional keywords passed to :func:`arc2d.full_fit`
+
+    Returns:
+        list: one `ArcFitResult` per arc, in the same order as `root_filenames` (sorted if obtained from `pattern`)
+    """
+    if root_filenames is None:
+        root_filenames = read_iraf_database.find_root_filenames(database_directory, pattern=pattern)
+    if configuration is None or isinstance(configuration, str):
+        configurations = [configuration] * len(root_filenames)
+    else:
+        configurations = list(configuration)
+        if len(configurations) != len(root_filenames):
+            raise ValueError('{} configurations given for {} arcs'.format(len(configurations), len(root_filenames)))
+    arguments = [(database_directory, root_filename, arc_configuration, cache_directory, use_prefilter, fit_kwargs)
+                 for root_filename, arc_configuration in zip(root_filenames, configurations)]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(arguments)))
+    if plot_directory is not None:
+        os.makedirs(plot_directory, exist_ok=True)
+    plot_executor = None if plot_directory is None else ProcessPoolExecutor(max_workers=1)
+    fit_executor = None if processes == 1 else ProcessPoolExecutor(max_workers=processes)
+    table_writer = None if summary_table is None else summary.SummaryTableWriter(summary_table)
+    try:
+        if fit_executor is None:
+            identify_cache = _prefetch_features(database_directory, root_filenames, configurations, cache_directory)
+            fitted = (fit_arc(*argument[:3], use_prefilter=use_prefilter, identify_cache=identify_cache,
+                              **fit_kwargs) for argument in arguments)
+        else:
+            # `map` returns the results in the order of the inputs, independently of the completion order
+            profile = profiling.report()['memory'] if profiling.is_enabled() else None
+            fitted = fit_executor.map(_fit_arc_worker, [(profile, argument) for argument in arguments],
+                                      chunksize=max(1, len(arguments) // (4 * processes)))
+        results, plots = [], []
+        for result, arc_configuration in zip(fitted, configurations):
+            profiling.merge(result.profile)
+            results.append(result)
+            _write_outputs(result, arc_configuration, output_directory, summary_format, table_writer)
+            if plot_executor is not None and result.success:
+                plots.append((result, plot_executor.submit(plot_arc, result, configuration=arc_configuration,
+                                                           plot_directory=plot_directory, plot_format=plot_format)))
+        for result, plot in plots:
+            try:
+                plot.result()
+            except Exception as error:
+                result.plot_error = '{}: {}'.format(type(error).__name__, error)
+    finally:
+        if fit_executor is not None:
+            fit_executor.shutdown()
+        if plot_executor is not None:
+            plot_executor.shutdown()
+        if table_writer is not None:
+            table_writer.close()
+    return results
+
+
+def fit_arcs_stacked(database_directory: str, root_filenames: list = None, pattern: str = 'id*',
+                     configuration: str = '32/mmSB', cache_directory: str = None, use_prefilter: bool = False,
+                     output_directory: str = None, summary_format: str = 'json', summary_table: str = None,
+                     **fit_kwargs) -> list:
+    r"""Fit the wavelength solution of many arcs in the current process, sharing the work among similar arcs.
+
+    The identify files of all the arcs are read concurrently, and the arcs that identified the same lines are
+    fitted together with :func:`stacked.fit_stacked`. This is convenient for calibration sequences, where the
+    same line list is used for all the arcs.
+
+    Args:
+        database_directory (str): IRAF database directory
+        root_filenames (list): root filenames of the arcs. If `None`, all the arcs matching `pattern` in the
+            `database_directory` are considered
+        pattern (str): glob pattern used to select the identify files when `root_filenames` is `None`
+        configuration (str): name of the GNIRS configuration
+        cache_directory (str): if provided, parsed features are cached in this directory (see `IdentifyCache`)
+        use_prefilter (bool): remove the misidentified lines found by :func:`prefilter.prefilter_lines` before the
+            fit of each arc
+        output_directory (str): if provided, the solution and the summary of each arc are written in this
+            directory (see :func:`summary.write_arc_outputs`). A failure is recorded in the `output_error`
+            attribute of the result of its arc
+        summary_format (str): format of the summary of each arc, `json` or `ecsv`
+        summary_table (str): if provided, a row for each arc is appended to this ECSV table
+        **fit_kwargs: additional keywords passed to :func:`stacked.fit_stacked`
+
+    The fitting time of each arc in `ArcFitResult.timing` is the average over the arcs fitted together.
+
+    Returns:
+        list: one `ArcFitResult` per arc, in the same order as `root_filenames` (sorted if obtained from `pattern`)
+    """
+    if root_filenames is None:
+        root_filenames = read_iraf_database.find_root_filenames(database_directory, pattern=pattern)
+    gnirs_configuration = gnirs.get_configuration(configuration)
+    identify_cache = _prefetch_features(database_directory, root_filenames, [configuration] * len(root_filenames),
+                                        cache_directory)
+    results, line_lists, fitted = [], [], []
+    for root_filename in root_filenames:
+        start = time.perf_counter()
+        try:
+            pixel, wavelength_iraf, wavelength, order = read_iraf_database.get_features_from_database(
+                database_directory, root_filename, gnirs_configuration, cache=identify_cache, max_workers=1)
+            prefilter_result = None
+            if use_prefilter:
+                prefilter_result = prefilter.prefilter_lines(wavelength_iraf, wavelength, order, gnirs_configuration)
+                pixel, wavelength, order = prefilter_result.apply(pixel, wavelength, order)
+        except Exception as error:
+            results.append(ArcFitResult(root_filename, error='{}: {}'.format(type(error).__name__, error)))
+            continue
+        results.append(ArcFitResult(root_filename, pixel=pixel, wavelength=wavelength, order=order,
+                                    prefilter=prefilter_result,
+                                    fit_info={'rejection': fit_kwargs.get('rejection', 'sigma_clip')},
+                                    timing={'read': time.perf_counter() - start}))
+        line_lists.append((pixel, wavelength, order))
+        fitted.append(results[-1])
+    start = time.perf_counter()
+    try:
+        solutions = stacked.fit_stacked(line_lists, gnirs_configuration.cols,
+                                        fit_infos=[result.fit_info for result in fitted], **fit_kwargs)
+    except Exception:
+        # a failure in a group of arcs must not affect the others: fit them one by one
+        solutions = []
+        for line_list, result in zip(line_lists, fitted):
+            try:
+                solutions.append(stacked.fit_stacked([line_list], gnirs_configuration.cols,
+                                                     fit_infos=[result.fit_info], **fit_kwargs)[0])
+            except Exception as error:
+                solutions.append(error)
+    fit_time = (time.perf_counter() - start) / max(1, len(fitted))
+    for result, arc_solution in zip(fitted, solutions):
+        result.timing['fit'] = fit_time
+        try:
+            if isinstance(arc_solution, Exception):
+                raise arc_solution
+            fit2d, mask = arc_solution
+            result.statistics = qa.residual_statistics(fit2d, mask, result.pixel, result.wavelength, result.order,
+                                                       tot_pixel=gnirs_configuration.cols)
+            result.fit2d, result.mask = fit2d, mask
+        except Exception as error:
+            result.error = '{}: {}'.format(type(error).__name__, error)
+    table_writer = None if summary_table is None else summary.SummaryTableWriter(summary_table)
+    try:
+        for result in results:
+            _write_outputs(result, configuration, output_directory, summary_format, table_writer)
+    finally:
+        if table_writer is not None:
+            table_writer.close()
+    return results
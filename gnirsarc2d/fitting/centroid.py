@@ -0,0 +1,273 @@
+"""Refinement of the centroids of the arc lines on the rectified arc spectra, with vectorized peak fitting.
+
+The approximate position of each line comes either from the IRAF database or from a previous wavelength solution
+(see :func:`predict_line_pixels`). A cutout of the spectrum of its order is extracted around each line, and the
+peaks of all the cutouts are fitted at once, so that new frames can be calibrated without running `identify`.
+"""
+
+import numpy as np
+
+from gnirsarc2d import profiling
+from gnirsarc2d.fitting import wavelength_map
+
+__all__ = ['CENTROID_METHODS', 'CentroidResult', 'spectra_from_rectified_arc', 'predict_line_pixels',
+           'lines_from_solution', 'refine_centroids']
+
+CENTROID_METHODS = ['gaussian', 'parabola']
+
+# Pixel coordinate of the first pixel of the spectra: IRAF pixels (and the database positions) are 1-based
+IRAF_FIRST_PIXEL = 1.
+# Default half width in pixels of the cutout where the peak of each line is searched
+DEFAULT_HALF_WIDTH = 5
+# Default half width in pixels of the region around the peak used by the gaussian fit
+DEFAULT_FIT_HALF_WIDTH = 3
+# Default largest accepted distance in pixels between the approximate and the refined position
+DEFAULT_MAX_SHIFT = 2.
+# Conversion between the standard deviation and the FWHM of a gaussian
+SIGMA_TO_FWHM = 2. * np.sqrt(2. * np.log(2.))
+
+
+class CentroidResult:
+    """Class containing the centroids refined by :func:`refine_centroids`.
+
+    All the attributes have one element per line, in the order of the input lines.
+
+    Attributes:
+        method (str): method used to fit the peaks
+        pixel (array): refined position of the lines, equal to the input position for the lines that are not valid
+        valid (array): True for the lines whose peak has been successfully fitted
+        shift (array): difference between the refined and the input position in pixels (NaN if not valid)
+        amplitude (array): height of the fitted peak above the background of the cutout
+        fwhm (array): FWHM of the fitted peak in pixels (NaN for the `parabola` method)
+
+    """
+
+    def __init__(self, method: str, pixel: np.array, valid: np.array, shift: np.array, amplitude: np.array,
+                 fwhm: np.array):
+        self.method = method
+        self.pixel = pixel
+        self.valid = valid
+        self.shift = shift
+        self.amplitude = amplitude
+        self.fwhm = fwhm
+
+    def __str__(self):
+        median_shift = np.nanmedian(np.abs(self.shift)) if self.n_valid > 0 else np.nan
+        return 'Centroids: refined {} of {} lines with the {} method, median shift {:.3f} pixel'.format(
+            self.n_valid, len(self.valid), self.method, median_shift)
+
+    @property
+    def n_valid(self):
+        r"""Number of lines successfully refined"""
+        return int(self.valid.sum())
+
+    def apply(self, *arrays) -> tuple:
+        r"""Select the lines successfully refined from arrays with one element per line.
+
+        Args:
+            *arrays: arrays to be filtered, e.g. wavelength and order
+
+        Returns:
+            tuple: the refined pixel positions followed by the filtered arrays
+        """
+        return (self.pixel[self.valid],) + tuple(np.asarray(array)[self.valid] for array in arrays)
+
+
+def spectra_from_rectified_arc(filename: str, configuration: object, extension: str = 'SCI',
+                               dispersion_axis: int = 0, spatial_range: tuple = None) -> tuple:
+    r"""Read the 1D spectrum of each order from a rectified (e.g. `nstransform`-ed) GNIRS arc.
+
+    The image of each slit is in the extension (`extension`, slit number), and it is collapsed along the spatial
+    direction with a median.
+
+    Args:
+        filename (str): name of the multi-extension FITS file
+        configuration (GnirsConfiguration): GNIRS configuration, providing the slits and the orders
+        extension (str): name of the extensions with the rectified images
+        dispersion_axis (int): numpy axis of the images along the dispersion direction. The default (0) is the
+            `y` axis, i.e. the column sections `[x,*]` used by `identify`
+        spatial_range (tuple): first and last (1-based, included) pixels along the spatial direction to be
+            collapsed. By default, all of them
+
+    Returns:
+        spectra, orders: array of shape (n_orders, n_pixel) with the spectra (padded with NaNs if the images have
+        different sizes), and the order number of each row
+    """
+    from astropy.io import fits
+    spectra, orders = [], []
+    with fits.open(filename, memmap=True) as hdul:
+        for slit, number in zip(configuration.order['slit'], configuration.order['number']):
+            image = np.moveaxis(np.asarray(hdul[extension, slit].data, dtype=float), dispersion_axis, 0)
+            if spatial_range is not None:
+                image = image[:, spatial_range[0] - 1:spatial_range[1]]
+            spectra.append(np.nanmedian(image, axis=1))
+            orders.append(number)
+    n_pixel = max(len(spectrum) for spectrum in spectra)
+    out = np.full((len(spectra), n_pixel), np.nan)
+    for row, spectrum in enumerate(spectra):
+        out[row, :len(spectrum)] = spectrum
+    return out, np.array(orders)
+
+
+def predict_line_pixels(fit2d: object, wavelength: np.array, order: np.array, tot_pixel: int) -> np.array:
+    r"""Approximate position of lines of known wavelength from a previous 2D wavelength solution.
+
+    The solution is evaluated on all the pixels of the orders of the lines (see :class:`wavelength_map.WavelengthMap`)
+    and inverted by linear interpolation.
+
+    Args:
+        fit2d (object): result of the fitting procedure (see :func:`arc2d.full_fit`), or a `WavelengthSolution`
+        wavelength (array): wavelength of the lines in Angstrom
+        order (array): order number of the lines
+        tot_pixel (int): size of the image in the spectral direction
+
+    Returns:
+        array: position of the lines in the pixel coordinates of the fit, NaN outside the range of their order
+    """
+    wavelength, order = np.asarray(wavelength, dtype=float), np.asarray(order)
+    orders, index_order = np.unique(order, return_inverse=True)
+    solution_map = wavelength_map.wavelength_map(fit2d, tot_pixel, orders)
+    pixels = np.arange(tot_pixel, dtype=float)
+    pixel = np.full(len(wavelength), np.nan)
+    for row, map_row in enumerate(solution_map):
+        on_order = index_order == row
+        # np.interp needs increasing wavelengths
+        step = 1 if map_row[-1] >= map_row[0] else -1
+        pixel[on_order] = np.interp(wavelength[on_order], map_row[::step], pixels[::step], left=np.nan,
+                                    right=np.nan)
+    return pixel
+
+
+def _cutouts(spectra: np.array, rows: np.array, centers: np.array, half_width: int) -> tuple:
+    r"""Stack the cutouts of `2 * half_width + 1` pixels around `centers` in the `rows` of `spectra`.
+
+    Returns:
+        values, index: values of the cutouts (NaN outside the spectra) and index of their pixels in the spectra
+    """
+    index = centers[:, np.newaxis] + np.arange(-half_width, half_width + 1)
+    inside = (index >= 0) & (index < spectra.shape[1]) & (rows[:, np.newaxis] >= 0)
+    values = spectra[np.where(inside, rows[:, np.newaxis], 0), np.where(inside, index, 0)]
+    return np.where(inside, values, np.nan), index
+
+
+def _parabola_peak(values: np.array, peak: np.array) -> tuple:
+    r"""Vertex of the parabola through the peak of each cutout and its two neighbours."""
+    lines = np.arange(len(values))
+    left, center, right = values[lines, peak - 1], values[lines, peak], values[lines, peak + 1]
+    curvature = left - 2. * center + right
+    with np.errstate(invalid='ignore', divide='ignore'):
+        offset = 0.5 * (left - right) / curvature
+        amplitude = center - 0.25 * (left - right) * offset
+    good = np.isfinite(offset) & (curvature < 0.)
+    return offset, amplitude, np.full(len(values), np.nan), good
+
+
+def _gaussian_peak(values: np.array, peak: np.array, fit_half_width: int) -> tuple:
+    r"""Gaussian fitted around the peak of each cutout.
+
+    The logarithm of a gaussian is a parabola: it is fitted with weighted least squares (weights equal to the
+    squared values, to compensate for the noise amplification of the logarithm) to the positive values within
+    `fit_half_width` pixels of the peak. The 3x3 normal equations of all the lines are solved at once.
+    """
+    offsets = np.arange(values.shape[1]) - peak[:, np.newaxis]
+    use = (np.abs(offsets) <= fit_half_width) & (values > 0.)
+    weights = np.where(use, values, 0.) ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_values = np.where(use, np.log(np.where(use, values, 1.)), 0.)
+    design = np.stack([np.ones(offsets.shape), offsets, offsets ** 2], axis=-1)
+    normal = np.einsum('nk,nki,nkj->nij', weights, design, design)
+    rhs = np.einsum('nk,nki,nk->ni', weights, design, log_values)
+    good = use.sum(axis=1) >= 3
+    # singular systems (e.g. not enough positive values) are replaced by the identity and flagged
+    normal[~good] = np.eye(3)
+    coefficients = np.linalg.solve(normal, rhs[:, :, np.newaxis])[:, :, 0]
+    constant, linear, quadratic = coefficients.T
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        offset = -linear / (2. * quadratic)
+        amplitude = np.exp(constant - linear ** 2 / (4. * quadratic))
+        fwhm = SIGMA_TO_FWHM * np.sqrt(-1. / (2. * quadratic))
+    good &= (quadratic < 0.) & np.isfinite(offset) & np.isfinite(amplitude)
+    return offset, amplitude, fwhm, good
+
+
+def refine_centroids(spectra: np.array, orders: np.array, pixel: np.array, order: np.array,
+                     method: str = 'gaussian', half_width: int = DEFAULT_HALF_WIDTH,
+                     fit_half_width: int = DEFAULT_FIT_HALF_WIDTH, max_shift: float = DEFAULT_MAX_SHIFT,
+                     first_pixel: float = IRAF_FIRST_PIXEL) -> object:
+    r"""Refine the position of arc lines by fitting their peaks in the spectra of their orders.
+
+    For each line, a cutout of `2 * half_width + 1` pixels centered on its approximate position is extracted from
+    the spectrum of its order, and the minimum of the cutout is subtracted as background. The peak is searched in
+    the cutout, and its position is refined with:
+
+    - `gaussian`: gaussian fitted to the pixels within `fit_half_width` of the peak (see :func:`_gaussian_peak`)
+    - `parabola`: parabola through the peak and its two neighbours
+
+    All the cutouts are stacked in a single array, so that all the lines are fitted with a few array operations. A
+    line is not valid if its order has no spectrum, if the peak is at the edge of the cutout, if the fit fails, or
+    if the refined position is more than `max_shift` pixels from the approximate one.
+
+    Args:
+        spectra (array): spectra of the orders, shape (n_orders, n_pixel)
+        orders (array): order number of each row of `spectra`
+        pixel (array): approximate position of the lines, e.g. from the IRAF database or from
+            :func:`predict_line_pixels`
+        order (array): order number of the lines
+        method (str): method used to fit the peaks
+        half_width (int): half width of the cutouts in pixels
+        fit_half_width (int): half width in pixels of the region around the peak used by the gaussian fit
+        max_shift (float): largest accepted distance in pixels between the approximate and the refined position
+        first_pixel (float): coordinate of the first pixel of the spectra in the system of `pixel` (1 for IRAF)
+
+    Returns:
+        CentroidResult: refined positions of the lines
+    """
+    if method not in CENTROID_METHODS:
+        raise ValueError(r"centroid method not defined. Current possibilities are: {}".format(CENTROID_METHODS))
+    spectra, orders = np.atleast_2d(np.asarray(spectra, dtype=float)), np.asarray(orders, dtype=int)
+    pixel, order = np.asarray(pixel, dtype=float), np.asarray(order, dtype=int)
+    with profiling.stage('centroid', method=method):
+        # row of the spectrum of each line, -1 if its order has no spectrum
+        order_to_row = np.full(max(orders.max(), order.max(initial=0)) + 1, -1)
+        order_to_row[orders] = np.arange(len(orders))
+        rows = np.where(order >= 0, order_to_row[np.clip(order, 0, None)], -1)
+        finite = np.isfinite(pixel)
+        centers = np.rint(np.where(finite, pixel - first_pixel, -2 * half_width)).astype(int)
+        values, index = _cutouts(spectra, rows, centers, half_width)
+        values = values - np.nanmin(np.where(np.isnan(values), np.inf, values), axis=1)[:, np.newaxis]
+        peak = np.argmax(np.where(np.isnan(values), -np.inf, values), axis=1)
+        valid = finite & (rows >= 0) & (peak > 0) & (peak < 2 * half_width)
+        peak = np.clip(peak, 1, 2 * half_width - 1)
+        if method == 'parabola':
+            offset, amplitude, fwhm, good = _parabola_peak(values, peak)
+        else:
+            offset, amplitude, fwhm, good = _gaussian_peak(values, peak, fit_half_width)
+        refined = index[np.arange(len(pixel)), peak] + offset + first_pixel
+        shift = refined - pixel
+        valid &= good & (np.abs(shift) <= max_shift)
+    return CentroidResult(method, np.where(valid, refined, pixel), valid, np.where(valid, shift, np.nan),
+                          np.where(valid, amplitude, np.nan), np.where(valid, fwhm, np.nan))
+
+
+def lines_from_solution(arc_solution: object, tot_pixel: int = None) -> tuple:
+    r"""Lines used by a saved wavelength solution, at the positions predicted by the solution itself.
+
+    This allows to calibrate a new arc of the same setup without the IRAF database: the predicted positions are
+    refined on the new arc with :func:`refine_centroids`.
+
+    Args:
+        arc_solution (WavelengthSolution): solution loaded with `gnirsarc2d.io.solution.load_solution`
+        tot_pixel (int): size of the image in the spectral direction. By default, the one stored in the solution
+
+    Returns:
+        pixel, wavelength, order: predicted position, wavelength, and order number of the lines not rejected by
+        the fit of the solution
+    """
+    if arc_solution.pixel is None:
+        raise ValueError('the solution does not contain the lines used in the fit')
+    tot_pixel = arc_solution.tot_pixel if tot_pixel is None else tot_pixel
+    good = np.ones(len(arc_solution.pixel), dtype=bool) if arc_solution.mask is None else \
+        ~np.asarray(arc_solution.mask, dtype=bool)
+    wavelength = np.asarray(arc_solution.wavelength, dtype=float)[good]
+    order = np.asarray(arc_solution.order, dtype=int)[good]
+    return predict_line_pixels(arc_solution, wavelength, order, tot_pixel), wavelength, order
@@ -0,0 +1,306 @@
+"""Incremental refit of the 2D wavelength solution when lines are added, removed, or re-weighted.
+"""
+
+import numpy as np
+
+from gnirsarc2d.fitting import arc2d
+
+__all__ = ['IncrementalFit']
+
+
+class IncrementalFit:
+    """Class that keeps the least-squares state of a 2D wavelength solution to quickly refit it after an edit.
+
+    The design matrix of all the lines and the triangular (Cholesky) factor `R` of the normal equations of the lines
+    currently kept (active and not rejected) are stored, so that a solution costs two triangular solves. Adding
+    lines is a rank-k update of the factor (a QR factorization of `R` stacked over the new rows), removing lines is a
+    rank-k Cholesky downdate, and re-weighting is an update followed by a downdate: each edit costs O(k p^2 + p^3)
+    for k lines and p coefficients, instead of the O(n p^2) of a new factorization of all the n lines. In the same
+    way, each rejection pass of the refit downdates the factor with the lines rejected by that pass only (and a refit
+    without warm start updates it with the lines rejected by the previous refit). A downdate that removes most of the
+    information (e.g. re-weighting all the lines) recomputes the factor from scratch, and if the factor is (close
+    to) singular the solution falls back to the least squares of :func:`arc2d.full_fit`. Neither the design matrix
+    nor the astropy model are rebuilt, unless the edit changes the range of orders (which defines the normalization
+    of the order axis).
+
+    As in :func:`arc2d.sigma_clip_fit`, the weights multiply the rows of the design matrix, i.e. they enter the
+    normal equations squared (use the inverse of the uncertainties).
+
+    Lines are identified by the index they had when they were added. Removed lines keep their index but are no
+    longer considered.
+
+    Attributes:
+        tot_pixel (int): size of the image in the spectral direction
+        fit_order_spec (int): order of the fitting along the spectral (pixel) direction for each order
+        fit_order_order (int): order of the fitting in the order direction
+        fit_function (str): 2D function to be used
+        sigma (float): sigma level for the rejection algorithm
+        niter (int): number of iterations for the rejection algorithm
+        coefficients (array): coefficients of the current solution
+        iterations (int): rejection iterations performed by the last refit
+        n_factorizations (int): number of factorizations computed from scratch
+        n_least_squares (int): number of solutions that fell back to the least squares of all the kept lines
+
+    """
+
+    def __init__(self, all_pixel: np.array, all_wavelength: np.array, all_orders: np.array, tot_pixel: float,
+                 fit_order_spec: int = 3, fit_order_order: int = 4, fit_function: str = 'legendre2d',
+                 sigma: float = 3.0, niter: int = 100):
+        self.tot_pixel = tot_pixel
+        self.fit_order_spec = fit_order_spec
+        self.fit_order_order = fit_order_order
+        self.fit_function = fit_function
+        self.sigma = sigma
+        self.niter = niter
+        self._pixel = np.array(all_pixel, dtype=float)
+        self._wavelength = np.array(all_wavelength, dtype=float)
+        self._orders = np.array(all_orders)
+        self._weights = np.ones(len(self._pixel))
+        self._active = np.ones(len(self._pixel), dtype=bool)
+        self._mask = np.zeros(len(self._pixel), dtype=bool)
+        # lines excluded from the factor: the mask of the current rejection pass
+        self._factor_mask = np.zeros(len(self._pixel), dtype=bool)
+        self.coefficients = None
+        self.iterations = 0
+        self.n_factorizations = 0
+        self.n_least_squares = 0
+        self._build()
+        self.refit(warm_start=False)
+
+    @property
+    def active(self):
+        r"""Indices of the lines currently considered in the fit"""
+        return np.flatnonzero(self._active)
+
+    @property
+    def pixel(self):
+        r"""Pixel position of the active lines"""
+        return self._pixel[self._active]
+
+    @property
+    def wavelength(self):
+        r"""True wavelength of the active lines"""
+        return self._wavelength[self._active]
+
+    @property
+    def order(self):
+        r"""Order number of the active lines"""
+        return self._orders[self._active]
+
+    @property
+    def mask(self):
+        r"""Mask of the active lines rejected by the last refit"""
+        return self._mask[self._active]
+
+    @property
+    def fit2d(self):
+        r"""Current solution as an astropy `Legendre2D`/`Chebyshev2D` model (updated in place by :meth:`refit`)"""
+        self._fit2d.parameters = self.coefficients
+        return self._fit2d
+
+    def _domain(self) -> tuple:
+        orders = self._orders[self._active]
+        return np.min(orders), np.max(orders)
+
+    def _design(self, pixel: np.array, orders: np.array) -> np.array:
+        return arc2d.design_matrix(pixel / float(self.tot_pixel - 1), orders, self.fit_order_spec,
+                                   self.fit_order_order, self._order_domain, fit_function=self.fit_function)
+
+    def _build(self):
+        r"""(Re)compute the design matrix of all the lines and the factor of the normal equations of the kept ones"""
+        self._order_domain = self._domain()
+        self._fit2d = arc2d._init_model(self.fit_function, self.fit_order_spec, self.fit_order_order,
+                                        self._order_domain)
+        self._design_matrix = self._design(self._pixel, self._orders)
+        self._data = self._wavelength * self._orders
+        self._factorize()
+
+    def _kept(self) -> np.array:
+        return self._active & ~self._factor_mask
+
+    def _factorize(self):
+        r"""Factorize the normal equations of the kept lines from scratch"""
+        self.n_factorizations += 1
+        # column scaling, as in the least-squares solution of `arc2d.sigma_clip_fit`
+        self._scale = np.ones(self._design_matrix.shape[1])
+        design, data = self._weighted_rows(self._kept())
+        scale = np.sqrt((design ** 2).sum(axis=0))
+        scale[scale == 0.] = 1.
+        design = design / scale
+        self._scale = scale
+        self._factor = self._positive_diagonal(np.linalg.qr(design, mode='r'))
+        self._rhs = design.T @ data
+        self._valid = self._is_regular(self._factor)
+
+    def _weighted_rows(self, rows: np.array, weights: np.array = None) -> tuple:
+        r"""Rows of the scaled design matrix and of the data, multiplied by the weights"""
+        weights = self._weights[rows] if weights is None else weights
+        return self._design_matrix[rows] * (weights[:, np.newaxis] / self._scale), self._data[rows] * weights
+
+    @staticmethod
+    def _positive_diagonal(factor: np.array) -> np.array:
+        signs = np.sign(np.diag(factor))
+        signs[signs == 0.] = 1.
+        return factor * signs[:, np.newaxis]
+
+    @staticmethod
+    def _is_regular(factor: np.array) -> bool:
+        diagonal = np.abs(np.diag(factor))
+        return len(diagonal) > 0 and np.min(diagonal) > 1.e-10 * np.max(diagonal)
+
+    def _update(self, rows: np.array, sign: float = 1., weights: np.array = None):
+        r"""Rank-k update (`sign` = 1) or downdate (`sign` = -1) of the factor with the given rows.
+
+        If the downdate fails, the factor is recomputed from the kept lines: the state (`_factor_mask`, `_active`, and
+        `_weights`) must already describe the lines after the edit.
+        """
+        if len(rows) == 0:
+            return
+        design, data = self._weighted_rows(rows, weights=weights)
+        self._rhs += sign * (design.T @ data)
+        if sign > 0.:
+            self._factor = self._positive_diagonal(np.linalg.qr(np.concatenate([self._factor, design]), mode='r'))
+        else:
+            self._factor = self._downdate(self._factor, design)
+        if self._factor is None:
+            self._factorize()
+        else:
+            self._valid = self._is_regular(self._factor)
+
+    @staticmethod
+    def _downdate(factor: np.array, rows: np.array) -> np.array:
+        r"""Rank-k Cholesky downdate of the upper triangular `factor`. `None` if it loses positive definiteness
+
+        `R.T @ R - X.T @ X = R.T @ (I - V.T @ V) @ R` with `V = X @ inv(R)`, so that the new factor is `G @ R`, with
+        `G` the Cholesky factor of `I - V.T @ V`.
+        """
+        projected = np.linalg.solve(factor.T, rows.T)
+        try:
+            lower = np.linalg.cholesky(np.eye(len(factor)) - projected @ projected.T)
+        except np.linalg.LinAlgError:
+            return None
+        # too much information removed: the downdated factor would be inaccurate
+        if np.min(np.diag(lower)) < 1.e-4:
+            return None
+        return lower.T @ factor
+
+    def _factor_solve(self, rhs: np.array) -> np.array:
+        r"""Solve `R.T @ R @ x = rhs` with the stored factor"""
+        return np.linalg.solve(self._factor, np.linalg.solve(self._factor.T, rhs))
+
+    def _set_factor_mask(self, mask: np.array):
+        r"""Update the factor so that it excludes the lines in `mask`, applying only the lines that changed state"""
+        restored = np.flatnonzero(self._active & self._factor_mask & ~mask)
+        rejected = np.flatnonzero(self._active & ~self._factor_mask & mask)
+        self._factor_mask = mask & self._active
+        # update before downdating, to keep the factor positive definite
+        self._update(restored)
+        self._update(rejected, sign=-1.)
+
+    def _solve(self) -> np.array:
+        r"""Solve the normal equations of the kept lines"""
+        if self._valid:
+            return self._factor_solve(self._rhs) / self._scale
+        # rank-deficient system: least-squares solution of the lines kept
+        self.n_least_squares += 1
+        kept = self._kept()
+        return arc2d._least_squares(self._design_matrix[kept], self._data[kept], self._weights[kept])
+
+    def refit(self, warm_start: bool = True) -> tuple:
+        r"""Refit the active lines with the sigma-clipping rejection.
+
+        Args:
+            warm_start (bool): if `True` (default), the rejection restarts from the mask of the previous refit (new
+                lines are not rejected), which usually converges in one or two passes but, since the rejection is
+                cumulative, it never brings back previously rejected lines. If `False`, the rejection starts from no
+                rejected lines and follows the same sequence of :func:`arc2d.full_fit`, giving the same model and mask
+
+        Returns:
+            fit2d, mask: current solution and mask of the rejected active lines
+        """
+        active = self._active
+        mask = self._mask & active if warm_start else np.zeros(len(active), dtype=bool)
+        design, data = self._design_matrix[active], self._data[active]
+        self._set_factor_mask(mask)
+        self.coefficients = self._solve()
+        self.iterations = 0
+        for _ in range(self.niter):
+            self.iterations += 1
+            new_mask = np.zeros(len(active), dtype=bool)
+            new_mask[active] = arc2d._sigma_clip_mask(design @ self.coefficients - data, mask[active],
+                                                      sigma=self.sigma)
+            self._set_factor_mask(new_mask)
+            self.coefficients = self._solve()
+            converged = new_mask.sum() == mask.sum()
+            mask = new_mask
+            if converged:
+                break
+        self._mask = mask
+        return self.fit2d, self.mask
+
+    def add_lines(self, pixel: np.array, wavelength: np.array, order: np.array, weights: np.array = None) -> np.array:
+        r"""Add lines to the fit. The solution is not updated until :meth:`refit` is called.
+
+        Args:
+            pixel (array): centroid position in pixels of the new lines
+            wavelength (array): true wavelength of the new lines
+            order (array): order number of the new lines
+            weights (array): weights of the new lines, multiplying the rows of the least-squares problem
+
+        Returns:
+            array: indices assigned to the new lines
+        """
+        pixel, wavelength, order = np.atleast_1d(pixel), np.atleast_1d(wavelength), np.atleast_1d(order)
+        weights = np.ones(len(pixel)) if weights is None else np.atleast_1d(weights).astype(float)
+        indices = np.arange(len(self._pixel), len(self._pixel) + len(pixel))
+        self._pixel = np.concatenate([self._pixel, pixel])
+        self._wavelength = np.concatenate([self._wavelength, wavelength])
+        self._orders = np.concatenate([self._orders, order])
+        self._weights = np.concatenate([self._weights, weights])
+        self._active = np.concatenate([self._active, np.ones(len(pixel), dtype=bool)])
+        self._mask = np.concatenate([self._mask, np.zeros(len(pixel), dtype=bool)])
+        self._factor_mask = np.concatenate([self._factor_mask, np.zeros(len(pixel), dtype=bool)])
+        if self._domain() != self._order_domain:
+            self._build()
+        else:
+            self._design_matrix = np.concatenate([self._design_matrix, self._design(pixel, order)])
+            self._data = np.concatenate([self._data, wavelength * order])
+            self._update(indices)
+        return indices
+
+    def remove_lines(self, indices: np.array):
+        r"""Remove lines from the fit. The solution is not updated until :meth:`refit` is called.
+
+        Args:
+            indices (array): indices of the lines to be removed
+        """
+        indices = np.atleast_1d(indices)
+        indices = indices[self._active[indices]]
+        kept = indices[~self._factor_mask[indices]]
+        self._active[indices] = False
+        self._mask[indices] = False
+        self._factor_mask[indices] = False
+        if self._domain() != self._order_domain:
+            self._build()
+        else:
+            self._update(kept, sign=-1.)
+
+    def remove_order(self, order: int):
+        r"""Remove all the lines of an order. The solution is not updated until :meth:`refit` is called.
+        """
+        self.remove_lines(np.flatnonzero(self._active & (self._orders == order)))
+
+    def set_weights(self, indices: np.array, weights: np.array):
+        r"""Change the weights of some lines. The solution is not updated until :meth:`refit` is called.
+
+        Args:
+            indices (array): indices of the lines
+            weights (array): new weights, multiplying the rows of the least-squares problem
+        """
+        indices = np.atleast_1d(indices)
+        kept = self._kept()[indices]
+        old_weights = self._weights[indices][kept]
+        self._weights[indices] = weights
+        # add the lines with the new weights first, then remove them with the old weights
+        self._update(indices[kept])
+        self._update(indices[kept], sign=-1., weights=old_weights)
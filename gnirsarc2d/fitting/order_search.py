@@ -0,0 +1,177 @@
+"""Automatic selection of the degrees and of the function of the 2D wavelength solution.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from gnirsarc2d.fitting import arc2d
+
+__all__ = ['OrderSearchResult', 'search_fit_order']
+
+SPEC_DEGREES = [1, 2, 3, 4, 5, 6]
+ORDER_DEGREES = [1, 2, 3, 4, 5]
+CROSS_VALIDATIONS = ['order', 'kfold']
+CRITERIA = ['cv', 'bic', 'aic']
+
+# Basis and data shared by all the candidates evaluated in a process (set by `_init_shared`)
+_SHARED = {}
+
+
+class OrderSearchResult:
+    """Class containing the result of the search of the best 2D wavelength solution.
+
+    Attributes:
+        scores (list): one dictionary per candidate with `fit_function`, `fit_order_spec`, `fit_order_order`,
+            `n_used` (lines used to score the candidate), `rms` (Angstrom), `cv_rms` (cross-validated RMS in
+            Angstrom), `aic`, `bic`, and `degenerate` (True if the candidate cannot be cross validated: its scores
+            are then infinite)
+        best (dict): score of the selected candidate
+        fit2d (object): fit obtained with the selected candidate
+        mask (array): data rejected by the fit obtained with the selected candidate
+        reference_mask (array): lines rejected by the reference fit, excluded from the scores of all the candidates
+
+    """
+
+    def __init__(self, scores: list, best: dict, fit2d: object = None, mask: np.array = None,
+                 reference_mask: np.array = None):
+        self.scores = scores
+        self.best = best
+        self.fit2d = fit2d
+        self.mask = mask
+        self.reference_mask = reference_mask
+
+    def __str__(self):
+        lines = ['{:12s} {:>4s} {:>5s} {:>6s} {:>10s} {:>10s} {:>12s} {:>12s}'.format(
+            'function', 'spec', 'order', 'n_used', 'rms', 'cv_rms', 'aic', 'bic')]
+        for score in self.scores:
+            lines.append('{fit_function:12s} {fit_order_spec:4d} {fit_order_order:5d} {n_used:6d} {rms:10.4f} '
+                         '{cv_rms:10.4f} {aic:12.2f} {bic:12.2f}'.format(**score) +
+                         (' <- best' if score is self.best else ''))
+        return '\n'.join(lines)
+
+
+def _init_shared(shared: dict):
+    _SHARED.clear()
+    _SHARED.update(shared)
+
+
+def _score_candidate(candidate: tuple) -> dict:
+    fit_function, fit_order_spec, fit_order_order = candidate
+    data, all_orders, folds, good = _SHARED['data'], _SHARED['all_orders'], _SHARED['folds'], _SHARED['good']
+    # the basis of lower degree are the first columns of the tables computed for the highest degree
+    design = arc2d._combine_vander(_SHARED[fit_function]['spec'][:, :fit_order_spec + 1],
+                                   _SHARED[fit_function]['order'][:, :fit_order_order + 1])
+    n_coefficients, n_used = design.shape[1], int(good.sum())
+    score = {'fit_function': fit_function, 'fit_order_spec': fit_order_spec, 'fit_order_order': fit_order_order,
+             'n_used': n_used, 'rms': np.inf, 'cv_rms': np.inf, 'aic': np.inf, 'bic': np.inf, 'degenerate': False}
+    # leaving out an order, the remaining orders constrain at most a polynomial of degree n_orders - 2
+    if _SHARED['cross_validation'] == 'order' and fit_order_order >= len(np.unique(folds[good])) - 1:
+        score['degenerate'] = True
+        return score
+    if n_coefficients >= n_used:
+        return score
+    # all the candidates are scored on the same lines, those kept by the reference fit
+    coefficients = arc2d._least_squares(design[good], data[good])
+    resid_wl = (design[good] @ coefficients - data[good]) / all_orders[good]
+    rss = np.sum(resid_wl ** 2)
+    score['rms'] = float(np.sqrt(rss / n_used))
+    if rss > 0.:
+        score['aic'] = float(n_used * np.log(rss / n_used) + 2. * n_coefficients)
+        score['bic'] = float(n_used * np.log(rss / n_used) + n_coefficients * np.log(n_used))
+
+    cv_resid_wl = []
+    for fold in np.unique(folds[good]):
+        test = good & (folds == fold)
+        train = good & (folds != fold)
+        if train.sum() <= n_coefficients:
+            return score
+        cv_coefficients = arc2d._least_squares(design[train], data[train])
+        cv_resid_wl.append((design[test] @ cv_coefficients - data[test]) / all_orders[test])
+    score['cv_rms'] = float(np.sqrt(np.mean(np.concatenate(cv_resid_wl) ** 2)))
+    return score
+
+
+def search_fit_order(all_pixel: np.array, all_wavelength: np.array, all_orders: np.array, tot_pixel: float,
+                     spec_degrees: list = None, order_degrees: list = None, fit_functions: list = None,
+                     cross_validation: str = 'order', n_folds: int = 5, criterion: str = 'cv', sigma: float = 3.0,
+                     niter: int = 100, processes: int = None, seed: int = 0,
+                     reference_degrees: tuple = (3, 4)) -> object:
+    r"""Select the degrees and the function of the 2D wavelength solution by cross validation.
+
+    The misidentified lines are first rejected by a reference fit, obtained with :func:`arc2d.full_fit` and the
+    `reference_degrees`. All the candidates are then scored on the same lines, those kept by the reference fit, so
+    that their scores are comparable: a candidate cannot improve its score by rejecting more lines. The
+    cross-validated RMS is estimated leaving out one order at a time or with a k-fold split. With the
+    leave-one-order-out validation, the candidates with a degree in the order direction of at least the number of
+    orders minus one are degenerate (the orders left in each training set cannot constrain them), and they are
+    flagged and never selected. The 1D basis are computed only once for the highest degrees and shared by all the
+    candidates, which are evaluated in a pool of processes.
+
+    Args:
+        all_pixel (array): centroid position in pixels of the identified lines
+        all_wavelength (array): true wavelength of the identified lines
+        all_orders (array): order number where the line are identified lines
+        tot_pixel (int): size of the image in the spectral direction
+        spec_degrees (list): degrees along the spectral direction to be tested
+        order_degrees (list): degrees along the order direction to be tested
+        fit_functions (list): 2D functions to be tested
+        cross_validation (str): `order` for leave-one-order-out, `kfold` for a k-fold split
+        n_folds (int): number of folds for the k-fold cross validation
+        criterion (str): the best candidate has the lowest `cv` (cross-validated RMS), `aic`, or `bic`
+        sigma (float): sigma level for the rejection algorithm
+        niter (int): number of iterations for the rejection algorithm
+        processes (int): number of worker processes. If `None`, it is set to the number of CPUs
+        seed (int): seed of the random split for the k-fold cross validation
+        reference_degrees (tuple): degrees along the spectral and the order direction of the reference fit
+
+    Returns:
+        OrderSearchResult: scores of all the candidates and fit obtained with the best one
+    """
+    spec_degrees = SPEC_DEGREES if spec_degrees is None else spec_degrees
+    order_degrees = ORDER_DEGREES if order_degrees is None else order_degrees
+    fit_functions = arc2d.FIT_FUNCTIONS if fit_functions is None else fit_functions
+    if cross_validation not in CROSS_VALIDATIONS:
+        raise ValueError(r"cross validation not defined. Current possibilities are: {}".format(CROSS_VALIDATIONS))
+    if criterion not in CRITERIA:
+        raise ValueError(r"criterion not defined. Current possibilities are: {}".format(CRITERIA))
+
+    norm_pixel = all_pixel / float(tot_pixel - 1)
+    order_domain = (np.min(all_orders), np.max(all_orders))
+    if cross_validation == 'order':
+        folds = np.asarray(all_orders)
+    else:
+        folds = np.random.default_rng(seed).permutation(len(all_pixel)) % n_folds
+    _, reference_mask = arc2d.full_fit(all_pixel, all_wavelength, all_orders, tot_pixel=tot_pixel,
+                                       fit_order_spec=reference_degrees[0], fit_order_order=reference_degrees[1],
+                                       fit_function=fit_functions[0], sigma=sigma, niter=niter)
+    reference_mask = np.asarray(reference_mask, dtype=bool)
+    shared = {'data': all_wavelength * all_orders, 'all_orders': np.asarray(all_orders, dtype=float),
+              'folds': folds, 'good': ~reference_mask, 'cross_validation': cross_validation}
+    for fit_function in fit_functions:
+        shared[fit_function] = {
+            'spec': arc2d._vander_1d(arc2d._map_domain(norm_pixel, (0., 1.)), max(spec_degrees),
+                                     fit_function=fit_function),
+            'order': arc2d._vander_1d(arc2d._map_domain(np.asarray(all_orders, dtype=float), order_domain),
+                                      max(order_degrees), fit_function=fit_function)}
+    candidates = [(fit_function, fit_order_spec, fit_order_order) for fit_function in fit_functions
+                  for fit_order_spec in spec_degrees for fit_order_order in order_degrees]
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(candidates)))
+    if processes == 1:
+        _init_shared(shared)
+        scores = [_score_candidate(candidate) for candidate in candidates]
+    else:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_shared, initargs=(shared,)) as executor:
+            scores = list(executor.map(_score_candidate, candidates,
+                                       chunksize=max(1, len(candidates) // (4 * processes))))
+
+    key = 'cv_rms' if criterion == 'cv' else criterion
+    best = min(scores, key=lambda score: (score[key], score['bic']))
+    fit2d, mask = arc2d.full_fit(all_pixel, all_wavelength, all_orders, tot_pixel=tot_pixel,
+                                 fit_order_spec=best['fit_order_spec'], fit_order_order=best['fit_order_order'],
+                                 fit_function=best['fit_function'], sigma=sigma, niter=niter)
+    return OrderSearchResult(scores, best, fit2d=fit2d, mask=mask, reference_mask=reference_mask)
@@ -0,0 +1,97 @@
+"""Vectorized rejection of obviously misidentified lines before the 2D fit.
+"""
+
+import numpy as np
+
+__all__ = ['PrefilterResult', 'prefilter_lines']
+
+# Conversion between the units of the configuration table (micron) and of the line lists (Angstrom)
+MICRON_TO_ANGSTROM = 1.e4
+# Default margin around the nominal range of each order, as a fraction of the width of the range
+DEFAULT_MARGIN = 0.05
+# Default largest accepted difference in Angstrom between the wavelength measured by IRAF and the archive one
+DEFAULT_TOLERANCE = 10.
+
+
+class PrefilterResult:
+    """Class containing the lines kept and removed by :func:`prefilter_lines`.
+
+    Attributes:
+        keep (array): True for the lines that pass the prefilter
+        out_of_range (array): True for the lines whose archive wavelength is outside the range of their order
+        mismatch (array): True for the lines in the range of their order whose measured and archive wavelengths
+            disagree beyond the tolerance
+        order (array): order number of the lines
+
+    """
+
+    def __init__(self, out_of_range: np.array, mismatch: np.array, order: np.array):
+        self.out_of_range = out_of_range
+        self.mismatch = mismatch
+        self.keep = ~(out_of_range | mismatch)
+        self.order = order
+
+    def __str__(self):
+        return 'Prefilter: removed {} of {} lines ({} out of the order range, {} with measured and archive ' \
+               'wavelengths in disagreement)'.format(self.n_removed, len(self.keep), int(self.out_of_range.sum()),
+                                                      int(self.mismatch.sum()))
+
+    @property
+    def n_removed(self):
+        r"""Number of lines removed"""
+        return int(len(self.keep) - self.keep.sum())
+
+    def removed_per_order(self) -> dict:
+        r"""Number of lines removed in each order"""
+        orders, removed = np.unique(self.order[~self.keep], return_counts=True)
+        return {int(order): int(n_removed) for order, n_removed in zip(orders, removed)}
+
+    def apply(self, *arrays) -> tuple:
+        r"""Select the lines that pass the prefilter from arrays with one element per line.
+
+        Args:
+            *arrays: arrays to be filtered, e.g. pixel, wavelength, and order
+
+        Returns:
+            tuple: the filtered arrays
+        """
+        return tuple(np.asarray(array)[self.keep] for array in arrays)
+
+
+def prefilter_lines(wavelength_iraf: np.array, wavelength_archive: np.array, order: np.array,
+                    configuration: object, margin: float = DEFAULT_MARGIN,
+                    tolerance: float = DEFAULT_TOLERANCE) -> object:
+    r"""Flag the identified lines that are certainly wrong, so that they do not enter the 2D fit.
+
+    A line is flagged if:
+
+    - its archive wavelength is outside the nominal range of its order (`wavelength_nm_min`, `wavelength_nm_max`
+      in the configuration, in micron), enlarged by `margin` times the width of the range on both sides
+    - the wavelength measured by IRAF from the 1D solution at the position of the line and the archive wavelength
+      differ by more than `tolerance`
+
+    Args:
+        wavelength_iraf (array): wavelength of the lines measured by IRAF in Angstrom. If `None`, the second test
+            is skipped
+        wavelength_archive (array): archive (true) wavelength of the lines in Angstrom
+        order (array): order number of the lines
+        configuration (GnirsConfiguration): GNIRS configuration providing the range of each order. A `ValueError`
+            is raised if the range of some of the orders is not defined (see `GnirsConfiguration.wavelength_range`)
+        margin (float): margin around the nominal ranges, as a fraction of their width
+        tolerance (float): largest accepted difference in Angstrom between measured and archive wavelengths. If
+            `None`, the second test is skipped
+
+    Returns:
+        PrefilterResult: lines kept and removed
+    """
+    wavelength_archive, order = np.asarray(wavelength_archive), np.asarray(order)
+    wavelength_min, wavelength_max = configuration.wavelength_range(order)
+    width = (wavelength_max - wavelength_min) * MICRON_TO_ANGSTROM
+    wavelength_min = wavelength_min * MICRON_TO_ANGSTROM - margin * width
+    wavelength_max = wavelength_max * MICRON_TO_ANGSTROM + margin * width
+    out_of_range = ~((wavelength_archive >= wavelength_min) & (wavelength_archive <= wavelength_max))
+    if wavelength_iraf is None or tolerance is None:
+        mismatch = np.zeros(len(wavelength_archive), dtype=bool)
+    else:
+        mismatch = ~(np.abs(np.asarray(wavelength_iraf) - wavelength_archive) <= tolerance)
+    return PrefilterResult(out_of_range, mismatch & ~out_of_range, order)
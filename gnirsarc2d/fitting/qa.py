@@ -0,0 +1,110 @@
+"""Residuals and quality-assessment statistics of the 2D wavelength solution.
+"""
+
+import numpy as np
+
+__all__ = ['FitStatistics', 'residual_statistics']
+
+
+class FitStatistics:
+    """Class containing the residuals and the QA statistics of a 2D wavelength solution.
+
+    Per-order quantities are arrays with one element for each entry of `orders`, per-line quantities follow the
+    order of the input lines.
+
+    Attributes:
+        orders (array): order numbers
+        n_lines (array): number of lines in each order
+        n_rejected (array): number of lines rejected by the fit in each order
+        dwl (array): dispersion in each order in Angstrom/pixel
+        rms_order (array): RMS of the residuals of the lines used in the fit in each order in Angstrom
+        rms_order_pixel (array): RMS of the residuals of the lines used in the fit in each order in pixels
+        rms_global (float): RMS of the residuals of all the lines used in the fit in Angstrom
+        rms_global_pixel (float): RMS of the residuals of all the lines used in the fit in pixels
+        resid_wl (array): residual (model - true wavelength) of each line in Angstrom
+        resid_pixel (array): residual of each line in pixels
+
+    """
+
+    def __init__(self, orders: np.array, n_lines: np.array, n_rejected: np.array, dwl: np.array,
+                 rms_order: np.array, rms_order_pixel: np.array, rms_global: float, rms_global_pixel: float,
+                 resid_wl: np.array, resid_pixel: np.array):
+        self.orders = orders
+        self.n_lines = n_lines
+        self.n_rejected = n_rejected
+        self.dwl = dwl
+        self.rms_order = rms_order
+        self.rms_order_pixel = rms_order_pixel
+        self.rms_global = rms_global
+        self.rms_global_pixel = rms_global_pixel
+        self.resid_wl = resid_wl
+        self.resid_pixel = resid_pixel
+
+    def __str__(self):
+        return 'RMS={:.4f} Ang ({:.4f} pixel), {} of {} lines rejected'.format(
+            self.rms_global, self.rms_global_pixel, int(np.sum(self.n_rejected)), int(np.sum(self.n_lines)))
+
+    def to_dict(self, residuals: bool = False) -> dict:
+        r"""Convert the statistics into a dictionary of built-in python types (e.g. to be saved as JSON).
+
+        Args:
+            residuals (bool): include the per-line residuals
+
+        Returns:
+            dict: the statistics
+        """
+        keys = ['orders', 'n_lines', 'n_rejected', 'dwl', 'rms_order', 'rms_order_pixel', 'rms_global',
+                'rms_global_pixel']
+        if residuals:
+            keys += ['resid_wl', 'resid_pixel']
+        return {key: np.asarray(getattr(self, key)).tolist() for key in keys}
+
+
+def residual_statistics(fit2d: object, mask: np.array, all_pixel: np.array, all_wavelength: np.array,
+                        all_orders: np.array, tot_pixel: float) -> object:
+    r"""Compute the residuals and the QA statistics of a 2D wavelength solution.
+
+    The model is evaluated only once, on the lines and on the first and last pixel of each order, and all the
+    per-order statistics are obtained with grouped reductions.
+
+    .. note::
+        The wavelengths are assumed to be in Angstrom
+
+    Args:
+        fit2d (object): result of the fitting procedure
+        mask (array): data rejected by the fitting procedure
+        all_pixel (array): centroid position in pixels of the identified lines
+        all_wavelength (array): true wavelength of the identified lines
+        all_orders (array): order number where the line are identified lines
+        tot_pixel (int): size of the image in the spectral direction
+
+    Returns:
+        FitStatistics: residuals and statistics of the fit
+    """
+    mask = np.asarray(mask, dtype=bool)
+    orders, index_order = np.unique(all_orders, return_inverse=True)
+    n_orders, n_lines = len(orders), len(all_pixel)
+    tot_pixel_minus_1 = float(tot_pixel - 1)
+
+    # single evaluation of the model (wavelength times order number): lines, then the edges of each order
+    model = fit2d(np.concatenate([all_pixel / tot_pixel_minus_1, np.zeros(n_orders), np.ones(n_orders)]),
+                  np.concatenate([all_orders, orders, orders]))
+    wv_order_mod_resid, wv_order_mod_first, wv_order_mod_last = model[:n_lines], model[n_lines:n_lines + n_orders], \
+        model[n_lines + n_orders:]
+
+    dwl = (wv_order_mod_last - wv_order_mod_first) / orders / tot_pixel_minus_1
+    resid_wl = wv_order_mod_resid / all_orders - all_wavelength
+    resid_pixel = resid_wl / np.abs(dwl[index_order])
+
+    # grouped reductions over the lines used in the fit
+    good = ~mask
+    n_lines_order = np.bincount(index_order, minlength=n_orders)
+    n_good = np.bincount(index_order[good], minlength=n_orders)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_order = np.bincount(index_order[good], weights=resid_wl[good], minlength=n_orders) / n_good
+        deviation = resid_wl[good] - mean_order[index_order[good]]
+        rms_order = np.sqrt(np.bincount(index_order[good], weights=deviation ** 2, minlength=n_orders) / n_good)
+    return FitStatistics(orders=orders, n_lines=n_lines_order, n_rejected=n_lines_order - n_good, dwl=dwl,
+                         rms_order=rms_order, rms_order_pixel=rms_order / np.abs(dwl),
+                         rms_global=float(np.std(resid_wl[good])), rms_global_pixel=float(np.std(resid_pixel[good])),
+                         resid_wl=resid_wl, resid_pixel=resid_pixel)
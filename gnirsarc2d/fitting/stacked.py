@@ -0,0 +1,231 @@
+"""Fit many arcs at once, solving together the arcs that identified the same lines.
+"""
+
+import numpy as np
+
+from gnirsarc2d import profiling
+from gnirsarc2d.fitting import arc2d
+
+__all__ = ['group_line_lists', 'stacked_sigma_clip_fit', 'fit_stacked']
+
+
+def _line_set_order(wavelength: np.array, order: np.array) -> np.array:
+    r"""Indices sorting the lines of an arc by order number and archive wavelength"""
+    return np.lexsort((np.asarray(wavelength), np.asarray(order)))
+
+
+def group_line_lists(line_lists: list) -> list:
+    r"""Group the arcs that identified the same set of lines, i.e. the same archive wavelengths in the same orders.
+
+    The pixel positions of the lines are not considered, since they change from arc to arc (e.g. with the flexure
+    of the instrument), and neither is the sequence in which the lines are listed.
+
+    Args:
+        line_lists (list): (pixel, wavelength, order) arrays of each arc, with the archive wavelengths
+
+    Returns:
+        list: lists with the indices of the arcs in each group, in order of first appearance
+    """
+    groups = {}
+    for index, (_, wavelength, order) in enumerate(line_lists):
+        sort = _line_set_order(wavelength, order)
+        key = (np.ascontiguousarray(np.asarray(wavelength, dtype=np.float64)[sort]).tobytes(),
+               np.ascontiguousarray(np.asarray(order, dtype=np.int64)[sort]).tobytes())
+        groups.setdefault(key, []).append(index)
+    return list(groups.values())
+
+
+def _column_median(values: np.array, n_values: np.array) -> np.array:
+    r"""Median of each column of `values` ignoring the NaNs, `n_values` being the number of finite values"""
+    # NaNs are sorted at the end of each column
+    values = np.sort(values, axis=0)
+    lower = np.take_along_axis(values, ((n_values - 1) // 2)[np.newaxis, :], axis=0)[0]
+    upper = np.take_along_axis(values, (n_values // 2)[np.newaxis, :], axis=0)[0]
+    return 0.5 * (lower + upper)
+
+
+def _sigma_clip_masks(residuals: np.array, masks: np.array, sigma: float = 3.0, maxiters: int = 5) -> np.array:
+    r"""Vectorized :func:`arc2d._sigma_clip_mask` applied to each column of `residuals` and `masks`"""
+    kept = ~masks
+    n_sets = residuals.shape[1]
+    min_value, max_value = np.full(n_sets, -np.inf), np.full(n_sets, np.inf)
+    active = np.ones(n_sets, dtype=bool)
+    for _ in range(maxiters):
+        n_kept = kept.sum(axis=0)
+        active &= n_kept > 0
+        columns = np.flatnonzero(active)
+        if columns.size == 0:
+            break
+        values = np.where(kept[:, columns], residuals[:, columns], np.nan)
+        center, std = _column_median(values, n_kept[columns]), np.nanstd(values, axis=0)
+        min_value[columns], max_value[columns] = center - sigma * std, center + sigma * std
+        new_kept = kept[:, columns] & (values >= min_value[columns]) & (values <= max_value[columns])
+        # the columns whose kept points did not change are converged, and their limits are frozen
+        active[columns[new_kept.sum(axis=0) == n_kept[columns]]] = False
+        kept[:, columns] = new_kept
+    return masks | (residuals < min_value) | (residuals > max_value)
+
+
+def _solve_masked(design: np.array, data: np.array, masks: np.array) -> np.array:
+    r"""Least-squares solution of each column of `data` excluding its masked rows.
+
+    The normal equations of the (column-scaled) design matrix are built once for each distinct mask and all the
+    columns are solved with a single batched call. If some of the systems are singular, the columns are solved
+    individually with :func:`arc2d._least_squares`.
+    """
+    scale = np.sqrt((design * design).sum(axis=0))
+    scale[scale == 0.] = 1.
+    scaled_design = design / scale
+    # identify the distinct masks through their bit-packed rows
+    packed = np.ascontiguousarray(np.packbits(masks, axis=0).T)
+    _, first, inverse = np.unique(packed.view(np.dtype((np.void, packed.shape[1]))).ravel(), return_index=True,
+                                  return_inverse=True)
+    unique_masks = masks[:, first].T
+    good = ~unique_masks
+    normal = np.matmul(np.transpose(good[:, :, np.newaxis] * scaled_design, (0, 2, 1)), scaled_design)
+    rhs = (scaled_design.T @ np.where(masks, 0., data)).T
+    try:
+        coefficients = np.linalg.solve(normal[inverse.ravel()], rhs[:, :, np.newaxis])[:, :, 0].T
+    except np.linalg.LinAlgError:
+        coefficients = np.column_stack([arc2d._least_squares(scaled_design[~masks[:, column]],
+                                                             data[~masks[:, column], column])
+                                        for column in range(data.shape[1])])
+    return coefficients / scale[:, np.newaxis]
+
+
+def _solve_stacked(designs: np.array, data: np.array, masks: np.array) -> np.array:
+    r"""Least-squares solution of each column of `data` on its own design matrix, excluding its masked rows.
+
+    The normal equations of the (column-scaled) design matrices of shape (n_sets, n_points, n_coefficients) are
+    built and solved with batched calls. If some of the systems are singular, the columns are solved individually
+    with :func:`arc2d._least_squares`.
+    """
+    good = ~masks.T
+    scale = np.sqrt(np.einsum('spc,sp->sc', designs * designs, good))
+    scale[scale == 0.] = 1.
+    scaled_designs = designs / scale[:, np.newaxis, :]
+    weighted_designs = scaled_designs * good[:, :, np.newaxis]
+    normal = np.matmul(np.transpose(weighted_designs, (0, 2, 1)), scaled_designs)
+    rhs = np.einsum('spc,sp->sc', weighted_designs, data.T)
+    try:
+        coefficients = np.linalg.solve(normal, rhs[:, :, np.newaxis])[:, :, 0] / scale
+    except np.linalg.LinAlgError:
+        coefficients = np.array([arc2d._least_squares(designs[column][good[column]], data[good[column], column])
+                                 for column in range(data.shape[1])])
+    return coefficients.T
+
+
+def stacked_sigma_clip_fit(design: np.array, data: np.array, sigma: float = 3.0, niter: int = 100) -> tuple:
+    r"""Run :func:`arc2d.sigma_clip_fit` on several sets of data at once.
+
+    All the sets are advanced together, one rejection iteration at a time: the rejection is applied to all the sets
+    at once, and the masked least-squares problems are solved together through their normal equations. The sets
+    that converged are removed from the following iterations. Each set follows the same steps of
+    :func:`arc2d.sigma_clip_fit`, with results equal within rounding errors.
+
+    If the sets share the same design matrix (e.g. bootstrap replicates of the same lines), the first solution is
+    obtained with a single factorization and multiple right-hand sides, and the normal equations are built once
+    for each distinct mask (see :func:`_solve_masked`). Otherwise each set has its own design matrix (e.g. arcs
+    that identified the same lines at different pixels), and the systems are solved with batched calls (see
+    :func:`_solve_stacked`).
+
+    Args:
+        design (array): design matrix of shape (n_points, n_coefficients) shared by all the sets, or design matrix
+            of each set with shape (n_sets, n_points, n_coefficients)
+        data (array): values to be fitted, shape (n_points, n_sets)
+        sigma (float): sigma level for the rejection algorithm
+        niter (int): maximum number of iterations for the rejection algorithm
+
+    Returns:
+        coefficients, masks, iterations: coefficients with shape (n_coefficients, n_sets), masks of the rejected
+        points with shape (n_points, n_sets), and number of rejection iterations of each set.
+    """
+    n_sets = data.shape[1]
+    masks = np.zeros(data.shape, dtype=bool)
+    if design.ndim == 2:
+        coefficients = arc2d._least_squares(design, data)
+    else:
+        coefficients = _solve_stacked(design, data, masks)
+    iterations = np.zeros(n_sets, dtype=int)
+    active = np.arange(n_sets)
+    for _ in range(niter):
+        if active.size == 0:
+            break
+        iterations[active] += 1
+        if design.ndim == 2:
+            residuals = design @ coefficients[:, active] - data[:, active]
+        else:
+            residuals = np.einsum('spc,cs->ps', design[active], coefficients[:, active]) - data[:, active]
+        new_masks = _sigma_clip_masks(residuals, masks[:, active], sigma=sigma)
+        if design.ndim == 2:
+            coefficients[:, active] = _solve_masked(design, data[:, active], new_masks)
+        else:
+            coefficients[:, active] = _solve_stacked(design[active], data[:, active], new_masks)
+        converged = new_masks.sum(axis=0) == masks[:, active].sum(axis=0)
+        masks[:, active] = new_masks
+        active = active[~converged]
+    return coefficients, masks, iterations
+
+
+def fit_stacked(line_lists: list, tot_pixel: float, fit_order_spec: int = 3, fit_order_order: int = 4,
+                fit_function: str = 'legendre2d', sigma: float = 3.0, niter: int = 100,
+                rejection: str = 'sigma_clip', fit_infos: list = None, **fit_kwargs) -> list:
+    r"""Obtain the 2D wavelength solution of many arcs, fitting together the arcs with the same lines.
+
+    The arcs are grouped by the lines they identified with :func:`group_line_lists`. For each group, the design
+    matrices of all the arcs (each with its own pixel positions) are built with a single call and stacked, and the
+    arcs are fitted together with :func:`stacked_sigma_clip_fit`. Arcs with a unique set of lines, or with a
+    `rejection` other than `sigma_clip` or a `fitter` other than `native`, are fitted individually with
+    :func:`arc2d.full_fit`. The results are the same of :func:`arc2d.full_fit` with the native fitter.
+
+    Args:
+        line_lists (list): (pixel, wavelength, order) arrays of each arc, archive wavelengths in Angstrom
+        tot_pixel (int): size of the image in the spectral direction
+        fit_order_spec (int): order of the fitting along the spectral (pixel) direction for each order
+        fit_order_order (int): order of the fitting in the order direction
+        fit_function (str): 2D function to be used
+        sigma (float): sigma level for the rejection algorithm
+        niter (int): number of iterations for the rejection algorithm
+        rejection (str): rejection strategy (see :func:`arc2d.robust_fit`)
+        fit_infos (list): if provided, one dictionary per arc, filled with the `rejection` used and the number of
+            `iterations` as in :func:`arc2d.full_fit`
+        **fit_kwargs: additional keywords passed to :func:`arc2d.full_fit` for the arcs fitted individually
+
+    Returns:
+        list: (fit2d, mask) of each arc, in the same order of `line_lists`
+    """
+    results = [None] * len(line_lists)
+    for group in group_line_lists(line_lists):
+        if len(group) == 1 or rejection != 'sigma_clip' or fit_kwargs.get('fitter', 'native') != 'native':
+            for index in group:
+                pixel, wavelength, order = line_lists[index]
+                results[index] = arc2d.full_fit(pixel, wavelength, order, tot_pixel, fit_order_spec=fit_order_spec,
+                                                fit_order_order=fit_order_order, fit_function=fit_function,
+                                                sigma=sigma, niter=niter, rejection=rejection,
+                                                fit_info=None if fit_infos is None else fit_infos[index],
+                                                **fit_kwargs)
+            continue
+        # the lines of each arc are listed in the same sequence, so that the rows of the arcs correspond
+        sorts = [_line_set_order(line_lists[index][1], line_lists[index][2]) for index in group]
+        _, wavelength, order = line_lists[group[0]]
+        wavelength, order = np.asarray(wavelength)[sorts[0]], np.asarray(order)[sorts[0]]
+        order_domain = (np.min(order), np.max(order))
+        with profiling.stage('fit', fitter='stacked', rejection=rejection):
+            pixel = np.concatenate([np.asarray(line_lists[index][0], dtype=float)[sort]
+                                    for index, sort in zip(group, sorts)])
+            design = arc2d.design_matrix(pixel / float(tot_pixel - 1), np.tile(order, len(group)), fit_order_spec,
+                                         fit_order_order, order_domain, fit_function=fit_function)
+            design = design.reshape(len(group), len(order), -1)
+            data = np.repeat((wavelength * order)[:, np.newaxis], len(group), axis=1)
+            coefficients, masks, iterations = stacked_sigma_clip_fit(design, data, sigma=sigma, niter=niter)
+        profiling.count('rejection_iterations', int(iterations.sum()), fitter='stacked', rejection=rejection)
+        model_function2d = arc2d._init_model(fit_function, fit_order_spec, fit_order_order, order_domain)
+        for column, (index, sort) in enumerate(zip(group, sorts)):
+            fit2d = model_function2d.copy()
+            fit2d.parameters = coefficients[:, column]
+            mask = np.empty(len(sort), dtype=bool)
+            mask[sort] = masks[:, column]
+            results[index] = (fit2d, mask)
+            if fit_infos is not None:
+                fit_infos[index].update(rejection=rejection, iterations=int(iterations[column]))
+    return results
@@ -0,0 +1,276 @@
+"""Uncertainties of the 2D wavelength solution: covariance of the coefficients and per-pixel wavelength errors.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from gnirsarc2d import profiling
+from gnirsarc2d.fitting import arc2d, stacked, wavelength_map
+
+__all__ = ['UNCERTAINTY_METHODS', 'SolutionUncertainty', 'analytic_covariance', 'bootstrap_coefficients',
+           'jackknife_coefficients', 'solution_uncertainty', 'wavelength_uncertainty']
+
+UNCERTAINTY_METHODS = ['analytic', 'bootstrap', 'jackknife']
+
+# Default number of bootstrap resamples
+DEFAULT_RESAMPLES = 1000
+# Number of bootstrap resamples solved at once
+DEFAULT_CHUNK_SIZE = 100
+
+
+class SolutionUncertainty:
+    """Class containing the uncertainty of a 2D wavelength solution.
+
+    The coefficients refer to the fitted quantity, i.e. the wavelength times the order number, with the ordering of
+    the `parameters` of the astropy model (see :func:`arc2d.design_matrix`).
+
+    Attributes:
+        method (str): method used to estimate the uncertainty, one of `UNCERTAINTY_METHODS`
+        covariance (array): covariance of the coefficients, shape (n_coefficients, n_coefficients)
+        samples (array): coefficients of each bootstrap resample or jackknife replicate, shape
+            (n_samples, n_coefficients). `None` for the analytic method
+        residual_std (float): standard deviation of the residuals of the lines used in the fit, in Angstrom times
+            the order number
+
+    """
+
+    def __init__(self, method: str, covariance: np.array, samples: np.array = None, residual_std: float = None):
+        self.method = method
+        self.covariance = covariance
+        self.samples = samples
+        self.residual_std = residual_std
+
+    def __str__(self):
+        n_samples = '' if self.samples is None else ', {} samples'.format(len(self.samples))
+        return 'SolutionUncertainty: {} method{}'.format(self.method, n_samples)
+
+    @property
+    def coefficient_errors(self):
+        r"""Standard deviation of each coefficient"""
+        return np.sqrt(np.diag(self.covariance))
+
+    def wavelength_uncertainty(self, fit2d: object, tot_pixel: int, orders: list, dtype: type = np.float64,
+                               chunk_size: int = None) -> np.array:
+        r"""Wavelength uncertainty of every pixel of every order (see :func:`wavelength_uncertainty`)"""
+        return wavelength_uncertainty(fit2d, self.covariance, tot_pixel, orders, dtype=dtype, chunk_size=chunk_size)
+
+
+def _design_from_model(fit2d: object, all_pixel: np.array, all_orders: np.array, tot_pixel: int) -> np.array:
+    r"""Design matrix of the lines for the model `fit2d`, with the same normalization used by :func:`arc2d.full_fit`
+    """
+    fit_function = wavelength_map._fit_function_from_model(fit2d)
+    norm_pixel = np.asarray(all_pixel, dtype=float) / float(tot_pixel - 1)
+    return arc2d.design_matrix(norm_pixel, all_orders, fit2d.x_degree, fit2d.y_degree, tuple(fit2d.y_domain),
+                               fit_function=fit_function)
+
+
+def analytic_covariance(design: np.array, data: np.array, coefficients: np.array, mask: np.array = None) -> tuple:
+    r"""Covariance of the least-squares coefficients from the design matrix of the final fit.
+
+    The covariance is `s^2 (X^T X)^-1`, where X contains the rows of the lines used in the fit and `s^2` is the
+    variance of their residuals, corrected for the number of degrees of freedom. The normal matrix is inverted after
+    scaling its columns, as done in :func:`arc2d._least_squares`.
+
+    Args:
+        design (array): design matrix of shape (n_points, n_coefficients)
+        data (array): fitted values
+        coefficients (array): coefficients of the fit
+        mask (array): mask of the rejected points (True = rejected)
+
+    Returns:
+        covariance, residual_std: covariance of the coefficients and standard deviation of the residuals
+    """
+    good = np.ones(len(data), dtype=bool) if mask is None else ~np.asarray(mask, dtype=bool)
+    good_design = design[good]
+    residuals = good_design @ coefficients - data[good]
+    n_dof = good_design.shape[0] - good_design.shape[1]
+    if n_dof <= 0:
+        raise ValueError('{} lines are not enough to estimate the uncertainty of {} coefficients'.format(
+            good_design.shape[0], good_design.shape[1]))
+    residual_std = np.sqrt(np.sum(residuals ** 2) / n_dof)
+    scale = np.sqrt((good_design * good_design).sum(axis=0))
+    scale[scale == 0.] = 1.
+    scaled_design = good_design / scale
+    inverse_normal = np.linalg.pinv(scaled_design.T @ scaled_design)
+    covariance = residual_std ** 2 * inverse_normal / np.outer(scale, scale)
+    return covariance, residual_std
+
+
+def _solve_weighted(design: np.array, data: np.array, weights: np.array) -> np.array:
+    r"""Weighted least-squares solutions of `data` for each row of `weights` (shape (n_sets, n_points)).
+
+    All the normal equations are built with two matrix products and solved with a single batched call. If some of
+    them are singular, the sets are solved individually with :func:`arc2d._least_squares`.
+    """
+    n_coefficients = design.shape[1]
+    scale = np.sqrt((design * design).sum(axis=0))
+    scale[scale == 0.] = 1.
+    scaled_design = design / scale
+    outer = (scaled_design[:, :, np.newaxis] * scaled_design[:, np.newaxis, :]).reshape(len(design), -1)
+    normal = (weights @ outer).reshape(len(weights), n_coefficients, n_coefficients)
+    rhs = weights @ (scaled_design * data[:, np.newaxis])
+    try:
+        coefficients = np.linalg.solve(normal, rhs[:, :, np.newaxis])[:, :, 0]
+    except np.linalg.LinAlgError:
+        coefficients = np.vstack([arc2d._least_squares(scaled_design, data, weights=np.sqrt(set_weights))
+                                  for set_weights in weights])
+    return coefficients / scale
+
+
+def _bootstrap_chunk(arguments: tuple) -> np.array:
+    design, data, n_resamples, seed = arguments
+    rng = np.random.default_rng(seed)
+    # a resample is described by the number of times each line is drawn, i.e. by its weights
+    counts = rng.multinomial(len(data), np.full(len(data), 1. / len(data)), size=n_resamples)
+    return _solve_weighted(design, data, counts.astype(float))
+
+
+def bootstrap_coefficients(design: np.array, data: np.array, mask: np.array = None,
+                           n_resamples: int = DEFAULT_RESAMPLES, seed: int = 0, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                           processes: int = 1) -> np.array:
+    r"""Coefficients of the least-squares fit of bootstrap resamples of the lines used in the fit.
+
+    The lines are drawn with replacement, and each resample is solved as a weighted least-squares problem whose
+    weights are the number of times each line was drawn. The rejection is not repeated: the resamples are drawn from
+    the lines kept by the final fit. The resamples are solved `chunk_size` at a time with batched normal equations,
+    and the chunks can be distributed on a pool of `processes`. Each chunk has its own random stream derived from
+    `seed`, so that the result does not depend on the number of processes.
+
+    Args:
+        design (array): design matrix of shape (n_points, n_coefficients)
+        data (array): fitted values
+        mask (array): mask of the rejected points (True = rejected)
+        n_resamples (int): number of bootstrap resamples
+        seed (int): seed of the random number generator
+        chunk_size (int): number of resamples solved at once
+        processes (int): number of worker processes. If `None`, the number of CPUs is used
+
+    Returns:
+        array: coefficients of each resample, shape (n_resamples, n_coefficients)
+    """
+    good = np.ones(len(data), dtype=bool) if mask is None else ~np.asarray(mask, dtype=bool)
+    good_design, good_data = design[good], data[good]
+    sizes = [min(chunk_size, n_resamples - start) for start in range(0, n_resamples, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    arguments = [(good_design, good_data, size, chunk_seed) for size, chunk_seed in zip(sizes, seeds)]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(arguments)))
+    if processes == 1:
+        return np.vstack([_bootstrap_chunk(argument) for argument in arguments])
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return np.vstack(list(executor.map(_bootstrap_chunk, arguments)))
+
+
+def jackknife_coefficients(design: np.array, data: np.array, groups: np.array, mask: np.array = None) -> tuple:
+    r"""Coefficients of the least-squares fits that leave out one group of lines (e.g. one order) at a time.
+
+    All the replicates are solved together with :func:`stacked._solve_masked`. When the order direction of the
+    model has as many coefficients as orders, leaving out an order leaves the model unconstrained, and the
+    replicates (and the resulting uncertainty) are dominated by the extrapolation to the missing order.
+
+    Args:
+        design (array): design matrix of shape (n_points, n_coefficients)
+        data (array): fitted values
+        groups (array): group of each point, e.g. the order numbers
+        mask (array): mask of the rejected points (True = rejected)
+
+    Returns:
+        samples, group_values: coefficients of each replicate, shape (n_groups, n_coefficients), and the group left
+        out by each replicate
+    """
+    fixed_mask = np.zeros(len(data), dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+    groups = np.asarray(groups)
+    group_values = np.unique(groups[~fixed_mask])
+    if len(group_values) < 2:
+        raise ValueError('at least two groups are needed for the jackknife, {} given'.format(len(group_values)))
+    masks = fixed_mask[:, np.newaxis] | (groups[:, np.newaxis] == group_values[np.newaxis, :])
+    data = np.repeat(np.asarray(data, dtype=float)[:, np.newaxis], len(group_values), axis=1)
+    return stacked._solve_masked(design, data, masks).T, group_values
+
+
+def solution_uncertainty(fit2d: object, mask: np.array, all_pixel: np.array, all_wavelength: np.array,
+                         all_orders: np.array, tot_pixel: int, method: str = 'analytic',
+                         n_resamples: int = DEFAULT_RESAMPLES, seed: int = 0, processes: int = 1) -> object:
+    r"""Estimate the uncertainty of the coefficients of a 2D wavelength solution obtained with :func:`arc2d.full_fit`.
+
+    The design matrix is rebuilt from the model, and the lines rejected by the fit (`mask`) are excluded. With the
+    `huber` and `tukey` rejections the final weights of the lines are not used, so the uncertainties are those of
+    the unweighted fit of the kept lines.
+
+    - `analytic`: covariance from the design matrix of the final fit (see :func:`analytic_covariance`)
+    - `bootstrap`: sample covariance of `n_resamples` bootstrap fits (see :func:`bootstrap_coefficients`)
+    - `jackknife`: jackknife covariance of the fits that leave out one order at a time
+      (see :func:`jackknife_coefficients`)
+
+    Args:
+        fit2d (object): result of the fitting procedure (see :func:`arc2d.full_fit`)
+        mask (array): mask of the rejected lines
+        all_pixel (array): centroid position in pixels of the identified lines
+        all_wavelength (array): true wavelength of the identified lines
+        all_orders (array): order number where the line are identified lines
+        tot_pixel (int): size of the image in the spectral direction
+        method (str): method used to estimate the uncertainty
+        n_resamples (int): number of bootstrap resamples
+        seed (int): seed of the random number generator of the bootstrap
+        processes (int): number of worker processes of the bootstrap
+
+    Returns:
+        SolutionUncertainty: covariance of the coefficients and, for the resampling methods, the samples
+    """
+    if method not in UNCERTAINTY_METHODS:
+        raise ValueError(r"uncertainty method not defined. Current possibilities are: {}".format(UNCERTAINTY_METHODS))
+    all_orders = np.asarray(all_orders)
+    design = _design_from_model(fit2d, all_pixel, all_orders, tot_pixel)
+    data = np.asarray(all_wavelength, dtype=float) * all_orders
+    coefficients = np.asarray(fit2d.parameters, dtype=float)
+    with profiling.stage('uncertainty', method=method):
+        covariance, residual_std = analytic_covariance(design, data, coefficients, mask=mask)
+        samples = None
+        if method == 'bootstrap':
+            samples = bootstrap_coefficients(design, data, mask=mask, n_resamples=n_resamples, seed=seed,
+                                             processes=processes)
+            covariance = np.cov(samples, rowvar=False)
+        elif method == 'jackknife':
+            samples, _ = jackknife_coefficients(design, data, all_orders, mask=mask)
+            n_samples = len(samples)
+            deviations = samples - samples.mean(axis=0)
+            covariance = (n_samples - 1.) / n_samples * deviations.T @ deviations
+    return SolutionUncertainty(method, covariance, samples=samples, residual_std=residual_std)
+
+
+def wavelength_uncertainty(fit2d: object, covariance: np.array, tot_pixel: int, orders: list,
+                           dtype: type = np.float64, chunk_size: int = None) -> np.array:
+    r"""Propagate the covariance of the coefficients to the wavelength of every pixel of every order.
+
+    The variance at (pixel, order) is `b^T C b`, with `b` the row of the design matrix divided by the order number.
+    The model is separable, so the covariance is first contracted with the basis of the orders (see
+    :class:`wavelength_map.WavelengthMap`), and only a small product per pixel remains.
+
+    Args:
+        fit2d (object): result of the fitting procedure (see :func:`arc2d.full_fit`)
+        covariance (array): covariance of the coefficients (see :class:`SolutionUncertainty`)
+        tot_pixel (int): size of the image in the spectral direction
+        orders (list): order numbers, e.g. `GnirsConfiguration.order["number"]`
+        dtype (type): data type of the output map
+        chunk_size (int): number of pixels along the spectral direction computed at once
+
+    Returns:
+        array: standard deviation of the wavelength in Angstrom, shape (len(orders), tot_pixel)
+    """
+    basis = wavelength_map.WavelengthMap(fit2d, tot_pixel, orders)
+    n_order, n_spec = basis.basis_order.shape[1], basis.basis_spec.shape[1]
+    covariance = np.asarray(covariance).reshape(n_order, n_spec, n_order, n_spec)
+    # contract the order part: shape (n_orders, n_spec, n_spec)
+    order_covariance = np.einsum('oj,jikl,ok->oil', basis.basis_order, covariance, basis.basis_order)
+    out = np.empty(basis.shape, dtype=dtype)
+    if chunk_size is None:
+        chunk_size = basis.tot_pixel
+    for start in range(0, basis.tot_pixel, chunk_size):
+        end = min(start + chunk_size, basis.tot_pixel)
+        basis_spec = basis.basis_spec[start:end]
+        variance = np.einsum('xi,oil,xl->ox', basis_spec, order_covariance, basis_spec, optimize=True)
+        out[:, start:end] = np.sqrt(np.clip(variance, 0., None))
+    return out
@@ -0,0 +1,206 @@
+"""Watch an IRAF database directory and refit the arcs whose identify files are created or modified.
+"""
+
+import collections
+import fnmatch
+import os
+import time
+
+from gnirsarc2d.fitting import batch
+from gnirsarc2d.io import cache, read_iraf_database, summary
+
+__all__ = ['ArcWatcher']
+
+# Seconds without changes to the files of an arc before it is refitted
+DEFAULT_DEBOUNCE = 2.
+# Seconds between two scans of the database directory
+DEFAULT_POLL_INTERVAL = 1.
+# Maximum number of arcs waiting to be refitted
+DEFAULT_MAX_QUEUE = 16
+
+
+class ArcWatcher:
+    """Class that polls a database directory and refits the arcs whose `idFILENAME_SLITNUMBER_` files change.
+
+    The directory is scanned with `os.scandir`, and a file is considered changed when its modification time or its
+    size differ from the previous scan. The changes are grouped by root filename, and an arc is queued only once
+    its files have not changed for `debounce` seconds, so that a burst of files written by the pipeline triggers a
+    single refit. An arc is never queued twice, and at most `max_queue` arcs wait to be refitted: the others stay
+    pending and are queued by the following polls. The parsed features are kept in a `MemoryIdentifyCache` (or in an
+    `IdentifyCache` in `cache_directory`, if provided), so that only the slit files that changed are parsed again.
+
+    For each refitted arc, the wavelength solution (`root_filename.fits`, see `gnirsarc2d.io.solution`) and the
+    summary of the fit with the QA statistics (`root_filename_summary.json` or `.ecsv`, see `gnirsarc2d.io.summary`)
+    are written in `output_directory`, plus the plot of the fit if requested and a row of the `summary_table`. The
+    errors raised while writing these files are stored in the `output_error` and `plot_error` attributes of the
+    result, so that a full disk or a broken plot do not stop the watcher.
+
+    Attributes:
+        database_directory (str): IRAF database directory
+        output_directory (str): directory where the solutions and the QA files are written
+        configuration (str): name of the GNIRS configuration
+        pattern (str): glob-like pattern of the identify files to be watched
+        debounce (float): seconds without changes before an arc is refitted
+        max_queue (int): maximum number of arcs waiting to be refitted
+        plot_format (str): format of the plots, `None` to skip them
+        summary_format (str): format of the summary of each arc, `json` or `ecsv`
+        summary_table (str): if provided, a row for each refit is appended to this ECSV table
+        use_prefilter (bool): remove the misidentified lines before the fit (see `prefilter.prefilter_lines`)
+        fit_kwargs (dict): additional keywords passed to :func:`arc2d.full_fit`
+        identify_cache (MemoryIdentifyCache or IdentifyCache): cache of the parsed features
+        queue (deque): root filenames waiting to be refitted
+
+    """
+
+    def __init__(self, database_directory: str, output_directory: str = None, configuration: str = '32/mmSB',
+                 pattern: str = 'id*', debounce: float = DEFAULT_DEBOUNCE, max_queue: int = DEFAULT_MAX_QUEUE,
+                 plot_format: str = None, summary_format: str = 'json', summary_table: str = None,
+                 cache_directory: str = None, use_prefilter: bool = False, refit_existing: bool = False,
+                 **fit_kwargs):
+        r"""Instantiate the class ArcWatcher
+
+        Args:
+            cache_directory (str): if provided, the parsed features are cached on disk in this directory (see
+                `IdentifyCache`) instead of in memory
+            refit_existing (bool): if True, the arcs already present in the directory are refitted by the first
+                poll. Otherwise only the files created or modified after the first scan are considered
+        """
+        if summary_format not in summary.SUMMARY_FORMATS:
+            raise ValueError(r"summary format not defined. Current possibilities are: {}".format(
+                summary.SUMMARY_FORMATS))
+        self.database_directory = database_directory
+        self.output_directory = database_directory if output_directory is None else output_directory
+        self.configuration = configuration
+        self.pattern = pattern
+        self.debounce = debounce
+        self.max_queue = max_queue
+        self.plot_format = plot_format
+        self.summary_format = summary_format
+        self.summary_table = summary_table
+        self.use_prefilter = use_prefilter
+        self.fit_kwargs = fit_kwargs
+        if cache_directory is None:
+            self.identify_cache = cache.MemoryIdentifyCache()
+        else:
+            self.identify_cache = cache.IdentifyCache(cache_directory)
+        self.queue = collections.deque()
+        # time of the last change of the files of each arc not yet queued
+        self._pending = {}
+        self._snapshot = {} if refit_existing else self.scan()
+        os.makedirs(self.output_directory, exist_ok=True)
+
+    def __str__(self):
+        return 'ArcWatcher: {} ({} pending, {} queued)'.format(self.database_directory, len(self._pending),
+                                                               len(self.queue))
+
+    def scan(self) -> dict:
+        r"""Status of the identify files in the database directory.
+
+        Returns:
+            dict: (modification time in ns, size) of each identify file, keyed by file name
+        """
+        snapshot = {}
+        with os.scandir(self.database_directory) as entries:
+            for entry in entries:
+                if not (fnmatch.fnmatchcase(entry.name, self.pattern) and
+                        read_iraf_database.IDENTIFY_FILE_PATTERN.match(entry.name)):
+                    continue
+                try:
+                    status = entry.stat()
+                except FileNotFoundError:
+                    continue
+                snapshot[entry.name] = (status.st_mtime_ns, status.st_size)
+        return snapshot
+
+    def poll(self, now: float = None) -> list:
+        r"""Scan the database directory and queue the arcs that are ready to be refitted.
+
+        Args:
+            now (float): current time as given by `time.monotonic`
+
+        Returns:
+            list: root filenames added to the queue
+        """
+        now = time.monotonic() if now is None else now
+        snapshot = self.scan()
+        changed = {name for name, status in snapshot.items() if self._snapshot.get(name) != status}
+        changed.update(set(self._snapshot) - set(snapshot))
+        self._snapshot = snapshot
+        for name in changed:
+            self._pending[read_iraf_database.IDENTIFY_FILE_PATTERN.match(name).group(1)] = now
+        queued = []
+        for root_filename, last_change in sorted(self._pending.items(), key=lambda item: item[1]):
+            if len(self.queue) >= self.max_queue:
+                break
+            if now - last_change < self.debounce or root_filename in self.queue:
+                continue
+            del self._pending[root_filename]
+            self.queue.append(root_filename)
+            queued.append(root_filename)
+        return queued
+
+    def refit(self, root_filename: str) -> object:
+        r"""Fit an arc and write its solution, summary, and plot.
+
+        The errors raised while writing the outputs or the plot are caught and stored in the `output_error` and
+        `plot_error` attributes of the result.
+
+        Args:
+            root_filename (str): root filename of the arc
+
+        Returns:
+            ArcFitResult: result of the fit
+        """
+        result = batch.fit_arc(self.database_directory, root_filename, configuration=self.configuration,
+                               use_prefilter=self.use_prefilter, identify_cache=self.identify_cache,
+                               **self.fit_kwargs)
+        if not result.success:
+            return result
+        if self.summary_table is None:
+            batch._write_outputs(result, self.configuration, self.output_directory, self.summary_format)
+        else:
+            try:
+                with summary.SummaryTableWriter(self.summary_table) as table_writer:
+                    batch._write_outputs(result, self.configuration, self.output_directory, self.summary_format,
+                                         table_writer)
+            except Exception as error:
+                result.output_error = '{}: {}'.format(type(error).__name__, error)
+        if self.plot_format is not None:
+            try:
+                batch.plot_arc(result, configuration=self.configuration, plot_directory=self.output_directory,
+                               plot_format=self.plot_format)
+            except Exception as error:
+                result.plot_error = '{}: {}'.format(type(error).__name__, error)
+        return result
+
+    def run(self, poll_interval: float = DEFAULT_POLL_INTERVAL, timeout: float = None, max_refits: int = None,
+            callback: object = print) -> int:
+        r"""Poll the directory and refit the arcs until interrupted (e.g. with Ctrl+C).
+
+        The modules and the parsed features stay in memory between refits.
+
+        Args:
+            poll_interval (float): seconds between two scans of the directory
+            timeout (float): stop after this number of seconds
+            max_refits (int): stop after this number of refits
+            callback (object): function called with each `ArcFitResult`
+
+        Returns:
+            int: number of refits performed
+        """
+        start, n_refits = time.monotonic(), 0
+        try:
+            while True:
+                self.poll()
+                while self.queue:
+                    result = self.refit(self.queue.popleft())
+                    n_refits += 1
+                    if callback is not None:
+                        callback(result)
+                    if max_refits is not None and n_refits >= max_refits:
+                        return n_refits
+                if timeout is not None and time.monotonic() - start >= timeout:
+                    return n_refits
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            return n_refits
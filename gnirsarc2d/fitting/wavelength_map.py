@@ -0,0 +1,115 @@
+"""Fast evaluation of a 2D wavelength solution on the full detector grid.
+"""
+
+import numpy as np
+
+from gnirsarc2d.fitting import arc2d
+
+__all__ = ['WavelengthMap', 'wavelength_map']
+
+
+def _fit_function_from_model(fit2d: object) -> str:
+    # astropy models are identified by their class, `WavelengthSolution` objects store the function name
+    fit_function = getattr(fit2d, 'fit_function', type(fit2d).__name__.lower())
+    if fit_function not in arc2d.FIT_FUNCTIONS:
+        raise ValueError(r"fitting function not defined. Current possibilities are: {}".format(arc2d.FIT_FUNCTIONS))
+    return fit_function
+
+
+class WavelengthMap:
+    """Class that evaluates a `Legendre2D`/`Chebyshev2D` wavelength solution as a product of 1D basis tables.
+
+    The model is separable: the value at (pixel, order) is `basis_order @ coefficients @ basis_spec.T`. The 1D
+    basis tables are computed only once, so that the wavelength of every pixel of every order is obtained with a
+    small matrix product instead of a call to the astropy model.
+
+    Attributes:
+        orders (array): order numbers, one row of the map for each of them
+        tot_pixel (int): size of the image in the spectral direction
+        basis_spec (array): basis evaluated on all the pixels, shape (tot_pixel, fit_order_spec + 1)
+        basis_order (array): basis evaluated on all the orders, shape (len(orders), fit_order_order + 1)
+        coefficients (array): coefficients of the model, shape (fit_order_order + 1, fit_order_spec + 1)
+
+    """
+
+    def __init__(self, fit2d: object, tot_pixel: int, orders: list):
+        r"""Instantiate the class WavelengthMap
+
+        Args:
+            fit2d (object): `Legendre2D`/`Chebyshev2D` model, or `gnirsarc2d.io.solution.WavelengthSolution`
+            tot_pixel (int): size of the image in the spectral direction
+            orders (list): order numbers
+        """
+        fit_function = _fit_function_from_model(fit2d)
+        self.orders = np.asarray(orders)
+        self.tot_pixel = int(tot_pixel)
+        norm_pixel = np.arange(self.tot_pixel) / float(self.tot_pixel - 1)
+        self.basis_spec = arc2d._vander_1d(arc2d._map_domain(norm_pixel, fit2d.x_domain, fit2d.x_window),
+                                           fit2d.x_degree, fit_function=fit_function)
+        self.basis_order = arc2d._vander_1d(arc2d._map_domain(self.orders.astype(float), fit2d.y_domain,
+                                                              fit2d.y_window),
+                                            fit2d.y_degree, fit_function=fit_function)
+        # the fit is performed on wavelength times order number: fold the division by the order in the basis
+        self.basis_order = self.basis_order / self.orders[:, np.newaxis]
+        self.coefficients = np.asarray(fit2d.parameters).reshape(fit2d.y_degree + 1, fit2d.x_degree + 1)
+
+    @property
+    def shape(self):
+        r"""Shape of the wavelength map (number of orders, tot_pixel)"""
+        return len(self.orders), self.tot_pixel
+
+    def evaluate(self, dtype: type = np.float64, chunk_size: int = None, out: np.array = None) -> np.array:
+        r"""Evaluate the wavelength of every pixel of every order.
+
+        Args:
+            dtype (type): data type of the output map (e.g. `np.float32` to halve the memory)
+            chunk_size (int): if provided, the map is computed in blocks of `chunk_size` pixels along the
+                spectral direction to limit the size of the temporary arrays
+            out (array): array (or memory map) of shape `shape` where the result is stored
+
+        Returns:
+            array: wavelength map of shape (number of orders, tot_pixel)
+        """
+        if out is None:
+            out = np.empty(self.shape, dtype=dtype)
+        # the order part is small, combine it with the coefficients only once
+        order_coefficients = self.basis_order @ self.coefficients
+        if chunk_size is None:
+            chunk_size = self.tot_pixel
+        for start in range(0, self.tot_pixel, chunk_size):
+            end = min(start + chunk_size, self.tot_pixel)
+            out[:, start:end] = order_coefficients @ self.basis_spec[start:end].T
+        return out
+
+    def to_npy(self, filename: str, dtype: type = np.float32, chunk_size: int = 256) -> np.array:
+        r"""Write the wavelength map in a `.npy` file that can be memory-mapped with `np.load(..., mmap_mode='r')`.
+
+        Args:
+            filename (str): name of the output file
+            dtype (type): data type of the output map
+            chunk_size (int): number of pixels along the spectral direction computed at once
+
+        Returns:
+            array: the memory-mapped wavelength map
+        """
+        out = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=self.shape)
+        self.evaluate(chunk_size=chunk_size, out=out)
+        out.flush()
+        return out
+
+
+def wavelength_map(fit2d: object, tot_pixel: int, orders: list, dtype: type = np.float64,
+                   chunk_size: int = None) -> np.array:
+    r"""Evaluate a 2D wavelength solution on all the pixels of all the orders.
+
+    Args:
+        fit2d (object): result of the fitting procedure (see :func:`arc2d.full_fit`)
+        tot_pixel (int): size of the image in the spectral direction
+        orders (list): order numbers, e.g. `GnirsConfiguration.order["number"]`
+        dtype (type): data type of the output map
+        chunk_size (int): number of pixels along the spectral direction computed at once
+
+    Returns:
+        array: wavelength map of shape (len(orders), tot_pixel)
+    """
+    return WavelengthMap(fit2d, tot_pixel, orders).evaluate(dtype=dtype, chunk_size=chunk_size)
@@ -1,20 +1,91 @@
 
-__all__ = ['GnirsConfiguration']
+import json
+import os
 
-CONFIGURATION_NAMES = [None, '32/mmSB']
+__all__ = ['GnirsConfiguration', 'get_configuration']
 
+# The supported setups are listed in data/configurations.json, e.g.:
 # 32/mmSB_G5533 setup, covering XYJHK with short blue camera
-# 10/mmLBSX_G5532 setup, covering YJHK with the long blue camera and SXD prism
+# 10/mmLBSX_G5532 setup, covering YJHK with the long blue camera: its orders and detector size are not defined yet
+CONFIGURATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'configurations.json')
+
+with open(CONFIGURATION_FILE, 'r') as _f:
+    _CONFIGURATION_TABLE = json.load(_f)['configurations']
+
+CONFIGURATION_NAMES = [None] + [record['name'] for record in _CONFIGURATION_TABLE]
+
+# Registry of the configurations with their lookup arrays, built the first time it is needed. numpy is imported
+# only at that point, to keep the startup of the scripts fast
+_REGISTRY = None
+# Instances returned by `get_configuration`
+_INSTANCES = {}
+
+
+def _load_registry() -> dict:
+    r"""Precompute the lookup arrays of each configuration in the table.
+
+    Returns:
+        dict: for each configuration name, the properties in the table plus the read-only arrays `slit_to_order`
+        (order number of each slit number, -1 if not used), `order_wavelength_min` and `order_wavelength_max`
+        (range in micron of each order number, NaN if not present). The configurations without orders in the table
+        have no slit and no wavelength range
+    """
+    global _REGISTRY
+    if _REGISTRY is None:
+        import numpy as np
+        registry = {None: {'name': None, 'mode': None, 'grating': None, 'camera': None, 'prism': None, 'order': {},
+                           'rows': None, 'cols': None, 'slit_to_order': np.full(1, -1),
+                           'order_wavelength_min': np.full(1, np.nan), 'order_wavelength_max': np.full(1, np.nan)}}
+        for record in _CONFIGURATION_TABLE:
+            order = record['order']
+            if not order.get('number'):
+                registry[record['name']] = dict(registry[None], **record)
+                continue
+            number, slit = np.array(order['number'], dtype=int), np.array(order['slit'], dtype=int)
+            slit_to_order = np.full(slit.max() + 1, -1)
+            slit_to_order[slit] = number
+            order_wavelength_min = np.full(number.max() + 1, np.nan)
+            order_wavelength_min[number] = order['wavelength_nm_min']
+            order_wavelength_max = np.full(number.max() + 1, np.nan)
+            order_wavelength_max[number] = order['wavelength_nm_max']
+            for lookup in [slit_to_order, order_wavelength_min, order_wavelength_max]:
+                lookup.flags.writeable = False
+            registry[record['name']] = dict(record, slit_to_order=slit_to_order,
+                                            order_wavelength_min=order_wavelength_min,
+                                            order_wavelength_max=order_wavelength_max)
+        _REGISTRY = registry
+    return _REGISTRY
+
+
+def get_configuration(name: str = None) -> object:
+    r"""Shared instance of the configuration `name`.
+
+    The instances are cached, so that resolving the configuration of many arcs costs a dictionary lookup. They must
+    be treated as read-only: use `GnirsConfiguration(name)` to get an instance that can be modified.
+
+    Args:
+        name (str): name of the GNIRS configuration
+
+    Returns:
+        GnirsConfiguration: the configuration
+    """
+    configuration = _INSTANCES.get(name)
+    if configuration is None:
+        configuration = _INSTANCES[name] = GnirsConfiguration(name=name)
+    return configuration
 
 
 class GnirsConfiguration:
     """Class containing the properties of GNIRS given a configuration.
 
+    The properties of the supported configurations are read from the table in `CONFIGURATION_FILE`.
+
     Attributes:
         name (str): name of the GNIRS configuration
         mode (str): mode used
         grating (str): grating used
         camera (str): camera used
+        prism (str): cross-dispersing prism used
         order (dict): dictionary to translate the slit number into an order number
         rows (int): size of the detector in the spectral direction
         cols (int): size of the detector in the spatial direction
@@ -40,63 +111,84 @@ class GnirsConfiguration:
         if name not in CONFIGURATION_NAMES:
             raise ValueError('{} is not a configuration currently covered.'.format(name) +
                              'Possible values are: \n {}'.format(CONFIGURATION_NAMES))
-
-        if name == '32/mmSB':
-            self.__name = '32/mmSB'
-            self.__mode = 'SXD'
-            self.__grating = '32/mmSB_G5533'
-            self.__camera = 'ShortBlue_G5540'
-            self.__order = {"number": [3, 4, 5, 6, 7, 8],
-                            "wavelength_nm_min": [1.869, 1.402, 1.122, 0.935, 0.802, 0.702],
-                            "wavelength_nm_max": [2.531, 1.898, 1.518, 1.265, 1.084, 0.948],
-                            "slit": [1, 2, 3, 4, 5, 6]
-                            }
-            self.__rows = 1024
-            self.__cols = 1024
-        elif name == '10/mmLBSX':
-            self.__name = '10/mmLBSX'
-            self.__mode = 'LXD'
-            self.__grating = '10 l/mm'
-            self.__camera = 'LongBlue'
-            self.__order = {}
-            self.__rows = None
-            self.__cols = None
-        else:
-            self.__name = name
-            self.__mode = None
-            self.__grating = None
-            self.__camera = None
-            self.__order = {}
-            self.__rows = None
-            self.__cols = None
+        self.__record = _load_registry()[name]
+        self.__name = name
 
     @property
     def mode(self):
         r"""Mode of the GNIRS configuration"""
-        return self.__mode
+        return self.__record['mode']
 
     @property
     def grating(self):
         r"""Grating of the GNIRS configuration"""
-        return self.__grating
+        return self.__record['grating']
 
     @property
     def camera(self):
         r"""Camera of the GNIRS configuration"""
-        return self.__camera
+        return self.__record['camera']
+
+    @property
+    def prism(self):
+        r"""Cross-dispersing prism of the GNIRS configuration"""
+        return self.__record['prism']
 
     @property
     def order(self):
-        r"""Order dictionary of the GNIRS configuration"""
-        return self.__order
+        r"""Order dictionary of the GNIRS configuration.
+
+        A copy is returned, since the same record is shared by all the instances of the configuration.
+        """
+        return {key: list(value) for key, value in self.__record['order'].items()}
 
     @property
     def rows(self):
         r"""Rows in the CCD of the GNIRS configuration"""
-        return self.__rows
+        return self.__record['rows']
 
     @property
     def cols(self):
         r"""Cols in the CCD of the GNIRS configuration"""
-        return self.__cols
+        return self.__record['cols']
+
+    def slit_to_order(self, slits):
+        r"""Order numbers of the given slit numbers.
+
+        Args:
+            slits (int or array): slit numbers
 
+        Returns:
+            int or array: order numbers, -1 for the slits that are not used by the configuration
+        """
+        import numpy as np
+        lookup = self.__record['slit_to_order']
+        slits = np.asarray(slits)
+        inside = (slits >= 0) & (slits < len(lookup))
+        return np.where(inside, lookup[np.where(inside, slits, 0)], -1)
+
+    def wavelength_range(self, orders) -> tuple:
+        r"""Nominal wavelength range of the given orders.
+
+        Args:
+            orders (int or array): order numbers
+
+        Returns:
+            wavelength_min, wavelength_max: ranges in micron
+
+        Raises:
+            ValueError: if the range of some of the orders is not defined for this configuration
+        """
+        import numpy as np
+        lookup_min, lookup_max = self.__record['order_wavelength_min'], self.__record['order_wavelength_max']
+        orders = np.asarray(orders)
+        inside = (orders >= 0) & (orders < len(lookup_min))
+        index = np.where(inside, orders, 0)
+        wavelength_min = np.where(inside, lookup_min[index], np.nan)
+        wavelength_max = np.where(inside, lookup_max[index], np.nan)
+        undefined = np.isnan(wavelength_min) | np.isnan(wavelength_max)
+        if np.any(undefined):
+            raise ValueError('wavelength range not defined for orders {} in configuration {}. Current '
+                             'possibilities are: {}'.format(np.unique(orders[undefined]).tolist(), self.name,
+                                                            self.__record['order'].get('number', [])))
+        return wavelength_min, wavelength_max
@@ -0,0 +1,207 @@
+"""Caches of the features parsed from IRAF identify database files: persistent on disk, or in memory.
+"""
+
+import glob
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+from gnirsarc2d.io import read_iraf_database
+
+__all__ = ['IdentifyCache', 'MemoryIdentifyCache']
+
+CACHE_EXTENSION = '.npz'
+# Maximum size of the cache directory in bytes
+DEFAULT_MAX_SIZE = 256 * 1024 ** 2
+
+
+def _path_key(path_to_file: str) -> str:
+    return hashlib.sha1(os.path.abspath(path_to_file).encode()).hexdigest()[:20]
+
+
+class IdentifyCache:
+    """Class that stores the features parsed from IRAF identify database files as binary `.npz` sidecars.
+
+    Each entry is keyed by the absolute path of the database file and by the selected column, and it is considered
+    valid only as long as the modification time and the size of the database file are unchanged. When the size of
+    the cache exceeds `max_size`, the least recently used entries are evicted. The size is measured by scanning the
+    cache directory only at the first write, and then kept as a running total, so that filling the cache with N
+    entries costs O(N) and not O(N^2). Entries written by other processes are accounted for at the next eviction.
+
+    Attributes:
+        cache_directory (str): directory where the cached entries are stored
+        max_size (int): maximum size of the cache directory in bytes
+
+    """
+
+    def __init__(self, cache_directory: str, max_size: int = DEFAULT_MAX_SIZE):
+        self.cache_directory = cache_directory
+        self.max_size = max_size
+        os.makedirs(self.cache_directory, exist_ok=True)
+        # running total of the size of the entries, `None` until the directory is scanned
+        self._size = None
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return 'IdentifyCache: {} ({} entries, {} bytes)'.format(self.cache_directory, len(self._entries()),
+                                                                 self.size)
+
+    @property
+    def size(self):
+        r"""Total size in bytes of the cached entries"""
+        return sum(os.path.getsize(entry) for entry in self._entries())
+
+    def _entries(self, path_to_file: str = None) -> list:
+        prefix = '*' if path_to_file is None else _path_key(path_to_file) + '_*'
+        return glob.glob(os.path.join(self.cache_directory, prefix + CACHE_EXTENSION))
+
+    def _entry(self, path_to_file: str, select_column: int = None) -> str:
+        column = 'median' if select_column is None else str(select_column)
+        return os.path.join(self.cache_directory, _path_key(path_to_file) + '_' + column + CACHE_EXTENSION)
+
+    def get_features(self, path_to_file: str, select_column: int = None) -> tuple:
+        r"""Cached version of :func:`read_iraf_database.get_features_from_identify_table`.
+
+        Args:
+            path_to_file (str): IRAF identify database file
+            select_column (int): column to be selected. If `None`, the central column is used
+
+        Returns:
+            pixel, wavelength_iraf, wavelength_archive: arrays with the properties of the identified lines
+        """
+        status = os.stat(path_to_file)
+        entry = self._entry(path_to_file, select_column=select_column)
+        try:
+            with np.load(entry) as cached:
+                if int(cached['mtime_ns']) == status.st_mtime_ns and int(cached['size']) == status.st_size:
+                    features = cached['pixel'], cached['wavelength_iraf'], cached['wavelength_archive']
+                    # mark the entry as recently used
+                    os.utime(entry)
+                    return features
+        except (OSError, KeyError, ValueError):
+            pass
+        features = read_iraf_database.get_features_from_identify_table(path_to_file, select_column=select_column)
+        size_change = self._write(entry, status, *features)
+        with self._lock:
+            if self._size is None:
+                self._size = self.size
+            else:
+                self._size += size_change
+            full = self._size > self.max_size
+        if full:
+            self.evict()
+        return features
+
+    def _write(self, entry: str, status: os.stat_result, pixel: np.array, wavelength_iraf: np.array,
+               wavelength_archive: np.array) -> int:
+        r"""Write an entry, returning the change of the size of the cache in bytes"""
+        try:
+            old_size = os.path.getsize(entry)
+        except OSError:
+            old_size = 0
+        # write to a temporary file first, so that concurrent readers never see a partial entry
+        file_descriptor, temporary_entry = tempfile.mkstemp(dir=self.cache_directory, suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as f:
+                np.savez(f, mtime_ns=status.st_mtime_ns, size=status.st_size, pixel=pixel,
+                         wavelength_iraf=wavelength_iraf, wavelength_archive=wavelength_archive)
+            os.replace(temporary_entry, entry)
+            return os.path.getsize(entry) - old_size
+        except OSError:
+            if os.path.exists(temporary_entry):
+                os.remove(temporary_entry)
+            return 0
+
+    def evict(self):
+        r"""Remove the least recently used entries until the cache is smaller than `max_size`
+        """
+        entries = []
+        for entry in self._entries():
+            try:
+                status = os.stat(entry)
+            except OSError:
+                continue
+            entries.append((status.st_mtime, status.st_size, entry))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            self._remove(entry)
+            total_size -= size
+        with self._lock:
+            self._size = total_size
+
+    def invalidate(self, path_to_file: str = None):
+        r"""Remove the cached entries of a database file, or all the entries if `path_to_file` is `None`
+        """
+        for entry in self._entries(path_to_file):
+            self._remove(entry)
+        with self._lock:
+            self._size = None
+
+    @staticmethod
+    def _remove(entry: str):
+        try:
+            os.remove(entry)
+        except FileNotFoundError:
+            pass
+
+
+class MemoryIdentifyCache:
+    """Class that keeps the features parsed from IRAF identify database files in memory.
+
+    It has the same interface of :class:`IdentifyCache` and the same validation based on modification time and size
+    of the database files, and it is meant for long-running processes (e.g. `fit_arc2d --watch`) where only the
+    files that changed have to be parsed again. It can be shared by the threads reading the files concurrently.
+
+    Attributes:
+        max_entries (int): maximum number of entries, the least recently used are evicted first
+
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return 'MemoryIdentifyCache: {} entries'.format(len(self._cache))
+
+    def get_features(self, path_to_file: str, select_column: int = None) -> tuple:
+        r"""Cached version of :func:`read_iraf_database.get_features_from_identify_table`.
+
+        Args:
+            path_to_file (str): IRAF identify database file
+            select_column (int): column to be selected. If `None`, the central column is used
+
+        Returns:
+            pixel, wavelength_iraf, wavelength_archive: arrays with the properties of the identified lines
+        """
+        status = os.stat(path_to_file)
+        key = (os.path.abspath(path_to_file), select_column)
+        with self._lock:
+            cached = self._cache.pop(key, None)
+        if cached is None or cached[0] != (status.st_mtime_ns, status.st_size):
+            # the file is parsed outside of the lock, so that different files are parsed concurrently
+            cached = ((status.st_mtime_ns, status.st_size),
+                      read_iraf_database.get_features_from_identify_table(path_to_file, select_column=select_column))
+        with self._lock:
+            # dictionaries keep the insertion order: the most recently used entries are at the end
+            self._cache[key] = cached
+            while len(self._cache) > self.max_entries:
+                del self._cache[next(iter(self._cache))]
+        return cached[1]
+
+    def invalidate(self, path_to_file: str = None):
+        r"""Remove the cached entries of a database file, or all the entries if `path_to_file` is `None`
+        """
+        with self._lock:
+            if path_to_file is None:
+                self._cache.clear()
+            else:
+                path_to_file = os.path.abspath(path_to_file)
+                for key in [key for key in self._cache if key[0] == path_to_file]:
+                    del self._cache[key]
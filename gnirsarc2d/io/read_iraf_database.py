@@ -1,14 +1,26 @@
+import collections
+import glob
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import re
 
-NUMBER_PATTERN = '[+\-]?(?:0|[1-9]\d*)(?:\.\d*)?(?:[eE][+\-]?\d+)|-?\d+(?:\.\d+)?'
+from gnirsarc2d import profiling
+
+NUMBER_PATTERN = r'[+\-]?(?:0|[1-9]\d*)(?:\.\d*)?(?:[eE][+\-]?\d+)|-?\d+(?:\.\d+)?'
+# Name of the identify database files: idFILENAME_SLITNUMBER_
+IDENTIFY_FILE_PATTERN = re.compile(r'^(.+)_(\d+)_$')
+# Default number of identify files read concurrently
+DEFAULT_READ_WORKERS = 8
 
 # ToDo fix documentation
 # ToDo double check the conversion in pixel from IRAF (1 based) to Python (0 based)
 
 
 def _clean_string(string_to_be_cleaned: str) -> int:
-    return re.sub('\s+', ' ', string_to_be_cleaned).strip()
+    return re.sub(r'\s+', ' ', string_to_be_cleaned).strip()
 
 
 def get_features_from_identify_table(path_to_file: str, select_column: int = None) -> tuple:
@@ -18,28 +30,218 @@ def get_features_from_identify_table(path_to_file: str, select_column: int = Non
         identify_table.feature_archive_wavelength
 
 
-def _select_identify_table(path_to_file: str, select_column: int = None) -> list:
-    # read the file and store it line by line
+def map_concurrently(function: object, arguments: list, max_workers: int = DEFAULT_READ_WORKERS):
+    r"""Generator applying `function` to each of the `arguments` in a pool of threads.
+
+    The results are yielded in the order of the `arguments`. At most `2 * max_workers` calls are submitted at the
+    same time, so that long lists of files are read with a bounded number of requests in flight (and of results
+    waiting to be consumed). Threads are effective because reading files releases the GIL, and on network file
+    systems the time is dominated by the latency of each request.
+
+    Args:
+        function (object): function of a single argument
+        arguments (list): arguments of the calls
+        max_workers (int): number of threads. If 1, the calls are performed sequentially in the current thread
+
+    Yields:
+        the results of the calls
+    """
+    if max_workers is None or max_workers <= 1:
+        for argument in arguments:
+            yield function(argument)
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = collections.deque()
+        for argument in arguments:
+            if len(in_flight) >= 2 * max_workers:
+                yield in_flight.popleft().result()
+            in_flight.append(executor.submit(function, argument))
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def _slit_paths(database_directory: str, root_filename: str, configuration: object) -> list:
+    return [os.path.join(database_directory, root_filename + "_" + str(slit) + "_")
+            for slit in configuration.order["slit"]]
+
+
+def _assemble_features(slit_features: list, configuration: object) -> tuple:
+    r"""Copy the features read from each slit into contiguous arrays, allocated once"""
+    n_lines = np.array([len(features[0]) for features in slit_features], dtype=int)
+    boundaries = np.concatenate([[0], np.cumsum(n_lines)])
+    pixel, wavelength_iraf, wavelength_archive = np.empty((3, boundaries[-1]))
+    for start, end, (pixel_slit, wavelength_iraf_slit, wavelength_archive_slit) in zip(boundaries[:-1],
+                                                                                      boundaries[1:],
+                                                                                      slit_features):
+        pixel[start:end] = pixel_slit
+        wavelength_iraf[start:end] = wavelength_iraf_slit
+        wavelength_archive[start:end] = wavelength_archive_slit
+    order = configuration.slit_to_order(np.repeat(configuration.order["slit"], n_lines))
+    return pixel, wavelength_iraf, wavelength_archive, order
+
+
+def get_features_from_database(database_directory: str, root_filename: str, configuration: object,
+                               cache: object = None, max_workers: int = DEFAULT_READ_WORKERS) -> tuple:
+    r"""Read the lines identified in all the slits of an arc.
+
+    The files are expected in the format `idFILENAME_SLITNUMBER_`, as produced by the GNIRS IRAF pipeline. The
+    slit files are read concurrently (see :func:`map_concurrently`).
+
+    Args:
+        database_directory (str): IRAF database directory
+        root_filename (str): root filename for the result of the identify task (`idFILENAME`)
+        configuration (GnirsConfiguration): GNIRS configuration used to translate slit numbers into orders
+        cache (IdentifyCache): if provided, the features are read from (and stored into) this cache
+        max_workers (int): number of threads reading the slit files. If 1, the files are read sequentially
+
+    Returns:
+        pixel, wavelength_iraf, wavelength_archive, order: arrays with the properties of all identified lines
+    """
+    read_features = get_features_from_identify_table if cache is None else cache.get_features
+    paths = _slit_paths(database_directory, root_filename, configuration)
+    if max_workers is None or max_workers <= 1:
+        slit_features = []
+        for slit, path_to_file in zip(configuration.order["slit"], paths):
+            with profiling.stage('read', slit=slit):
+                slit_features.append(read_features(path_to_file))
+    elif profiling.is_enabled():
+        # the profiler is not thread safe: each read is timed in its thread and recorded afterwards
+        def timed_read_features(path_to_file):
+            start = time.perf_counter()
+            features = read_features(path_to_file)
+            return features, time.perf_counter() - start
+
+        with profiling.stage('read_concurrent', workers=min(max_workers, len(paths))):
+            timed_features = list(map_concurrently(timed_read_features, paths,
+                                                   max_workers=min(max_workers, len(paths))))
+        slit_features = [features for features, _ in timed_features]
+        for slit, (_, wall_time) in zip(configuration.order["slit"], timed_features):
+            profiling.record('read', wall_time, slit=slit)
+    else:
+        slit_features = list(map_concurrently(read_features, paths, max_workers=min(max_workers, len(paths))))
+    return _assemble_features(slit_features, configuration)
+
+
+def _parse_features(feature_lines: list) -> np.array:
+    r"""Parse pixel, measured and archive wavelength, and FWHM of the feature lines, shape (n_lines, 4)"""
+    # np.loadtxt warns when there are no lines, e.g. for a slit where no feature has been identified
+    if not any(feature_line.strip() for feature_line in feature_lines):
+        return np.zeros((0, 4))
+    return np.loadtxt(feature_lines, usecols=(0, 1, 2, 3), ndmin=2)
+
+
+def get_all_features_from_identify_table(path_to_file: str) -> dict:
+    r"""Read the lines identified in all the columns (i.e. all the identify blocks) of a database file.
+
+    The file is read in a single pass: the feature lines of all the blocks are collected and then parsed in bulk.
+
+    Args:
+        path_to_file (str): IRAF identify database file
+
+    Returns:
+        dict: contiguous arrays with keys `column`, `pixel`, `measured_wavelength`, `archive_wavelength`, and `fwhm`
+    """
+    columns_id_block, features_id_block, feature_lines = [], [], []
+    column, features_to_read = None, 0
     with open(path_to_file, 'r') as f:
-        identify_table_lines = f.readlines()
-
-    # splitting the table into the different instances that has been run to identify lines
-    start_id_block, end_id_block, columns_id_block = [], [], []
-    for index_line, identify_table_line in enumerate(identify_table_lines):
-        if identify_table_line.startswith('# '):
-            start_id_block.append(index_line)
-        if identify_table_line == '\n':
-            end_id_block.append(index_line)
-        if identify_table_line.startswith('begin'):
-            columns_id_block.append(identify_table_line.split("][")[1].split(",")[0])
-
-    # this is to deal with the case that there are multiple newlines at the end of the file
-    if len(start_id_block) < len(end_id_block):
-        end_id_block = end_id_block[:len(start_id_block)]
+        for identify_table_line in f:
+            if features_to_read > 0:
+                feature_lines.append(identify_table_line)
+                features_to_read -= 1
+            elif identify_table_line.startswith('begin'):
+                column = int(identify_table_line.split("][")[1].split(",")[0])
+            elif identify_table_line.split(None, 1)[:1] == ['features']:
+                features_to_read = int(identify_table_line.split()[1])
+                columns_id_block.append(column)
+                features_id_block.append(features_to_read)
+    features = np.ascontiguousarray(_parse_features(feature_lines).T)
+    return {'column': np.repeat(np.array(columns_id_block, dtype=int), features_id_block),
+            'pixel': features[0],
+            'measured_wavelength': features[1],
+            'archive_wavelength': features[2],
+            'fwhm': features[3]}
+
+
+def get_all_features_from_database(database_directory: str, root_filename: str, configuration: object) -> dict:
+    r"""Read the lines identified in all the columns of all the slits of an arc.
+
+    Args:
+        database_directory (str): IRAF database directory
+        root_filename (str): root filename for the result of the identify task (`idFILENAME`)
+        configuration (GnirsConfiguration): GNIRS configuration used to translate slit numbers into orders
+
+    Returns:
+        dict: contiguous arrays with the same keys of :func:`get_all_features_from_identify_table` plus `order`
+    """
+    all_features = []
+    for slit in configuration.order["slit"]:
+        features = get_all_features_from_identify_table(
+            os.path.join(database_directory, root_filename + "_" + str(slit) + "_"))
+        features['order'] = configuration.slit_to_order(np.full(len(features['pixel']), slit))
+        all_features.append(features)
+    return {key: np.concatenate([features[key] for features in all_features]) for key in all_features[0]}
+
+
+def find_root_filenames(database_directory: str, pattern: str = 'id*') -> list:
+    r"""Find the root filenames of all the arcs present in a database directory.
+
+    Args:
+        database_directory (str): IRAF database directory
+        pattern (str): glob pattern used to select the identify files
+
+    Returns:
+        list: sorted list of unique root filenames (`idFILENAME`)
+    """
+    root_filenames = set()
+    for path_to_file in glob.glob(os.path.join(database_directory, pattern)):
+        match = IDENTIFY_FILE_PATTERN.match(os.path.basename(path_to_file))
+        if match is not None:
+            root_filenames.add(match.group(1))
+    return sorted(root_filenames)
+
+
+def _iter_identify_blocks(path_to_file: str):
+    r"""Generator over the blocks of an IRAF identify database file.
+
+    The file is scanned only once, without tokenizing the feature tables. Each block starts with the `# date` line
+    and ends with an empty line (or with the end of the file).
+
+    Yields:
+        column, start, end: column used by `identify` and byte offsets of the beginning and the end of the block
+    """
+    with open(path_to_file, 'rb') as f:
+        start, column, offset = None, None, 0
+        for identify_table_line in f:
+            if identify_table_line.startswith(b'# '):
+                start, column = offset, None
+            elif start is not None and identify_table_line.startswith(b'begin'):
+                column = identify_table_line.split(b"][")[1].split(b",")[0].decode().strip()
+            elif start is not None and identify_table_line.strip() == b'':
+                yield column, start, offset
+                start = None
+            offset += len(identify_table_line)
+        if start is not None:
+            yield column, start, offset
+
+
+def _read_identify_block(path_to_file: str, start: int, end: int) -> list:
+    r"""Read the lines of the block stored between the byte offsets `start` and `end`.
+    """
+    with open(path_to_file, 'rb') as f:
+        f.seek(start)
+        return f.read(end - start).decode().splitlines()
+
+
+def _select_identify_table(path_to_file: str, select_column: int = None) -> list:
+    # index the different instances that has been run to identify lines
+    columns_id_block, start_id_block, end_id_block = [], [], []
+    for column, start, end in _iter_identify_blocks(path_to_file):
+        columns_id_block.append(column)
+        start_id_block.append(start)
+        end_id_block.append(end)
 
     index_median_block = _get_central_column(columns_id_block, select_column)
-    index_start_id_block, index_end_id_block = start_id_block[index_median_block], end_id_block[index_median_block]
-    return identify_table_lines[index_start_id_block:index_end_id_block]
+    return _read_identify_block(path_to_file, start_id_block[index_median_block], end_id_block[index_median_block])
 
 
 def _get_central_column(columns_id_block: list, select_column: int) -> int:
@@ -61,52 +263,55 @@ class IrafIdentify:
         date (str): date when the `identify` task ran
         column (str): column considered extract wavelengths
         units (str): units used by `identify`
-        feature_pixel (list): pixel location of the detected lines
-        feature_measured_wavelength (list): measured wavelength after IRAF fitting
-        feature_archive_wavelength (list): archived wavelength
-        feature_fwhm (list): required FWHM of the feature
+        feature_pixel (array): pixel location of the detected lines
+        feature_measured_wavelength (array): measured wavelength after IRAF fitting
+        feature_archive_wavelength (array): archived wavelength
+        feature_fwhm (array): required FWHM of the feature
 
     """
 
     def __init__(self, date: str = None, column: str = None, units: str = None,
-                 feature_pixel: list = None, feature_measured_wavelength: list = None,
-                 feature_archive_wavelength: list = None, feature_fwhm: list = None):
+                 feature_pixel: np.array = None, feature_measured_wavelength: np.array = None,
+                 feature_archive_wavelength: np.array = None, feature_fwhm: np.array = None):
         self.date = date
         self.column = column
         self.units = units
         if feature_pixel is None:
-            self.feature_pixel = []
+            self.feature_pixel = np.array([])
         else:
-            self.feature_pixel = feature_pixel
+            self.feature_pixel = np.asarray(feature_pixel, dtype=float)
         if feature_measured_wavelength is None:
-            self.feature_measured_wavelength = []
+            self.feature_measured_wavelength = np.array([])
         else:
-            self.feature_measured_wavelength = feature_measured_wavelength
+            self.feature_measured_wavelength = np.asarray(feature_measured_wavelength, dtype=float)
         if feature_archive_wavelength is None:
-            self.feature_archive_wavelength = []
+            self.feature_archive_wavelength = np.array([])
         else:
-            self.feature_archive_wavelength = feature_archive_wavelength
+            self.feature_archive_wavelength = np.asarray(feature_archive_wavelength, dtype=float)
         if feature_fwhm is None:
-            self.feature_fwhm = []
+            self.feature_fwhm = np.array([])
         else:
-            self.feature_fwhm = feature_fwhm
+            self.feature_fwhm = np.asarray(feature_fwhm, dtype=float)
 
     def from_iraf_id_lines(self, id_table_lines: list):
         """Fill an IrafIdentify object from the output of IRAF identify
+
+        The header is scanned up to the `features` keyword, then the feature table is parsed in bulk.
         """
+        features_start, features_end = 0, 0
         for index_line, identify_table_line in enumerate(id_table_lines):
             if '# ' in identify_table_line:
                 self.date = _clean_string(identify_table_line.replace("# ", "").replace("\n", ""))
-            if 'begin' in identify_table_line:
+            elif 'begin' in identify_table_line:
                 self.column = _clean_string(identify_table_line.split("][")[1].split(",")[0])
-            if 'units' in identify_table_line:
+            elif 'units' in identify_table_line:
                 self.units = _clean_string(identify_table_line.replace("units", ""))
-            if 'features' in identify_table_line:
+            elif 'features' in identify_table_line:
                 features_start = index_line + 1
                 features_end = features_start + int(_clean_string(identify_table_line.replace("features", "")))
-        for index_line, identify_table_line in enumerate(id_table_lines[features_start:features_end]):
-            table_line = re.split('\s+', identify_table_line.strip())
-            self.feature_pixel.append(float(table_line[0]))
-            self.feature_measured_wavelength.append(float(table_line[1]))
-            self.feature_archive_wavelength.append(float(table_line[2]))
-            self.feature_fwhm.append(float(table_line[3]))
+                break
+        features = _parse_features(id_table_lines[features_start:features_end])
+        self.feature_pixel = features[:, 0]
+        self.feature_measured_wavelength = features[:, 1]
+        self.feature_archive_wavelength = features[:, 2]
+        self.feature_fwhm = features[:, 3]
@@ -0,0 +1,171 @@
+"""Save and load 2D wavelength solutions and their line lists as versioned FITS files.
+
+The layout of a solution file is:
+
+- primary HDU: header with the format name and version, the fitting function, the degrees, the domains and windows
+  of the model, the GNIRS configuration, the fitting parameters, and user metadata (as `HIERARCH META ...` cards)
+- `COEFFS` image extension: coefficients of the model with shape (y_degree + 1, x_degree + 1)
+- `LINES` binary table: `PIXEL`, `WAVELENGTH`, `ORDER`, and `MASK` of the lines used in the fit
+
+Files are opened with `memmap=True`, so that the arrays are read from disk only when they are accessed.
+"""
+
+import numpy as np
+
+__all__ = ['WavelengthSolution', 'save_solution', 'load_solution']
+
+SOLUTION_FORMAT = 'GNIRSARC2D-SOLUTION'
+SOLUTION_VERSION = 1
+META_PREFIX = 'META '
+
+
+class WavelengthSolution:
+    """Class containing a 2D wavelength solution and the lines used to obtain it.
+
+    The class exposes the same attributes of an astropy `Legendre2D`/`Chebyshev2D` model needed by
+    `gnirsarc2d.fitting.wavelength_map.WavelengthMap`, so that an archived solution can be applied without
+    building the astropy model.
+
+    Attributes:
+        fit_function (str): 2D function used for the fit
+        coefficients (array): coefficients of the model with shape (y_degree + 1, x_degree + 1)
+        x_domain (tuple): domain of the model along the (normalized) spectral direction
+        y_domain (tuple): domain of the model along the order direction
+        x_window (tuple): window of the model along the spectral direction
+        y_window (tuple): window of the model along the order direction
+        pixel (array): centroid position in pixels of the identified lines
+        wavelength (array): true wavelength of the identified lines
+        order (array): order number where the line are identified lines
+        mask (array): data rejected by the fitting procedure
+        configuration (str): name of the GNIRS configuration
+        tot_pixel (int): size of the image in the spectral direction
+        metadata (dict): additional information about the fit
+
+    """
+
+    def __init__(self, fit_function: str, coefficients: np.array, x_domain: tuple, y_domain: tuple,
+                 x_window: tuple = (-1., 1.), y_window: tuple = (-1., 1.), pixel: np.array = None,
+                 wavelength: np.array = None, order: np.array = None, mask: np.array = None,
+                 configuration: str = None, tot_pixel: int = None, metadata: dict = None):
+        self.fit_function = fit_function
+        self.coefficients = coefficients
+        self.x_domain = tuple(x_domain)
+        self.y_domain = tuple(y_domain)
+        self.x_window = tuple(x_window)
+        self.y_window = tuple(y_window)
+        self.pixel = pixel
+        self.wavelength = wavelength
+        self.order = order
+        self.mask = mask
+        self.configuration = configuration
+        self.tot_pixel = tot_pixel
+        self.metadata = {} if metadata is None else metadata
+
+    def __str__(self):
+        return 'WavelengthSolution: {} ({}, {}) for {}'.format(self.fit_function, self.x_degree, self.y_degree,
+                                                                self.configuration)
+
+    @property
+    def x_degree(self):
+        r"""Degree of the model along the spectral direction"""
+        return self.coefficients.shape[1] - 1
+
+    @property
+    def y_degree(self):
+        r"""Degree of the model along the order direction"""
+        return self.coefficients.shape[0] - 1
+
+    @property
+    def parameters(self):
+        r"""Flattened coefficients, in the order of the parameters of the astropy model"""
+        return self.coefficients.ravel()
+
+    @property
+    def fit2d(self):
+        r"""The solution as an astropy `Legendre2D`/`Chebyshev2D` model"""
+        from gnirsarc2d.fitting import arc2d
+        fit2d = arc2d._init_model(self.fit_function, self.x_degree, self.y_degree, self.y_domain)
+        fit2d.x_domain, fit2d.x_window, fit2d.y_window = self.x_domain, self.x_window, self.y_window
+        fit2d.parameters = self.parameters
+        return fit2d
+
+    @classmethod
+    def from_fit(cls, fit2d: object, mask: np.array = None, pixel: np.array = None, wavelength: np.array = None,
+                 order: np.array = None, configuration: str = None, tot_pixel: int = None, metadata: dict = None):
+        r"""Create a solution from the output of :func:`gnirsarc2d.fitting.arc2d.full_fit`
+        """
+        coefficients = np.asarray(fit2d.parameters, dtype=float).reshape(fit2d.y_degree + 1, fit2d.x_degree + 1)
+        return cls(type(fit2d).__name__.lower(), coefficients, fit2d.x_domain, fit2d.y_domain,
+                   x_window=fit2d.x_window, y_window=fit2d.y_window, pixel=pixel, wavelength=wavelength,
+                   order=order, mask=mask, configuration=configuration, tot_pixel=tot_pixel, metadata=metadata)
+
+
+def save_solution(filename: str, solution: object, overwrite: bool = True):
+    r"""Save a wavelength solution in a FITS file.
+
+    Args:
+        filename (str): name of the output file
+        solution (WavelengthSolution): solution to be saved
+        overwrite (bool): overwrite `filename` if it exists
+    """
+    from astropy.io import fits
+    header = fits.Header()
+    header['FORMAT'] = (SOLUTION_FORMAT, 'Format of the file')
+    header['VERSION'] = (SOLUTION_VERSION, 'Version of the format')
+    header['FITFUNC'] = (solution.fit_function, 'Function of the 2D fit')
+    header['XDEGREE'] = (solution.x_degree, 'Degree along the spectral direction')
+    header['YDEGREE'] = (solution.y_degree, 'Degree along the order direction')
+    for axis in ['x', 'y']:
+        for kind in ['domain', 'window']:
+            values = getattr(solution, '{}_{}'.format(axis, kind))
+            header['{}{}MIN'.format(axis.upper(), kind[:3].upper())] = float(values[0])
+            header['{}{}MAX'.format(axis.upper(), kind[:3].upper())] = float(values[1])
+    header['CONFIG'] = ('' if solution.configuration is None else solution.configuration, 'GNIRS configuration')
+    header['TOTPIXEL'] = (-1 if solution.tot_pixel is None else int(solution.tot_pixel), 'Spectral size in pixels')
+    for key, value in solution.metadata.items():
+        header['HIERARCH ' + META_PREFIX + key.upper()] = value
+    hdus = [fits.PrimaryHDU(header=header),
+            fits.ImageHDU(np.asarray(solution.coefficients, dtype=np.float64), name='COEFFS')]
+    if solution.pixel is not None:
+        n_lines = len(solution.pixel)
+        mask = np.zeros(n_lines, dtype=bool) if solution.mask is None else np.asarray(solution.mask, dtype=bool)
+        hdus.append(fits.BinTableHDU.from_columns([
+            fits.Column(name='PIXEL', format='D', array=np.asarray(solution.pixel, dtype=np.float64)),
+            fits.Column(name='WAVELENGTH', format='D', array=np.asarray(solution.wavelength, dtype=np.float64)),
+            fits.Column(name='ORDER', format='J', array=np.asarray(solution.order, dtype=np.int32)),
+            fits.Column(name='MASK', format='L', array=mask)], name='LINES'))
+    fits.HDUList(hdus).writeto(filename, overwrite=overwrite)
+
+
+def load_solution(filename: str, lines: bool = True) -> object:
+    r"""Load a wavelength solution saved with :func:`save_solution`.
+
+    Args:
+        filename (str): name of the file
+        lines (bool): load also the lines used in the fit (memory-mapped)
+
+    Returns:
+        WavelengthSolution: the solution
+    """
+    from astropy.io import fits
+    with fits.open(filename, memmap=True) as hdul:
+        header = hdul[0].header
+        if header.get('FORMAT') != SOLUTION_FORMAT:
+            raise ValueError('{} is not a gnirsarc2d wavelength solution'.format(filename))
+        if header['VERSION'] > SOLUTION_VERSION:
+            raise ValueError('Version {} of the format is not supported (latest supported: {})'.format(
+                header['VERSION'], SOLUTION_VERSION))
+        metadata = {key[len(META_PREFIX):].lower(): value for key, value in header.items()
+                    if key.startswith(META_PREFIX)}
+        pixel, wavelength, order, mask = None, None, None, None
+        if lines and 'LINES' in hdul:
+            table = hdul['LINES'].data
+            pixel, wavelength, order, mask = table['PIXEL'], table['WAVELENGTH'], table['ORDER'], table['MASK']
+        return WavelengthSolution(header['FITFUNC'], np.asarray(hdul['COEFFS'].data, dtype=np.float64),
+                                  (header['XDOMMIN'], header['XDOMMAX']), (header['YDOMMIN'], header['YDOMMAX']),
+                                  x_window=(header['XWINMIN'], header['XWINMAX']),
+                                  y_window=(header['YWINMIN'], header['YWINMAX']),
+                                  pixel=pixel, wavelength=wavelength, order=order, mask=mask,
+                                  configuration=header['CONFIG'] or None,
+                                  tot_pixel=None if header['TOTPIXEL'] < 0 else header['TOTPIXEL'],
+                                  metadata=metadata)
@@ -0,0 +1,236 @@
+"""Machine-readable output of the 2D fits: per-arc summaries and a combined table streamed during batch runs.
+
+For each arc, :func:`write_arc_outputs` writes:
+
+- `root_filename.fits`: the wavelength solution (see `gnirsarc2d.io.solution`), the astropy model can be rebuilt
+  with `load_solution('root_filename.fits').fit2d`
+- `root_filename_summary.json` (or `.ecsv`): model type, degrees, domains, coefficients, per-order statistics,
+  rejected lines, and timing of the fit
+
+The combined table written by :class:`SummaryTableWriter` is an ECSV file with one row per arc, appended (and
+flushed) as soon as each arc is fitted, so that it can be ingested while the batch is still running.
+"""
+
+import csv
+import json
+import os
+
+import numpy as np
+
+__all__ = ['SUMMARY_FORMATS', 'arc_summary', 'write_summary', 'write_arc_outputs', 'SummaryTableWriter']
+
+SUMMARY_FORMAT = 'GNIRSARC2D-SUMMARY'
+SUMMARY_VERSION = 1
+SUMMARY_FORMATS = ['json', 'ecsv']
+# Name of the combined table written in the output directory by the batch mode
+DEFAULT_TABLE_NAME = 'arc2d_summary.ecsv'
+
+# Columns of the combined table: name, ECSV datatype, unit, description
+TABLE_COLUMNS = [
+    ('root_filename', 'string', None, 'Root filename of the arc'),
+    ('configuration', 'string', None, 'GNIRS configuration'),
+    ('success', 'bool', None, 'True if the arc has been fitted'),
+    ('error', 'string', None, 'Error raised while reading or fitting the arc'),
+    ('fit_function', 'string', None, 'Function of the 2D fit'),
+    ('x_degree', 'int64', None, 'Degree along the spectral direction'),
+    ('y_degree', 'int64', None, 'Degree along the order direction'),
+    ('rejection', 'string', None, 'Rejection of the misidentified lines'),
+    ('n_lines', 'int64', None, 'Number of lines in the fit'),
+    ('n_prefiltered', 'int64', None, 'Number of lines removed before the fit'),
+    ('n_rejected', 'int64', None, 'Number of lines rejected by the fit'),
+    ('rms_global', 'float64', 'Angstrom', 'RMS of the residuals of the lines used in the fit'),
+    ('rms_global_pixel', 'float64', 'pix', 'RMS of the residuals of the lines used in the fit'),
+    ('read_time', 'float64', 's', 'Time spent reading the identify files'),
+    ('fit_time', 'float64', 's', 'Time spent fitting the lines'),
+    ('solution_file', 'string', None, 'File with the wavelength solution'),
+    ('summary_file', 'string', None, 'File with the summary of the fit'),
+]
+
+
+def arc_summary(result: object, configuration: str = None) -> dict:
+    r"""Summary of the fit of an arc as a dictionary of built-in python types.
+
+    Args:
+        result (ArcFitResult): result of the fit (see `gnirsarc2d.fitting.batch`)
+        configuration (str): name of the GNIRS configuration
+
+    Returns:
+        dict: the summary. Failed arcs have only the root filename, the configuration, and the error
+    """
+    summary = {'format': SUMMARY_FORMAT, 'version': SUMMARY_VERSION, 'root_filename': result.root_filename,
+               'configuration': configuration, 'success': result.success}
+    if not result.success:
+        summary['error'] = result.error
+        return summary
+    fit2d = result.fit2d
+    fit_info = getattr(result, 'fit_info', None) or {}
+    summary.update(
+        fit_function=type(fit2d).__name__.lower(), x_degree=int(fit2d.x_degree), y_degree=int(fit2d.y_degree),
+        x_domain=[float(value) for value in fit2d.x_domain], y_domain=[float(value) for value in fit2d.y_domain],
+        x_window=[float(value) for value in fit2d.x_window], y_window=[float(value) for value in fit2d.y_window],
+        coefficients=np.asarray(fit2d.parameters, dtype=float).reshape(fit2d.y_degree + 1,
+                                                                       fit2d.x_degree + 1).tolist(),
+        rejection=fit_info.get('rejection'),
+        iterations=None if fit_info.get('iterations') is None else int(fit_info['iterations']),
+        n_lines=len(result.pixel), n_rejected=int(np.sum(result.mask)),
+        n_prefiltered=0 if result.prefilter is None else result.prefilter.n_removed,
+        statistics=result.statistics.to_dict(),
+        timing={key: float(value) for key, value in (getattr(result, 'timing', None) or {}).items()})
+    return summary
+
+
+def _write_json(filename: str, content: dict):
+    # write to a temporary file first, so that readers never see a partial file
+    temporary_filename = filename + '.tmp'
+    with open(temporary_filename, 'w') as f:
+        json.dump(content, f, indent=2)
+    os.replace(temporary_filename, filename)
+
+
+def write_summary(filename: str, summary: dict, summary_format: str = 'json'):
+    r"""Write the summary of an arc.
+
+    The `json` format contains the whole dictionary. The `ecsv` format contains a table with the statistics of each
+    order, while the other entries of the summary are stored in the metadata of the table.
+
+    Args:
+        filename (str): name of the output file
+        summary (dict): summary obtained with :func:`arc_summary`
+        summary_format (str): `json` or `ecsv`
+    """
+    if summary_format == 'json':
+        _write_json(filename, summary)
+    elif summary_format == 'ecsv':
+        from astropy.table import Table
+        statistics = summary.get('statistics', {})
+        columns = ['orders', 'n_lines', 'n_rejected', 'dwl', 'rms_order', 'rms_order_pixel']
+        units = {'dwl': 'Angstrom / pix', 'rms_order': 'Angstrom', 'rms_order_pixel': 'pix'}
+        table = Table([statistics.get(column, []) for column in columns], names=columns,
+                      meta={key: value for key, value in summary.items() if key != 'statistics'})
+        for column, unit in units.items():
+            table[column].unit = unit
+        if statistics:
+            table.meta.update(rms_global=statistics['rms_global'], rms_global_pixel=statistics['rms_global_pixel'])
+        table.write(filename, format='ascii.ecsv', overwrite=True)
+    else:
+        raise ValueError(r"summary format not defined. Current possibilities are: {}".format(SUMMARY_FORMATS))
+
+
+def write_arc_outputs(result: object, output_directory: str, configuration: str = None, tot_pixel: int = None,
+                      summary_format: str = 'json') -> dict:
+    r"""Write the wavelength solution and the summary of an arc in `output_directory`.
+
+    Args:
+        result (ArcFitResult): result of the fit (see `gnirsarc2d.fitting.batch`)
+        output_directory (str): directory where the files are written
+        configuration (str): name of the GNIRS configuration
+        tot_pixel (int): size of the image in the spectral direction
+        summary_format (str): format of the summary, `json` or `ecsv`
+
+    Returns:
+        dict: the summary, with the names of the files written in `solution_file` (`None` for failed arcs) and
+        `summary_file`
+    """
+    if summary_format not in SUMMARY_FORMATS:
+        raise ValueError(r"summary format not defined. Current possibilities are: {}".format(SUMMARY_FORMATS))
+    os.makedirs(output_directory, exist_ok=True)
+    output_root = os.path.join(output_directory, result.root_filename)
+    summary = arc_summary(result, configuration=configuration)
+    summary['solution_file'] = None
+    if result.success:
+        from gnirsarc2d.io import solution
+        metadata = {'root': result.root_filename, 'rms': summary['statistics']['rms_global']}
+        if summary['rejection'] is not None:
+            metadata['rejection'] = summary['rejection']
+        arc_solution = solution.WavelengthSolution.from_fit(
+            result.fit2d, mask=result.mask, pixel=result.pixel, wavelength=result.wavelength, order=result.order,
+            configuration=configuration, tot_pixel=tot_pixel, metadata=metadata)
+        summary['solution_file'] = output_root + '.fits'
+        solution.save_solution(summary['solution_file'], arc_solution)
+    summary['summary_file'] = '{}_summary.{}'.format(output_root, summary_format)
+    write_summary(summary['summary_file'], summary, summary_format=summary_format)
+    return summary
+
+
+def _table_header() -> list:
+    lines = ['# %ECSV 1.0', '# ---', '# delimiter: \',\'', '# datatype:']
+    for name, datatype, unit, description in TABLE_COLUMNS:
+        column = ['name: {}'.format(name)]
+        if unit is not None:
+            column.append('unit: {}'.format(unit))
+        column += ['datatype: {}'.format(datatype), 'description: {}'.format(description)]
+        lines.append('# - {' + ', '.join(column) + '}')
+    lines += ['# meta: {{format: {}, version: {}}}'.format(SUMMARY_FORMAT, SUMMARY_VERSION),
+              '# schema: astropy-2.0', ','.join(name for name, _, _, _ in TABLE_COLUMNS)]
+    return [line + '\n' for line in lines]
+
+
+class SummaryTableWriter:
+    """Class that appends one row per arc to an ECSV table, flushing the file after each row.
+
+    The header is written only when the file is created, together with its directory if needed. If the file already exists, its header must be the one of
+    this version of the table, and the new rows are appended to the existing ones, so that the results of several
+    runs (e.g. of a whole night) are collected in a single table. Missing values (e.g. the statistics of the arcs
+    that failed) are left empty and read as masked. The table can be read with `astropy.table.Table.read`.
+
+    Attributes:
+        filename (str): name of the table
+        n_rows (int): number of rows written by this instance
+
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.n_rows = 0
+        header = _table_header()
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            with open(filename, 'r') as f:
+                existing_header = [f.readline() for _ in header]
+            if existing_header != header:
+                raise ValueError('{} is not a summary table with version {} of the format'.format(filename,
+                                                                                               SUMMARY_VERSION))
+            self._file = open(filename, 'a', newline='')
+        else:
+            self._file = open(filename, 'w', newline='')
+            self._file.writelines(header)
+            self._file.flush()
+        self._writer = csv.writer(self._file, lineterminator='\n')
+
+    def __str__(self):
+        return 'SummaryTableWriter: {} ({} rows written)'.format(self.filename, self.n_rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, summary: dict):
+        r"""Append the row of an arc to the table.
+
+        Args:
+            summary (dict): summary of the arc (see :func:`arc_summary` and :func:`write_arc_outputs`)
+        """
+        timing = summary.get('timing', {})
+        # the per-order statistics have the same names of some totals of the summary: take only the global ones
+        statistics = summary.get('statistics', {})
+        row = dict(summary, rms_global=statistics.get('rms_global'),
+                   rms_global_pixel=statistics.get('rms_global_pixel'), read_time=timing.get('read'),
+                   fit_time=timing.get('fit'))
+        values = []
+        for name, datatype, _, _ in TABLE_COLUMNS:
+            value = row.get(name)
+            if value is None or (datatype == 'float64' and not np.isfinite(value)):
+                values.append('')
+            elif datatype == 'float64':
+                values.append(repr(float(value)))
+            else:
+                values.append(str(value))
+        self._writer.writerow(values)
+        self._file.flush()
+        self.n_rows += 1
+
+    def close(self):
+        r"""Close the table"""
+        self._file.close()
@@ -0,0 +1,244 @@
+"""Lightweight timing and memory instrumentation of the read, fit, and plot stages.
+
+Profiling is off by default, and in that case :func:`stage` returns a shared no-op context manager. It is switched
+on with :func:`enable` (e.g. by the `--profile` option of the scripts) or by setting the environment variable
+`GNIRSARC2D_PROFILE` to the name of the JSON report.
+"""
+
+import contextlib
+import json
+import os
+import time
+import tracemalloc
+
+__all__ = ['enable', 'disable', 'is_enabled', 'stage', 'record', 'count', 'report', 'merge', 'reset',
+           'write_report']
+
+PROFILE_ENVIRONMENT_VARIABLE = 'GNIRSARC2D_PROFILE'
+
+_NO_OP = contextlib.nullcontext()
+# Profiler in use, `None` when profiling is disabled
+_PROFILER = None
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return (name,) + tuple(sorted(labels.items()))
+
+
+class Profiler:
+    """Class collecting wall time, number of calls, and peak memory of each stage, plus generic counters.
+
+    Records are aggregated by stage name and labels (e.g. `slit=3`).
+
+    Attributes:
+        memory (bool): trace the peak memory allocated by python during each stage (slows down the code)
+        stages (dict): records of the stages
+        counters (dict): records of the counters
+
+    """
+
+    def __init__(self, memory: bool = True):
+        self.memory = memory
+        self.stages = {}
+        self.counters = {}
+        self._open = []
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name: str, **labels):
+        r"""Context manager timing the code it wraps as a call of the stage `name`.
+
+        Stages can be nested: the peak memory of a stage includes the one of the stages it contains.
+
+        Args:
+            name (str): name of the stage
+            **labels: labels distinguishing different calls of the same stage (e.g. `slit=3`)
+        """
+        frame = {'peak': 0}
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # the peak is reset at each stage: hand the peak reached so far to the stages still running
+            for open_frame in self._open:
+                open_frame['peak'] = max(open_frame['peak'], peak - open_frame['start'])
+            tracemalloc.reset_peak()
+            frame['start'] = current
+        self._open.append(frame)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - start_time
+            self._open.pop()
+            if self.memory:
+                _, peak = tracemalloc.get_traced_memory()
+                frame['peak'] = max(frame['peak'], peak - frame['start'])
+                for open_frame in self._open:
+                    open_frame['peak'] = max(open_frame['peak'], peak - open_frame['start'])
+            self.record(name, wall_time, peak_memory=frame['peak'], **labels)
+
+    def record(self, name: str, wall_time: float, peak_memory: int = 0, **labels):
+        r"""Add a call of the stage `name` to its record.
+
+        Args:
+            name (str): name of the stage
+            wall_time (float): wall time of the call in seconds
+            peak_memory (int): peak memory allocated during the call in bytes
+            **labels: labels distinguishing different calls of the same stage (e.g. `slit=3`)
+        """
+        record = self.stages.setdefault(_key(name, labels), {'name': name, 'labels': labels, 'calls': 0,
+                                                             'wall_time': 0., 'peak_memory': 0})
+        record['calls'] += 1
+        record['wall_time'] += wall_time
+        record['peak_memory'] = max(record['peak_memory'], peak_memory)
+
+    def count(self, name: str, value: float = 1, **labels):
+        r"""Add `value` to the counter `name`.
+
+        Args:
+            name (str): name of the counter
+            value (float): value to be added
+            **labels: labels distinguishing different uses of the same counter (e.g. `slit=3`)
+        """
+        record = self.counters.setdefault(_key(name, labels), {'name': name, 'labels': labels, 'calls': 0,
+                                                               'total': 0})
+        record['calls'] += 1
+        record['total'] += value
+
+    def report(self) -> dict:
+        r"""Records collected so far.
+
+        Returns:
+            dict: process id, memory flag, and lists of the records of the stages and of the counters, that can be
+            saved as JSON
+        """
+        return {'pid': os.getpid(), 'memory': self.memory,
+                'stages': [dict(record) for record in self.stages.values()],
+                'counters': [dict(record) for record in self.counters.values()]}
+
+    def merge(self, other_report: dict):
+        r"""Add the records of another report to the current ones. Calls, wall times, and counter totals are summed,
+        the peak memory is the largest of the two.
+
+        Args:
+            other_report (dict): report produced by :meth:`report`, e.g. in a worker process
+        """
+        for record in other_report['stages']:
+            own = self.stages.setdefault(_key(record['name'], record['labels']),
+                                         {'name': record['name'], 'labels': record['labels'], 'calls': 0,
+                                          'wall_time': 0., 'peak_memory': 0})
+            own['calls'] += record['calls']
+            own['wall_time'] += record['wall_time']
+            own['peak_memory'] = max(own['peak_memory'], record['peak_memory'])
+        for record in other_report['counters']:
+            own = self.counters.setdefault(_key(record['name'], record['labels']),
+                                           {'name': record['name'], 'labels': record['labels'], 'calls': 0,
+                                            'total': 0})
+            own['calls'] += record['calls']
+            own['total'] += record['total']
+
+    def reset(self):
+        r"""Discard the records collected so far"""
+        self.stages, self.counters = {}, {}
+
+
+def enable(memory: bool = True):
+    r"""Switch on the profiling. Records collected by a previous profiler are discarded.
+
+    Args:
+        memory (bool): trace the peak memory of each stage with `tracemalloc`
+    """
+    global _PROFILER
+    _PROFILER = Profiler(memory=memory)
+
+
+def disable():
+    r"""Switch off the profiling"""
+    global _PROFILER
+    if _PROFILER is not None and _PROFILER.memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _PROFILER = None
+
+
+def is_enabled() -> bool:
+    r"""True if the profiling is on"""
+    return _PROFILER is not None
+
+
+def stage(name: str, **labels):
+    r"""Context manager timing the code it wraps as the stage `name`.
+
+    Args:
+        name (str): name of the stage
+        **labels: labels distinguishing different calls of the same stage (e.g. `slit=3`)
+
+    Returns:
+        a context manager, that does nothing when the profiling is off
+    """
+    if _PROFILER is None:
+        return _NO_OP
+    return _PROFILER.stage(name, **labels)
+
+
+def record(name: str, wall_time: float, **labels):
+    r"""Add a call of the stage `name` timed elsewhere, e.g. in a thread where :func:`stage` cannot be used since the
+    profiler is not thread safe. The peak memory is not recorded. No-op if profiling is off.
+
+    Args:
+        name (str): name of the stage
+        wall_time (float): wall time of the call in seconds
+        **labels: labels distinguishing different calls of the same stage (e.g. `slit=3`)
+    """
+    if _PROFILER is not None:
+        _PROFILER.record(name, wall_time, **labels)
+
+
+def count(name: str, value: float = 1, **labels):
+    r"""Add `value` to the counter `name` (e.g. the number of rejection iterations). No-op if profiling is off.
+
+    Args:
+        name (str): name of the counter
+        value (float): value to be added
+        **labels: labels distinguishing different uses of the same counter (e.g. `slit=3`)
+    """
+    if _PROFILER is not None:
+        _PROFILER.count(name, value, **labels)
+
+
+def report() -> dict:
+    r"""Records collected so far.
+
+    Returns:
+        dict: records that can be saved as JSON (see :meth:`Profiler.report`), `None` if profiling is off
+    """
+    return None if _PROFILER is None else _PROFILER.report()
+
+
+def merge(other_report: dict):
+    r"""Add the records of another report to the current ones. No-op if profiling is off.
+
+    Args:
+        other_report (dict): report produced by :func:`report`, e.g. in a worker process. Ignored if `None`
+    """
+    if _PROFILER is not None and other_report is not None:
+        _PROFILER.merge(other_report)
+
+
+def reset():
+    r"""Discard the records collected so far, keeping the profiling on"""
+    if _PROFILER is not None:
+        _PROFILER.reset()
+
+
+def write_report(filename: str):
+    r"""Write the records collected so far in a JSON file.
+
+    Args:
+        filename (str): name of the JSON file. It contains `null` if profiling is off
+    """
+    with open(filename, 'w') as f:
+        json.dump(report(), f, indent=2, default=float)
+
+
+if os.environ.get(PROFILE_ENVIRONMENT_VARIABLE):
+    enable()
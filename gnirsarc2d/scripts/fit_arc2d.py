@@ -1,13 +1,21 @@
 import argparse
-import numpy as np
+import os
+import time
 # from IPython import embed
 
 from gnirsarc2d.gnirs_config import gnirs
-from gnirsarc2d.fitting import arc2d
-from gnirsarc2d import __version__
+from gnirsarc2d import __version__, profiling
 
 EXAMPLES = str(r"""EXAMPLES:""" + """\n""" + """\n""" +
                r""">>> fit_arc2d --database_directory ./database/ --root_filename idwarc_comb_SCI """ + """\n""" +
+               r""">>> fit_arc2d --batch --database_directory ./database/ --pattern 'idwarc*' --processes 4 """ +
+               """\n""" +
+               r""">>> fit_arc2d --watch --database_directory ./database/ --output_directory ./solutions/ """ +
+               """\n""" +
+               r""">>> fit_arc2d --batch --database_directory ./database/ --output_directory ./solutions/ """ +
+               """\n""" +
+               r""">>> fit_arc2d --rectified_arc wrarc_new.fits --prior_solution ./solutions/idwarc_comb_SCI.fits """ +
+               """\n""" +
                r""" """)
 
 
@@ -42,6 +50,73 @@ def parser(options=None):
                                help=r"order of the fitting along the spectral (pixel) direction for each order")
     script_parser.add_argument("-oo", "--fit_order_order", nargs="+", type=int, default=4,
                                help=r"order of the fitting in the order direction")
+    script_parser.add_argument("-r", "--rejection", type=str, default='sigma_clip',
+                               help=r"rejection of the misidentified lines: `sigma_clip` (iterative sigma clipping), "
+                                    r"`mad_clip` (clipping based on the median absolute deviation), `huber` or "
+                                    r"`tukey` (iteratively reweighted least squares), or `lmeds` (least median of "
+                                    r"squares)")
+    script_parser.add_argument("--prefilter", action="store_true", default=False,
+                               help=r"remove, before the fit, the lines with archive wavelength outside the range of "
+                                    r"their order or in disagreement with the wavelength measured by IRAF")
+    script_parser.add_argument("-ra", "--rectified_arc", type=str, default=None,
+                               help=r"rectified arc (multi-extension FITS file with one `SCI` extension per slit) "
+                                    r"on which the position of the lines is refined before the fit, by fitting "
+                                    r"the peak of each line in the spectrum of its order")
+    script_parser.add_argument("-ps", "--prior_solution", type=str, default=None,
+                               help=r"wavelength solution (saved in `output_directory` by a previous run) that "
+                                    r"provides the lines and their approximate position on the `rectified_arc`. "
+                                    r"The IRAF database is not read")
+    script_parser.add_argument("-cm", "--centroid_method", type=str, default='gaussian',
+                               help=r"fit of the peaks of the lines on the `rectified_arc`: `gaussian` or "
+                                    r"`parabola`")
+    script_parser.add_argument("-so", "--search_order", action="store_true", default=False,
+                               help=r"select `fit_function`, `fit_order_spec`, and `fit_order_order` with a "
+                                    r"leave-one-order-out cross validation over a grid of candidates")
+    script_parser.add_argument("--no-plot", dest="plot", action="store_false", default=True,
+                               help=r"do not plot the result of the fit (matplotlib is never imported)")
+    script_parser.add_argument("-pf", "--plot_file", type=str, default=None,
+                               help=r"save the plot in this file (e.g. `fit.png` or `fit.pdf`) instead of showing it")
+    script_parser.add_argument("-pd", "--plot_directory", type=str, default=None,
+                               help=r"in batch mode, save the plot of each arc in this directory")
+    script_parser.add_argument("--profile", nargs="?", type=str, default=None, const="fit_arc2d_profile.json",
+                               help=r"record wall time, calls, rejection iterations, and peak memory of each stage "
+                                    r"and save them in this JSON file (default: fit_arc2d_profile.json). The "
+                                    r"profiling can also be switched on by setting the environment variable "
+                                    r"GNIRSARC2D_PROFILE to the name of the file")
+    script_parser.add_argument("-b", "--batch", action="store_true", default=False,
+                               help=r"fit all the `root_filename` (or all the arcs matching `pattern` in the "
+                                    r"`database_directory`) in a pool of processes, without plotting")
+    script_parser.add_argument("-s", "--stacked", action="store_true", default=False,
+                               help=r"in batch mode, fit together (in a single process) the arcs that identified "
+                                    r"the same lines (archive wavelengths and orders), solving their least-squares "
+                                    r"problems with batched calls")
+    script_parser.add_argument("-w", "--watch", action="store_true", default=False,
+                               help=r"keep running and refit each arc matching `pattern` in the `database_directory` "
+                                    r"when its identify files are created or modified. The solution and the QA "
+                                    r"statistics are written in `output_directory`. Stop with Ctrl+C")
+    script_parser.add_argument("-od", "--output_directory", type=str, default=None,
+                               help=r"directory where the solution (`root_filename.fits`) and the summary of the fit "
+                                    r"(`root_filename_summary.json`) of each arc are written. In batch mode, a row "
+                                    r"for each arc is also appended to the table `summary_table`. In watch mode, it "
+                                    r"defaults to the database directory")
+    script_parser.add_argument("-sf", "--summary_format", type=str, default='json',
+                               help=r"format of the summary of each arc: `json` or `ecsv`")
+    script_parser.add_argument("-st", "--summary_table", type=str, default=None,
+                               help=r"in batch and watch mode, ECSV table where a row for each arc is appended as "
+                                    r"soon as it is fitted (batch mode default: arc2d_summary.ecsv in the "
+                                    r"`output_directory`)")
+    script_parser.add_argument("--debounce", type=float, default=2.,
+                               help=r"in watch mode, seconds without changes to the files of an arc before it is "
+                                    r"refitted")
+    script_parser.add_argument("--poll_interval", type=float, default=1.,
+                               help=r"in watch mode, seconds between two scans of the database directory")
+    script_parser.add_argument("-p", "--pattern", type=str, default="id*",
+                               help=r"glob pattern used to select the identify files in batch mode")
+    script_parser.add_argument("-np", "--processes", type=int, default=None,
+                               help=r"number of processes used in batch mode or in the order search "
+                                    r"(default: number of CPUs)")
+    script_parser.add_argument("-cd", "--cache_directory", type=str, default=None,
+                               help=r"directory where the lines parsed from the database are cached between runs")
     if options is None:
         args = script_parser.parse_args()
     else:
@@ -50,6 +125,18 @@ def parser(options=None):
 
 
 def main(args):
+    profile_file = args.profile or os.environ.get(profiling.PROFILE_ENVIRONMENT_VARIABLE)
+    if args.profile is not None and not profiling.is_enabled():
+        profiling.enable()
+    try:
+        return _main(args)
+    finally:
+        if profile_file:
+            profiling.write_report(profile_file)
+
+
+def _main(args):
+    from gnirsarc2d.fitting import arc2d
     from gnirsarc2d.io import read_iraf_database
     if type(args.database_directory) == list:
         database_directory = args.database_directory[0]
@@ -60,9 +147,9 @@ def main(args):
     else:
         root_filename = args.root_filename
     if type(args.configuration) == list:
-        configuration = gnirs.GnirsConfiguration(name=args.configuration[0])
+        configuration = gnirs.get_configuration(args.configuration[0])
     else:
-        configuration = gnirs.GnirsConfiguration(name=args.configuration)
+        configuration = gnirs.get_configuration(args.configuration)
     if type(args.fit_function) == list:
         fit_function = args.fit_function[0]
     else:
@@ -76,20 +163,126 @@ def main(args):
     else:
         fit_order_order = args.fit_order_order
 
-    pixel, wavelength_iraf, wavelength_archive, order = [], [], [], []
-    for slit in configuration.order["slit"]:
-        pixel_slit, wavelength_iraf_slit, wavelength_archive_slit = read_iraf_database.get_features_from_identify_table(
-            database_directory + root_filename + "_" + str(slit) + "_")
-        order_number = configuration.order['number'][configuration.order['slit'].index(int(slit))]
-        order_slit = [order_number] * len(pixel_slit)
-        pixel.extend(pixel_slit)
-        wavelength_iraf.extend(wavelength_iraf_slit)
-        wavelength_archive.extend(wavelength_archive_slit)
-        order.extend(order_slit)
-    fit2d, mask = arc2d.full_fit(np.array(pixel), np.array(wavelength_archive), np.array(order),
-                                 tot_pixel=configuration.cols, fit_function=fit_function,
-                                 fit_order_spec=fit_order_spec, fit_order_order=fit_order_order)
-    arc2d.plot_fit(fit2d, mask, np.array(pixel), np.array(wavelength_archive), np.array(order),
-                   tot_pixel=configuration.cols)
-
-    return
+    if args.watch:
+        return _main_watch(args, database_directory, configuration, fit_function, fit_order_spec, fit_order_order)
+    if args.batch:
+        return _main_batch(args, database_directory, configuration, fit_function, fit_order_spec, fit_order_order)
+
+    if args.cache_directory is not None:
+        from gnirsarc2d.io import cache
+        identify_cache = cache.IdentifyCache(args.cache_directory)
+    else:
+        identify_cache = None
+    start = time.perf_counter()
+    if args.prior_solution is not None:
+        from gnirsarc2d.fitting import centroid
+        from gnirsarc2d.io import solution
+        if args.rectified_arc is None:
+            raise ValueError('a rectified arc is needed to refine the lines of the prior solution')
+        pixel, wavelength_archive, order = centroid.lines_from_solution(solution.load_solution(args.prior_solution),
+                                                                        tot_pixel=configuration.cols)
+        wavelength_iraf = None
+        if root_filename is None:
+            root_filename = os.path.splitext(os.path.basename(args.rectified_arc))[0]
+    else:
+        pixel, wavelength_iraf, wavelength_archive, order = read_iraf_database.get_features_from_database(
+            database_directory, root_filename, configuration, cache=identify_cache)
+    if args.rectified_arc is not None:
+        from gnirsarc2d.fitting import centroid
+        spectra, spectra_orders = centroid.spectra_from_rectified_arc(args.rectified_arc, configuration)
+    timing = {'read': time.perf_counter() - start}
+    start = time.perf_counter()
+    prefilter_result = None
+    if args.prefilter:
+        from gnirsarc2d.fitting import prefilter
+        with profiling.stage('prefilter'):
+            prefilter_result = prefilter.prefilter_lines(wavelength_iraf, wavelength_archive, order, configuration)
+            pixel, wavelength_archive, order = prefilter_result.apply(pixel, wavelength_archive, order)
+        print(prefilter_result)
+    if args.rectified_arc is not None:
+        centroid_result = centroid.refine_centroids(spectra, spectra_orders, pixel, order,
+                                                    method=args.centroid_method)
+        print(centroid_result)
+        pixel, wavelength_archive, order = centroid_result.apply(wavelength_archive, order)
+    fit_info = {}
+    if args.search_order:
+        from gnirsarc2d.fitting import order_search
+        search_result = order_search.search_fit_order(pixel, wavelength_archive, order,
+                                                      tot_pixel=configuration.cols, processes=args.processes)
+        print(search_result)
+        fit2d, mask = search_result.fit2d, search_result.mask
+    else:
+        fit2d, mask = arc2d.full_fit(pixel, wavelength_archive, order,
+                                     tot_pixel=configuration.cols, fit_function=fit_function,
+                                     fit_order_spec=fit_order_spec, fit_order_order=fit_order_order,
+                                     rejection=args.rejection, fit_info=fit_info)
+    timing['fit'] = time.perf_counter() - start
+    from gnirsarc2d.fitting import batch, qa
+    statistics = qa.residual_statistics(fit2d, mask, pixel, wavelength_archive, order, tot_pixel=configuration.cols)
+    result = batch.ArcFitResult(root_filename, fit2d=fit2d, mask=mask, pixel=pixel, wavelength=wavelength_archive,
+                                order=order, statistics=statistics, prefilter=prefilter_result, fit_info=fit_info,
+                                timing=timing)
+    if args.output_directory is not None:
+        from gnirsarc2d.io import summary
+        arc_summary = summary.write_arc_outputs(result, args.output_directory, configuration=configuration.name,
+                                                tot_pixel=configuration.cols, summary_format=args.summary_format)
+        print('Solution and summary written in {} and {}'.format(arc_summary['solution_file'],
+                                                                 arc_summary['summary_file']))
+    if args.plot:
+        arc2d.plot_fit(fit2d, mask, pixel, wavelength_archive, order,
+                       tot_pixel=configuration.cols, output_file=args.plot_file)
+
+    return result
+
+
+def _main_batch(args, database_directory: str, configuration: object, fit_function: str, fit_order_spec: int,
+                fit_order_order: int) -> list:
+    from gnirsarc2d.fitting import batch
+    summary_table = args.summary_table
+    if summary_table is None and args.output_directory is not None:
+        from gnirsarc2d.io import summary
+        summary_table = os.path.join(args.output_directory, summary.DEFAULT_TABLE_NAME)
+    output_kwargs = {'output_directory': args.output_directory, 'summary_format': args.summary_format,
+                     'summary_table': summary_table}
+    if args.stacked:
+        results = batch.fit_arcs_stacked(database_directory, root_filenames=args.root_filename,
+                                         pattern=args.pattern, configuration=configuration.name,
+                                         cache_directory=args.cache_directory, use_prefilter=args.prefilter,
+                                         fit_function=fit_function, fit_order_spec=fit_order_spec,
+                                         fit_order_order=fit_order_order, rejection=args.rejection, **output_kwargs)
+        if args.plot_directory is not None and args.plot:
+            for result in results:
+                try:
+                    batch.plot_arc(result, configuration=configuration.name, plot_directory=args.plot_directory)
+                except Exception as error:
+                    result.plot_error = '{}: {}'.format(type(error).__name__, error)
+    else:
+        results = batch.fit_arcs(database_directory, root_filenames=args.root_filename, pattern=args.pattern,
+                                 configuration=configuration.name, processes=args.processes,
+                                 cache_directory=args.cache_directory,
+                                 plot_directory=args.plot_directory if args.plot else None,
+                                 fit_function=fit_function, fit_order_spec=fit_order_spec,
+                                 fit_order_order=fit_order_order, rejection=args.rejection,
+                                 use_prefilter=args.prefilter, **output_kwargs)
+    for result in results:
+        print(result)
+    n_failed = sum(not result.success for result in results)
+    print('Fitted {} arcs, {} failed'.format(len(results) - n_failed, n_failed))
+    if summary_table is not None:
+        print('Summary table: {}'.format(summary_table))
+    return results
+
+
+def _main_watch(args, database_directory: str, configuration: object, fit_function: str, fit_order_spec: int,
+                fit_order_order: int) -> int:
+    from gnirsarc2d.fitting import watch
+    watcher = watch.ArcWatcher(database_directory, output_directory=args.output_directory,
+                               configuration=configuration.name, pattern=args.pattern, debounce=args.debounce,
+                               plot_format='png' if args.plot else None, summary_format=args.summary_format,
+                               summary_table=args.summary_table, cache_directory=args.cache_directory,
+                               use_prefilter=args.prefilter, fit_function=fit_function, fit_order_spec=fit_order_spec,
+                               fit_order_order=fit_order_order, rejection=args.rejection)
+    print('Watching {} (Ctrl+C to stop)'.format(database_directory))
+    n_refits = watcher.run(poll_interval=args.poll_interval)
+    print('Refitted {} arcs'.format(n_refits))
+    return n_refits